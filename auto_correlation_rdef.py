@@ -2,49 +2,63 @@
 
 import numpy as np
 import scipy.fftpack as fft
+import scipy.fft as sp_fft
 import argparse
+import os
 import time
-
-def read_rdef_file_in_chunks(filename, chunk_size=256*1024):
-    """Reads an RDEF file in chunks and yields sample data as numpy arrays."""
-    print(f"Reading file: {filename}...", end='', flush=True)
-    start_time = time.time()
-    try:
-        with open(filename, "rb") as f:
-            f.seek(176)
-            while True:
-                data = f.read(chunk_size)
-                if not data:
-                    break
-                samples = np.frombuffer(data, dtype=np.int16).copy()
-                yield samples
-    except Exception as e:
-        print(f"Error reading file {filename}: {e}")
-    print(f" done. ({time.time() - start_time:.2f} seconds)")
-
-def compute_autocorrelation_fft(data, fft_size=2048):
-    """Compute the auto-correlation of the data using FFT."""
-    print("Starting FFT-based auto-correlation computation...", end='', flush=True)
-    start_time = time.time()
-    try:
-        data = data[:fft_size]
-        data = data - np.mean(data)
-        n = len(data)
-
-        f_data = np.fft.fft(data, n=fft_size)
-        psd = f_data * np.conjugate(f_data)
-        autocorrelation = np.fft.ifft(psd).real[:n]
-        autocorrelation /= autocorrelation[0]
-    except Exception as e:
-        print(f"Error during auto-correlation computation: {e}")
-        return None
-    print(f" done. ({time.time() - start_time:.2f} seconds)")
-    return autocorrelation
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from rdef_utilities import *
+from metrics import METRICS, add_metrics_arguments, metrics_config, run_profiler
+
+class AutocorrelationAccumulator:
+    """Running average of the auto-correlation of consecutive segments of fft_size samples.
+
+    Samples are cut into an (n_segments, fft_size) matrix, batch_segments rows at a time transformed
+    by one multi-threaded FFT call, and their power spectra summed: the auto-correlation is the
+    inverse FFT of the average. Samples left over at the end of a block start the next segment."""
+
+    def __init__(self, fft_size=2048, workers=-1, batch_segments=1024):
+        self.fft_size = fft_size
+        self.workers = workers
+        self.batch_segments = batch_segments
+        self.power_sum = np.zeros(fft_size, dtype=np.float64)
+        self.n_segments = 0
+        self._carry = np.empty(fft_size, dtype=np.complex64)
+        self._n_carry = 0
+
+    def _add(self, segments):
+        f_segments = sp_fft.fft(segments, axis=1, workers=self.workers)
+        f_segments[:, 0] = 0  # mean of each segment removed
+        self.power_sum += (f_segments.real ** 2 + f_segments.imag ** 2).sum(axis=0)
+        self.n_segments += len(segments)
+
+    def update(self, samples):
+        """Add a block of consecutive complex samples."""
+        if self._n_carry:
+            n_take = min(self.fft_size - self._n_carry, len(samples))
+            self._carry[self._n_carry:self._n_carry + n_take] = samples[:n_take]
+            self._n_carry += n_take
+            samples = samples[n_take:]
+            if self._n_carry < self.fft_size:
+                return
+            self._add(self._carry[None, :])
+            self._n_carry = 0
+        n_segments = len(samples) // self.fft_size
+        segments = samples[:n_segments * self.fft_size].reshape(n_segments, self.fft_size)
+        for start in range(0, n_segments, self.batch_segments):
+            self._add(segments[start:start + self.batch_segments])
+        self._n_carry = len(samples) - n_segments * self.fft_size
+        self._carry[:self._n_carry] = samples[n_segments * self.fft_size:]
+
+    def autocorrelation(self):
+        """Average auto-correlation, normalized to 1 at lag 0 (None before a whole segment)."""
+        if self.n_segments == 0:
+            return None
+        autocorrelation = sp_fft.ifft(self.power_sum / self.n_segments).real
+        return autocorrelation / autocorrelation[0]
 
 def compute_frequency_spectrum(correlation, sample_rate):
     """Compute the one-sided frequency spectrum from the auto-correlation."""
-    print("Computing frequency spectrum...", end='', flush=True)
-    start_time = time.time()
     try:
         fft_size = len(correlation)
         spectrum = fft.fft(correlation)
@@ -56,71 +70,100 @@ def compute_frequency_spectrum(correlation, sample_rate):
     except Exception as e:
         print(f"Error during frequency spectrum computation: {e}")
         return None, None
-    print(f" done. ({time.time() - start_time:.2f} seconds)")
     return freq, spectrum
 
 def save_spectrum_to_file(frequencies, amplitudes, filename):
     """Save the frequency spectrum to a file."""
     output_filename = f"{filename}_spectrum.txt"
-    print(f"Saving spectrum to {output_filename}...", end='', flush=True)
     try:
         with open(output_filename, "w") as f:
             for freq, amp in zip(frequencies, amplitudes):
                 f.write(f"{freq} {amp}\n")
     except Exception as e:
         print(f"Error saving file {output_filename}: {e}")
-    print(f" done.")
-
-def pad_autocorrelations(correlations):
-    """Pad autocorrelations to the same length."""
-    max_length = max(len(ac) for ac in correlations)
-    padded_correlations = []
-    for ac in correlations:
-        if len(ac) < max_length:
-            padded_ac = np.pad(ac, (0, max_length - len(ac)), 'constant')
-        else:
-            padded_ac = ac
-        padded_correlations.append(padded_ac)
-    return np.array(padded_correlations)
-
-def process_rdef_files(files, sample_rate, chunk_size=256*1024):
-    for i, filename in enumerate(files):
-        print(f"\nProcessing file {filename} ({i + 1}/{len(files)})...")
-
-        all_autocorrelations = []
-        chunk_count = 0
-
-        total_chunks = sum(1 for _ in read_rdef_file_in_chunks(filename, chunk_size))
-        print(f"Total chunks to process: {total_chunks}")
-
-        for chunk in read_rdef_file_in_chunks(filename, chunk_size):
-            chunk_count += 1
-            print(f"Processing chunk {chunk_count}/{total_chunks}...", end='', flush=True)
-            autocorrelation = compute_autocorrelation_fft(chunk, fft_size=2048)
-            if autocorrelation is None:
-                print("Skipping chunk due to auto-correlation error.")
-                continue
-            all_autocorrelations.append(autocorrelation)
-            print(" done.")
-
-        if not all_autocorrelations:
-            print(f"Skipping file {filename} due to errors.")
-            continue
-
-        padded_autocorrelations = pad_autocorrelations(all_autocorrelations)
-        combined_autocorrelation = np.mean(padded_autocorrelations, axis=0)
-
-        frequencies, amplitudes = compute_frequency_spectrum(combined_autocorrelation, sample_rate)
-        if frequencies is None or amplitudes is None:
-            print(f"Skipping file {filename} due to frequency spectrum computation error.")
-            continue
 
+def process_rdef_file(filename, sample_rate=None, fft_size=2048, fft_workers=-1):
+    """Auto-correlation and spectrum of one RDEF file, in one pass over its records. Returns the spectrum file name or None."""
+    start_time = time.time()
+    # Records from their headers, in one pass over the memory-mapped file
+    try:
+        reader = RdefReader(filename)
+    except Exception as e:
+        print(f"Error reading file {filename}: {e}")
+        return None
+    if len(reader) == 0:
+        print(f"Skipping file {filename}, no RDEF record found.")
+        return None
+    file_sample_rate = sample_rate if sample_rate is not None else int(reader.headers['SAMPLE_RATE'][0])
+
+    accumulator = AutocorrelationAccumulator(fft_size, fft_workers)
+    buffer = np.empty(int(reader.headers['SAMPLE_RATE'].max()), dtype=np.complex64)
+    for k in range(len(reader)):
+        with METRICS.timer('rdef_read'):
+            samples = reader.samples(k, out=buffer)
+        with METRICS.timer('fft'):
+            accumulator.update(samples)
+        METRICS.count('samples', len(samples))
+    METRICS.count('bytes_read', len(reader.mmap))
+    METRICS.count('records', len(reader))
+    combined_autocorrelation = accumulator.autocorrelation()
+    if combined_autocorrelation is None:
+        print(f"Skipping file {filename}, fewer than {fft_size} samples.")
+        return None
+    print(f"{filename}: {len(reader)} records, {accumulator.n_segments} segments of {fft_size} samples ({time.time() - start_time:.2f} seconds)")
+
+    with METRICS.timer('spectrum'):
+        frequencies, amplitudes = compute_frequency_spectrum(combined_autocorrelation, file_sample_rate)
+    if frequencies is None or amplitudes is None:
+        print(f"Skipping file {filename} due to frequency spectrum computation error.")
+        return None
+
+    with METRICS.timer('save'):
         save_spectrum_to_file(frequencies, amplitudes, filename)
+    METRICS.count('files')
+    return f"{filename}_spectrum.txt"
+
+def process_rdef_file_job(filename, sample_rate, fft_size, fft_workers, metrics=None):
+    """Worker: process_rdef_file, with the METRICS lines (metrics_config) of the file labelled with its name."""
+    if metrics is not None:
+        METRICS.configure(label=filename, **metrics)
+    try:
+        return process_rdef_file(filename, sample_rate, fft_size, fft_workers)
+    finally:
+        METRICS.summary()
+        METRICS.close()
+
+def process_rdef_files(files, sample_rate=None, fft_size=2048, jobs=1, metrics=None):
+    """Process the files one after the other, or jobs files at a time on a pool of processes sharing the cores.
+
+    metrics -> metrics_config of the workers of the pool (the files processed in this process use METRICS as configured)."""
+    if jobs <= 1:
+        for i, filename in enumerate(files):
+            print(f"\nProcessing file {filename} ({i + 1}/{len(files)})...")
+            process_rdef_file(filename, sample_rate, fft_size)
+        return
+    fft_workers = max((os.cpu_count() or 1) // jobs, 1)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(process_rdef_file_job, filename, sample_rate, fft_size, fft_workers, metrics): filename for filename in files}
+        for i, future in enumerate(as_completed(futures)):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error processing file {futures[future]}: {e}")
+            print(f"Processed {i + 1}/{len(files)} files.")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Compute auto-correlation and frequency spectrum of RDEF PRD files.')
     parser.add_argument('files', nargs='+', help='RDEF PRD files to process.')
-    parser.add_argument('-sample_rate', type=int, default=64000000, help='Sample rate in Hz (default: 128 MHz)')
-    parser.add_argument('-chunk_size', type=int, default=256*1024, help='Size of chunks to read from file (default: 256 KB)')
+    parser.add_argument('-sample_rate', type=int, default=None, help='Sample rate in Hz (default: SAMPLE_RATE of the RDEF records)')
+    parser.add_argument('-fft_size', type=int, default=2048, help='Samples of each auto-correlated segment (default: 2048)')
+    parser.add_argument('-jobs', type=int, default=1, help='Files processed at the same time (default: 1)')
+    add_metrics_arguments(parser)
     args = parser.parse_args()
-    process_rdef_files(args.files, args.sample_rate, args.chunk_size)
+
+    if args.metrics is not None and args.jobs <= 1:
+        METRICS.configure(args.metrics, args.metrics_interval, 'auto_correlation_rdef')
+    with run_profiler(args.profile, args.profile_out):
+        process_rdef_files(args.files, args.sample_rate, args.fft_size, args.jobs, metrics_config(args.metrics, args.metrics_interval))
+    METRICS.summary()
+    METRICS.close()
@@ -0,0 +1,226 @@
+#!/bin/python3
+
+import numpy as np
+import scipy
+import argparse
+import contextlib
+import datetime
+import io
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+from vdif2rdef import *
+from auto_correlation_rdef import AutocorrelationAccumulator
+from synthetic_data import *
+
+def timed(function, repeat=3, setup=None):
+    # Best wall-clock time of repeat calls of function (the least disturbed by the rest of the machine), and its last result.
+    # With setup, function is called with a fresh result of setup(), not timed, at each repeat
+    best = None
+    for _ in range(repeat):
+        inputs = () if setup is None else (setup(),)
+        start = perf_counter()
+        result = function(*inputs)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def stage_report(elapsed, n_bytes, n_items, unit='samples'):
+    # Throughput of a stage: MB/s of the bytes it reads or writes, and items (samples or frames) per second
+    return {'seconds': elapsed, 'bytes': int(n_bytes), 'MB_per_s': n_bytes / elapsed / 1e6,
+            unit: int(n_items), f'{unit}_per_s': n_items / elapsed}
+
+def benchmark_vdif(filename, workdir, repeat=3, rdef_bits=16, fft_size=2048, auxfile=None):
+    """Time each stage of the conversion of a VDIF file, and of the auto-correlation of its RDEF files.
+
+    Stages: header_index (frame headers and their validation), decode, analytic_signal, quantize_write,
+    rdef_read, autocorrelation and, with auxfile, the end-to-end convert_file. Each stage gets its
+    inputs ready from the previous one, so that only its own work is timed. Returns {stage: report}."""
+    stages = {}
+    reader = VdifReader(filename)
+    FRAME_HEADER = reader.FRAME_HEADER
+    file_bytes = len(reader.mmap)
+
+    def header_index():
+        index = VdifIndex(filename)
+        frames_in_sec = index.frames_in_sec()
+        steps_in_sec = frames_in_sec // len(index.threads)
+        first_frame = index.first_second
+        last = index.last_header()
+        n_seconds = int(last['seconds_from_epoch']) - index.frame_key(first_frame)[0] + int(last['data_frame_n'] == steps_in_sec - 1)
+        with contextlib.redirect_stdout(io.StringIO()):  # header validation report
+            return vdif_frame_map(index, first_frame, frames_in_sec, n_seconds)
+    elapsed, FRAME_MAP = timed(header_index, repeat)
+    stages['header_index'] = stage_report(elapsed, file_bytes, reader.index.n_frames, 'frames')
+
+    # Frames and rows of each second, as VdifReader.seconds decodes them
+    steps_in_sec = FRAME_MAP['steps_in_sec']
+    n_seconds = len(FRAME_MAP['frames']) // steps_in_sec
+    seconds = []
+    for k in range(n_seconds):
+        first_step, stop_step = k * steps_in_sec, (k + 1) * steps_in_sec
+        frames = reader.frames(int(FRAME_MAP['starts'][first_step]), int(FRAME_MAP['starts'][stop_step]))
+        seconds.append((frames, vdif_map_rows(FRAME_MAP, first_step, stop_step)))
+    n_channels = vdif_total_channels(FRAME_HEADER)
+    sample_rate = steps_in_sec * vdif_frame_samples_perchann(FRAME_HEADER)
+    n_samples = n_seconds * sample_rate * n_channels
+
+    elapsed, decoded = timed(lambda: [vdif_decode_mapped(frames, rows, FRAME_HEADER) for frames, rows in seconds], repeat)
+    stages['decode'] = stage_report(elapsed, sum(frames.nbytes for frames, rows in seconds), n_samples)
+
+    def analytic_signal():
+        transformed = []
+        for i in range(n_channels):
+            stream = AnalyticSignal()
+            pieces = [stream.push(channels_sample[i]) for channels_sample in decoded]
+            transformed.append(np.concatenate(pieces + [stream.flush()]))
+        return transformed
+    elapsed, transformed = timed(analytic_signal, repeat)
+    stages['analytic_signal'] = stage_report(elapsed, sum(samples.nbytes for samples in transformed), n_samples)
+
+    outnames = [os.path.join(workdir, f'benchmark_{i + 1:02}.prd') for i in range(n_channels)]
+    def quantize_write(transformed):
+        writer = RdefWriter()
+        for i in range(n_channels):
+            writer.open(i, outnames[i])
+        for k in range(n_seconds):
+            for i in range(n_channels):
+                packed_data = quantize_data(transformed[i][k * sample_rate:(k + 1) * sample_rate], rdef_bits, FRAME_HEADER['bit_sample'])
+                writer.write_record(i, None, 2000, 1, k, sample_rate, 8000e6, 0.0, packed_data, rdef_bits)
+        writer.close()
+    # quantize_data scales its input in place: each repeat quantizes a copy of the analytic signal
+    elapsed, _ = timed(quantize_write, repeat, lambda: [samples.copy() for samples in transformed])
+    rdef_bytes = sum(os.path.getsize(outname) for outname in outnames)
+    stages['quantize_write'] = stage_report(elapsed, rdef_bytes, n_samples)
+
+    def rdef_read():
+        samples = []
+        for outname in outnames:
+            rdef = RdefReader(outname)
+            samples.append([rdef.samples(k) for k in range(len(rdef))])
+        return samples
+    elapsed, rdef_samples = timed(rdef_read, repeat)
+    stages['rdef_read'] = stage_report(elapsed, rdef_bytes, n_samples)
+
+    def autocorrelation():
+        for records in rdef_samples:
+            accumulator = AutocorrelationAccumulator(fft_size)
+            for samples in records:
+                accumulator.update(samples)
+            accumulator.autocorrelation()
+    elapsed, _ = timed(autocorrelation, repeat)
+    stages['autocorrelation'] = stage_report(elapsed, sum(samples.nbytes for records in rdef_samples for samples in records), n_samples)
+
+    if auxfile is not None:
+        aux = load_aux_file(auxfile)
+        outdir = os.path.join(workdir, 'convert')
+        os.makedirs(outdir, exist_ok=True)
+        def convert():
+            with contextlib.redirect_stdout(io.StringIO()):
+                return convert_file(filename, aux, maxseconds=n_seconds, outdir=outdir, nocache=True, rdef_bits=rdef_bits)
+        elapsed, _ = timed(convert, repeat)
+        stages['convert_file'] = stage_report(elapsed, file_bytes, n_samples)
+    return stages
+
+def platform_info():
+    """Machine, Python and library versions, and the git revision of the code, to compare results."""
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {'machine': platform.machine(), 'platform': platform.platform(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count(), 'python': platform.python_version(), 'numpy': np.__version__,
+            'scipy': scipy.__version__, 'revision': revision}
+
+def config_key(config):
+    # Configurations of two benchmark files compared with each other
+    return tuple(config.get(key) for key in ('filename', 'nchann', 'threads', 'bit_sample', 'complex_data', 'legacy', 'seconds', 'frames_per_sec'))
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Print the stages whose MB/s fell by more than tolerance (a fraction) from the baseline results; returns their number."""
+    baseline_runs = {config_key(run['config']): run['stages'] for run in baseline['runs']}
+    regressions = 0
+    for run in results['runs']:
+        baseline_stages = baseline_runs.get(config_key(run['config']))
+        if baseline_stages is None:
+            continue
+        for stage, report in run['stages'].items():
+            if stage not in baseline_stages:
+                continue
+            ratio = report['MB_per_s'] / baseline_stages[stage]['MB_per_s']
+            if ratio < 1 - tolerance:
+                print(f"*** Regression of {stage} on {run['config']['filename']}: {report['MB_per_s']:.1f} MB/s, {ratio:.0%} of the baseline")
+                regressions += 1
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Throughput (MB/s, samples/s) of each stage of vdif2rdef on synthetic VDIF data, to JSON.')
+    parser.add_argument('-outfile', type=str, default='benchmark.json', help='JSON file of the results.')
+    parser.add_argument('-seconds', type=int, default=2, help='Seconds of synthetic data.')
+    parser.add_argument('-fps', type=int, default=100, help='Frames per second of each thread.')
+    parser.add_argument('-payload', type=int, default=8000, help='Bytes of the data field of each frame.')
+    parser.add_argument('-nchann', type=int, nargs='+', default=[8], help='Channel counts (of each thread) to benchmark.')
+    parser.add_argument('-bits', type=int, nargs='+', default=[2], help='Bits per sample to benchmark.')
+    parser.add_argument('-threads', type=int, nargs='+', default=[1], help='Thread counts to benchmark.')
+    parser.add_argument('-legacy', action='store_true', help='16-byte legacy headers.')
+    parser.add_argument('-complex', action='store_true', help='Complex samples.')
+    parser.add_argument('-drop', type=float, default=0.0, help='Fraction of frames left out of the synthetic files.')
+    parser.add_argument('-vdif', type=str, help='Benchmark this VDIF file instead of synthetic ones.')
+    parser.add_argument('-auxfile', type=str, help='Sidefile of the -vdif file, to time the end-to-end conversion too.')
+    parser.add_argument('-convert', action='store_true', help='Time the end-to-end conversion of the synthetic files too.')
+    parser.add_argument('-rdef_bits', type=int, default=16, choices=[2, 4, 8, 16], help='Bits of each RDEF I and Q sample.')
+    parser.add_argument('-fft_size', type=int, default=2048, help='Samples of each auto-correlated segment.')
+    parser.add_argument('-repeat', type=int, default=3, help='Runs of each stage, the best one reported.')
+    parser.add_argument('-workdir', type=str, help='Directory of the files written (default: a temporary one, removed at the end).')
+    parser.add_argument('-baseline', type=str, help='Earlier JSON results to compare with: regressions are reported, with exit status 1.')
+    parser.add_argument('-tolerance', type=float, default=0.1, help='Fraction of the baseline MB/s a stage may lose before it is a regression.')
+    args = parser.parse_args()
+
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix='vdif2rdef_benchmark_')
+    os.makedirs(workdir, exist_ok=True)
+    results = {'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+               'platform': platform_info(), 'runs': []}
+    try:
+        if args.vdif is not None:
+            configs = [(args.vdif, {'filename': os.path.basename(args.vdif)}, args.auxfile)]
+        else:
+            configs = []
+            for nchann, bits, threads in itertools.product(args.nchann, args.bits, args.threads):
+                filename = os.path.join(workdir, f'synthetic_{nchann}x{threads}_{bits}bit.vdif')
+                config = synth_vdif_file(filename, args.seconds, nchann, bits, args.fps, args.payload, threads,
+                                         args.legacy, args.complex, drop=args.drop, lead_frames=3)
+                config['filename'] = os.path.basename(filename)
+                auxfile = None
+                if args.convert:
+                    auxfile = filename + '.aux'
+                    synth_aux_file(auxfile, nchann * threads)
+                configs.append((filename, config, auxfile))
+
+        for filename, config, auxfile in configs:
+            print(f"Benchmarking {config['filename']} ...")
+            stages = benchmark_vdif(filename, workdir, args.repeat, args.rdef_bits, args.fft_size, auxfile)
+            for stage, report in stages.items():
+                unit = 'frames' if 'frames' in report else 'samples'
+                print(f"  {stage:16} {report['MB_per_s']:10.1f} MB/s {report[unit + '_per_s'] / 1e6:10.2f} M{unit}/s")
+            results['runs'].append({'config': config, 'rdef_bits': args.rdef_bits, 'fft_size': args.fft_size,
+                                    'repeat': args.repeat, 'stages': stages})
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.outfile, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {args.outfile}')
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare_to_baseline(results, baseline, args.tolerance):
+            sys.exit(1)
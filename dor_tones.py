@@ -0,0 +1,188 @@
+#!/bin/python3
+
+import numpy as np
+import argparse
+import os
+import sys
+from vdif_utilities import *
+
+def dor_tone_plan(aux, channels, sample_rate, complex_data=False):
+    """Baseband frequencies (Hz) of the DOR tones falling in each channel, {channel: frequencies}.
+
+    A tone at CARRIER_FREQUENCY + DOR_TONES_OFFSET is at that minus CHANNELS_FREQUENCY in the channel,
+    which it falls in if that is between 0 and sample_rate / 2 (-sample_rate / 2 and sample_rate / 2
+    for complex data). Channels without tones are left out."""
+    tones = [aux['CARRIER_FREQUENCY'] + offset for offset in aux.get('DOR_TONES_OFFSET', [])]
+    low, high = (-sample_rate / 2, sample_rate / 2) if complex_data else (0, sample_rate / 2)
+    plan = {}
+    for i in channels:
+        frequencies = [tone - aux['CHANNELS_FREQUENCY'][i] for tone in tones]
+        frequencies = sorted({frequency for frequency in frequencies if low < frequency < high})
+        if frequencies:
+            plan[i] = np.array(frequencies)
+    return plan
+
+class ToneExtractor:
+    """Phasors of a few tones of one channel, integration by integration, from its decoded samples.
+
+    The samples of each integration are multiplied by the mixers exp(-2j pi f n / fs) of all the tones
+    chunk_samples at a time: a (chunk_samples, tones) table shared by all the chunks, in one matrix
+    product per chunk, each chunk's sum rotated by the mixer phase at its start. The phase of the
+    first sample of each integration is applied afterwards. The work scales with the number of tones,
+    with no transform of the whole band, and the memory with chunk_samples."""
+
+    def __init__(self, frequencies, sample_rate, integration_samples, complex_data=False, chunk_samples=65536):
+        self.frequencies = np.asarray(frequencies, dtype=np.float64)
+        self.sample_rate = sample_rate
+        self.integration_samples = integration_samples
+        self.complex_data = complex_data
+        self.chunk_samples = min(chunk_samples, integration_samples)
+        cycles = np.outer(np.arange(self.chunk_samples), self.frequencies) / sample_rate % 1
+        mixer = np.exp(-2j * np.pi * cycles)
+        self.mixer = mixer.astype(np.complex64)
+        self.mixer_parts = np.concatenate((mixer.real, mixer.imag), axis=1).astype(np.float32)
+        # Mixer phase at the start of each chunk of an integration
+        starts = np.arange(0, integration_samples, self.chunk_samples)
+        self.rotations = np.exp(-2j * np.pi * (np.outer(starts, self.frequencies) / sample_rate % 1))
+        # A real tone of amplitude a gives a phasor of amplitude a / 2
+        self.scale = (1.0 if complex_data else 2.0) / integration_samples
+
+    def process(self, samples, second=0, first_sample=0):
+        """(integrations, tones) complex phasors of the whole integrations of samples.
+
+        samples[0] is sample first_sample of second seconds after the reference time of the phases."""
+        n_integrations = len(samples) // self.integration_samples
+        blocks = samples[:n_integrations * self.integration_samples].reshape(n_integrations, self.integration_samples)
+        n_tones = len(self.frequencies)
+        phasors = np.zeros((n_integrations, n_tones), dtype=np.complex128)
+        for chunk, start in enumerate(range(0, self.integration_samples, self.chunk_samples)):
+            stop = min(start + self.chunk_samples, self.integration_samples)
+            if self.complex_data:
+                mixed = blocks[:, start:stop] @ self.mixer[:stop - start]
+            else:
+                parts = blocks[:, start:stop].astype(np.float32) @ self.mixer_parts[:stop - start]
+                mixed = parts[:, :n_tones] + 1j * parts[:, n_tones:]
+            phasors += mixed * self.rotations[chunk]
+        # Mixer phase at the first sample of each integration, from whole seconds and samples separately to stay exact
+        starts = first_sample + self.integration_samples * np.arange(n_integrations)
+        cycles = (self.frequencies * second) % 1 + np.outer(starts, self.frequencies) / self.sample_rate % 1
+        return phasors * np.exp(-2j * np.pi * cycles) * self.scale
+
+class ToneWriter:
+    """Amplitude and phase of the DOR tones of each channel of plan (dor_tone_plan), written to {outname}_tones.txt.
+
+    Fed with the decoded samples of consecutive seconds, whole (add_second) or in pieces of a channel
+    (add_samples), so that a conversion writes the tones of the samples it decodes anyway. Each line:
+    second of day of the start of the integration, sky frequency of the tone (Hz), amplitude, phase
+    (rad, from the start of the first second) and the validity flag of the RDEF records: 0 if no frame
+    of that second was missing, else 1."""
+
+    def __init__(self, FRAME_HEADER, aux, plan, sample_rate, integration_time, outnames):
+        integration_samples = int(round(integration_time * sample_rate))
+        if integration_samples <= 0 or sample_rate % integration_samples or abs(integration_samples - integration_time * sample_rate) > 1e-6:
+            print(f'*** Error: Integration time {integration_time} s is not a whole number of samples dividing one second ({sample_rate} samples).')
+            sys.exit()
+        self.FRAME_HEADER = FRAME_HEADER
+        self.aux = aux
+        self.plan = plan
+        self.integration_time = integration_time
+        self.integration_samples = integration_samples
+        self.names = [f'{outnames[i]}_tones.txt' for i in plan]
+        self.extractors = {i: ToneExtractor(frequencies, sample_rate, integration_samples, FRAME_HEADER['data_type']) for i, frequencies in plan.items()}
+        self.tone_files = {i: open(f'{outnames[i]}_tones.txt', 'w') for i in plan}
+        self.first_second = None
+        self._pending = {i: [] for i in plan}  # pieces of the unfinished integration of each channel
+        for i in plan:
+            sky_frequencies = ', '.join(f'{aux["CHANNELS_FREQUENCY"][i] + frequency:.2f}' for frequency in plan[i])
+            print(f'Extracting DOR tones of channel {i + 1} at {sky_frequencies} Hz to {outnames[i]}_tones.txt ...')
+
+    def add_second(self, seconds_from_epoch, valid, channels_sample):
+        """Decoded samples of a whole second (as VdifReader.seconds yields them)."""
+        for i in self.plan:
+            self.add_samples(i, seconds_from_epoch, valid, channels_sample[i], 0)
+
+    def add_samples(self, i, seconds_from_epoch, valid, samples, first_sample):
+        """Samples of channel i from sample first_sample of a second, following the samples added before.
+
+        Whole integrations are processed at once; the samples of an unfinished one are copied until it is."""
+        if self.first_second is None:
+            self.first_second = seconds_from_epoch
+        pending = self._pending[i]
+        if pending:
+            pending.append(samples.copy())
+            if sum(len(piece) for piece in pending) < self.integration_samples:
+                return
+            first_sample -= sum(len(piece) for piece in pending[:-1])
+            samples = np.concatenate(pending)
+            pending.clear()
+        n_whole = len(samples) // self.integration_samples * self.integration_samples
+        if n_whole:
+            self._write(i, seconds_from_epoch, valid, samples[:n_whole], first_sample)
+        if n_whole < len(samples):
+            pending.append(samples[n_whole:].copy())
+
+    def _write(self, i, seconds_from_epoch, valid, samples, first_sample):
+        phasors = self.extractors[i].process(samples, seconds_from_epoch - self.first_second, first_sample)
+        amplitude, phase = np.abs(phasors), np.angle(phasors)
+        sod = vdif_second_timetag(self.FRAME_HEADER, seconds_from_epoch, 1)[2]
+        flag = 0 if valid[i // self.FRAME_HEADER['nchann']] else 1  # as VALIDITY_FLAG
+        first_integration = first_sample // self.integration_samples
+        lines = []
+        for k in range(len(phasors)):
+            for t, frequency in enumerate(self.plan[i]):
+                lines.append(f'{sod + (first_integration + k) * self.integration_time} {self.aux["CHANNELS_FREQUENCY"][i] + frequency} {amplitude[k, t]} {phase[k, t]} {flag}\n')
+        self.tone_files[i].writelines(lines)
+
+    def close(self):
+        for tone_file in self.tone_files.values():
+            tone_file.close()
+
+def extract_tones(seconds, FRAME_HEADER, aux, plan, sample_rate, integration_time, outnames):
+    """Write the amplitude and phase of the DOR tones of each channel of plan to {outname}_tones.txt (see ToneWriter).
+
+    seconds -> (seconds_from_epoch, valid, channels_sample) of consecutive seconds, as VdifReader.seconds.
+    Returns the names written."""
+    tone_writer = ToneWriter(FRAME_HEADER, aux, plan, sample_rate, integration_time, outnames)
+    try:
+        for seconds_from_epoch, valid, channels_sample in seconds:
+            tone_writer.add_second(seconds_from_epoch, valid, channels_sample)
+    finally:
+        tone_writer.close()
+    return tone_writer.names
+
+if __name__ == "__main__":
+    from vdif2rdef import load_aux_file, rdef_output_name
+
+    parser = argparse.ArgumentParser(description='Extract the amplitude and phase of the DOR tones of VDIF files.')
+    parser.add_argument('filenames', nargs='+', help='VDIF file(s) to process.')
+    parser.add_argument('-auxfile', type=str, help='Name of the auxiliary side file, with DOR_TONES_OFFSET.')
+    parser.add_argument('-skip', type=int, default=0, help='Seconds to skip from the beginning of the file.')
+    parser.add_argument('-maxseconds', type=int, help='Max number of seconds to process (default: all).')
+    parser.add_argument('-channels', nargs='+', type=int, help='Channels to look for tones in (first channel is "1").')
+    parser.add_argument('-integration', type=float, default=0.1, help='Integration time of each phase and amplitude (s).')
+    parser.add_argument('-outdir', type=str, default='.', help='Directory of the tone files.')
+    args = parser.parse_args()
+
+    aux = load_aux_file(args.auxfile)
+    for filename in args.filenames:
+        print(f'Processing {filename} ...')
+        reader = VdifReader(filename)
+        FRAME_HEADER = reader.FRAME_HEADER
+        n_channels = vdif_total_channels(FRAME_HEADER)
+        if n_channels != aux['NUMBER_CHANNELS']:
+            print(f'*** Error: Number of channels in auxiliary file does not match VDIF file {filename}.')
+            sys.exit()
+        channels = range(n_channels) if args.channels is None else [(int(k) - 1) for k in args.channels]
+        frames_in_sec = reader.index.frames_in_sec()
+        sample_rate = frames_in_sec // len(reader.index.threads) * vdif_frame_samples_perchann(FRAME_HEADER)
+        plan = dor_tone_plan(aux, channels, sample_rate, FRAME_HEADER['data_type'])
+        if not plan:
+            print(f'No DOR tone in the band of the channels of {filename}.')
+            continue
+
+        # Files named as the RDEF files of the same seconds would be
+        first_second = reader.index.frame_key(reader.index.first_second)[0] + args.skip
+        year, doy, sod, hh, mm, ss = vdif_second_timetag(FRAME_HEADER, first_second, frames_in_sec)
+        outnames = {i: os.path.join(args.outdir, rdef_output_name(aux, i, year, doy, hh, mm, ss)) for i in plan}
+        extract_tones(reader.seconds(args.skip, args.maxseconds, list(plan)), FRAME_HEADER, aux, plan, sample_rate, args.integration, outnames)
+    print('Processing completed.')
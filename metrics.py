@@ -0,0 +1,174 @@
+#!/bin/python3
+
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import tracemalloc
+from time import perf_counter, time
+
+class StageTimer:
+    """Context manager adding the time spent in its block to a stage of RunMetrics."""
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add_time(self.stage, perf_counter() - self.start)
+        return False
+
+class RunMetrics:
+    """Timers, counters and gauges of the stages of a run, reported as JSON lines.
+
+    Disabled (the default) every call returns at once, so the stages can be instrumented at no cost.
+    Once configured, a progress line with the totals so far is written at most every interval seconds,
+    and summary() writes the totals of the run with the rate of each counter and the share of the
+    run spent in each stage. Counters count things (bytes, frames, samples), timers add up seconds
+    (and calls) of a stage, gauges keep the last and largest value of a level (queue depths)."""
+
+    def __init__(self):
+        self.enabled = False
+        self.outfile = None
+        self._null_timer = contextlib.nullcontext()
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.timers = {}
+        self.gauges = {}
+        self.started = perf_counter()
+        self._last_report = self.started
+
+    def configure(self, outfile='-', interval=10.0, label=None):
+        """Start measuring; lines are appended to outfile ('-' for stdout), one a line so that processes can share it."""
+        self.close()
+        self.enabled = True
+        self.interval = interval
+        self.label = label
+        self._out = sys.stdout if outfile == '-' else open(outfile, 'a', buffering=1)
+        self.outfile = outfile
+        self.reset()
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        if not self.enabled:
+            return
+        last, peak = self.gauges.get(name, (value, value))
+        self.gauges[name] = (value, max(peak, value))
+
+    def timer(self, stage):
+        """with METRICS.timer('decode'): ... adds the time of the block to the stage."""
+        if not self.enabled:
+            return self._null_timer
+        return StageTimer(self, stage)
+
+    def add_time(self, stage, seconds):
+        if not self.enabled:
+            return
+        total, calls = self.timers.get(stage, (0.0, 0))
+        self.timers[stage] = (total + seconds, calls + 1)
+        self.tick()
+
+    def tick(self):
+        """Write a progress line if interval seconds have passed since the last one."""
+        if not self.enabled:
+            return
+        now = perf_counter()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self._emit('progress')
+
+    def snapshot(self):
+        """Totals so far, as written in the JSON lines."""
+        elapsed = perf_counter() - self.started
+        return {'elapsed': elapsed,
+                'counters': dict(self.counters),
+                'rates': {name: value / elapsed for name, value in self.counters.items()} if elapsed > 0 else {},
+                'timers': {stage: {'seconds': total, 'calls': calls, 'share': total / elapsed if elapsed > 0 else 0.0}
+                           for stage, (total, calls) in self.timers.items()},
+                'gauges': {name: {'last': last, 'max': peak} for name, (last, peak) in self.gauges.items()}}
+
+    def _emit(self, event):
+        line = {'event': event, 'time': time(), 'pid': os.getpid()}
+        if self.label is not None:
+            line['label'] = self.label
+        line.update(self.snapshot())
+        self._out.write(json.dumps(line) + '\n')
+
+    def summary(self):
+        """Write the summary line of the run and return its totals (None if disabled)."""
+        if not self.enabled:
+            return None
+        self._emit('summary')
+        return self.snapshot()
+
+    def close(self):
+        if self.enabled and self._out is not sys.stdout:
+            self._out.close()
+        self.enabled = False
+
+# Metrics of this process, shared by all the modules
+METRICS = RunMetrics()
+
+def metrics_config(outfile=None, interval=10.0):
+    """Settings to configure METRICS with in worker processes, None if not measuring."""
+    return None if outfile is None else {'outfile': outfile, 'interval': interval}
+
+@contextlib.contextmanager
+def run_profiler(kind=None, outfile=None, top=25):
+    """Profile the block with cProfile ('cprofile') or trace its memory allocations ('tracemalloc').
+
+    cProfile statistics are dumped to outfile (for pstats or snakeviz) and the top functions by
+    cumulative time printed; tracemalloc prints the peak and the lines allocating the most memory
+    (to outfile too, if given). kind None profiles nothing."""
+    if kind is None:
+        yield
+        return
+    if kind == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            if outfile is not None:
+                profiler.dump_stats(outfile)
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(top)
+            print(report.getvalue())
+    elif kind == 'tracemalloc':
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            lines = [f'Memory: {current / 1e6:.1f} MB allocated at the end, {peak / 1e6:.1f} MB at the peak']
+            lines += [str(statistic) for statistic in snapshot.statistics('lineno')[:top]]
+            print('\n'.join(lines))
+            if outfile is not None:
+                with open(outfile, 'w') as f:
+                    f.write('\n'.join(lines) + '\n')
+    else:
+        print('*** UNKNOWN PROFILER: ', kind)
+        sys.exit()
+
+def add_metrics_arguments(parser):
+    """Command line options of the metrics and profiler of a run."""
+    parser.add_argument('-metrics', type=str, help='Append JSON lines of the timers and counters of each stage to this file ("-" for stdout).')
+    parser.add_argument('-metrics-interval', type=float, default=10.0, help='Seconds between progress lines of -metrics (a summary line ends the run).')
+    parser.add_argument('-profile', choices=['cprofile', 'tracemalloc'], help='Profile the run (of the main process) with cProfile or tracemalloc.')
+    parser.add_argument('-profile-out', type=str, help='File of the cProfile statistics or tracemalloc report.')
@@ -0,0 +1,198 @@
+#!/bin/python3
+
+import numpy as np
+import os
+import struct
+
+# RDEF record header: 176 bytes, little endian
+RDEF_HEADER = struct.Struct('<4sIH2sHHIHHddHHI6d5d9Ii')
+
+# The same header as a NumPy record, to read the headers of a whole file at once
+RDEF_HEADER_DTYPE = np.dtype([('RECORD_LABEL', 'S4'), ('RECORD_LENGTH', '<u4'), ('RECORD_VERSION_ID', '<u2'),
+                              ('STATION_ID', 'S2'), ('SPACECRAFT_ID', '<u2'), ('SAMPLE_SIZE', '<u2'),
+                              ('SAMPLE_RATE', '<u4'), ('VALIDITY_FLAG', '<u2'), ('AGENCY_FLAG', '<u2'),
+                              ('RF_TO_IF_DOWNCONV', '<f8'), ('IF_TO_CHANNEL_DOWNCONV', '<f8'),
+                              ('TIMETAG_YEAR', '<u2'), ('TIMETAG_DOY', '<u2'), ('TIMETAG_SECOND_OF_DAY', '<u4'),
+                              ('TIMETAG_PICOSECOND', '<f8'), ('CHANN_ACCUM_PHASE', '<f8'),
+                              ('CHANN_PHASE_C0', '<f8'), ('CHANN_PHASE_C1', '<f8'), ('CHANN_PHASE_C2', '<f8'),
+                              ('CHANN_PHASE_C3', '<f8'), ('SPARE_PHASE', '<f8', 5), ('SPARE', '<u4', 9),
+                              ('END_LABEL', '<i4')])
+
+# Bits of each I and Q sample of the records
+RDEF_SAMPLE_SIZES = (2, 4, 8, 16)
+
+def rdef_record_bytes(total_samples_perchann, sample_size=16):
+    """Bytes of the packed I/Q samples of one record."""
+    return -(-total_samples_perchann * 2 * sample_size // 8)
+
+def rdef_header_fields(year_beg, doy_beg, sod_beg, total_samples_perchann, carrier_frequency, channel_frequency_offset, sample_size=16, validity_flag=0):
+    """Values of the RDEF header fields, in RDEF_HEADER order."""
+    RECORD_LABEL = 'RDEF'
+    RECORD_VERSION_ID = 0
+    STATION_ID = 'Wa'.encode()
+    SPACECRAFT_ID = 0
+    SAMPLE_SIZE = sample_size  # bits of each of the I and Q parts of a complex sample
+    SAMPLE_RATE = int(total_samples_perchann)
+    VALIDITY_FLAG = validity_flag  # 0 valid, 1 samples of missing or invalid VDIF frames set to zero
+    AGENCY_FLAG = 0
+    RF_TO_IF_DOWNCONV = 0.0
+    IF_TO_CHANNEL_DOWNCONV = float(carrier_frequency)  # Use single carrier frequency here
+    TIMETAG_PICOSECOND = 0.0
+    CHANN_ACCUM_PHASE = 0.0
+    CHANN_PHASE_C0 = 0.0
+    CHANN_PHASE_C1 = float(channel_frequency_offset)
+    CHANN_PHASE_C2 = 0.0
+    CHANN_PHASE_C3 = 0.0
+    END_LABEL = -99999
+
+    RECORD_LENGTH = RDEF_HEADER.size + rdef_record_bytes(total_samples_perchann, sample_size)
+
+    return (RECORD_LABEL.encode(), RECORD_LENGTH, RECORD_VERSION_ID, STATION_ID.ljust(2, b'\x00'), SPACECRAFT_ID,
+            SAMPLE_SIZE, SAMPLE_RATE, VALIDITY_FLAG, AGENCY_FLAG, RF_TO_IF_DOWNCONV, IF_TO_CHANNEL_DOWNCONV,
+            year_beg, doy_beg, int(sod_beg), TIMETAG_PICOSECOND, CHANN_ACCUM_PHASE,
+            CHANN_PHASE_C0, CHANN_PHASE_C1, CHANN_PHASE_C2, CHANN_PHASE_C3) + (0.0,) * 5 + (0,) * 9 + (END_LABEL,)
+
+def quantize_data(transformed_data, sample_size=16, input_bits=2, out=None):
+    """Requantize complex data to interleaved I/Q samples of sample_size bits, packed as in an RDEF record.
+
+    Uniform mid-rise quantizer with two's complement codes, whose full scale is that of input_bits
+    VDIF samples: code = floor(x * 2**(sample_size - input_bits - 1)), clipped to sample_size bits.
+    Samples shorter than a byte are packed first sample in the most significant bits, 16-bit
+    samples are little endian. transformed_data is scaled in place; out (uint8) receives the bytes."""
+    iq_pairs = transformed_data.view(np.float32)  # I, Q, I, Q, ...
+    iq_pairs *= 2.0 ** (sample_size - input_bits - 1)
+    np.floor(iq_pairs, out=iq_pairs)
+    np.clip(iq_pairs, -2 ** (sample_size - 1), 2 ** (sample_size - 1) - 1, out=iq_pairs)
+
+    n_bytes = rdef_record_bytes(len(transformed_data), sample_size)
+    packed = np.empty(n_bytes, dtype=np.uint8) if out is None else out[:n_bytes]
+    if sample_size >= 8:
+        np.copyto(packed.view(np.int8 if sample_size == 8 else '<i2'), iq_pairs, casting='unsafe')
+        return packed
+
+    samples_per_byte = 8 // sample_size
+    codes = np.zeros(n_bytes * samples_per_byte, dtype=np.uint8)
+    np.copyto(codes[:len(iq_pairs)].view(np.int8), iq_pairs, casting='unsafe')
+    codes &= (1 << sample_size) - 1
+    codes = codes.reshape(n_bytes, samples_per_byte)
+    np.left_shift(codes[:, 0], 8 - sample_size, out=packed)
+    for k in range(1, samples_per_byte):
+        packed |= codes[:, k] << (8 - (k + 1) * sample_size)
+    return packed
+
+def unpack_data(packed, sample_size=16, n_values=None):
+    """Interleaved I/Q codes (int8, or int16 for 16-bit samples) of packed RDEF samples, the inverse of quantize_data's packing.
+
+    8- and 16-bit samples are returned as views of packed, without copying."""
+    if sample_size == 16:
+        return packed[:n_values * 2 if n_values is not None else None].view('<i2')[:n_values]
+    if sample_size == 8:
+        return packed.view(np.int8)[:n_values]
+    samples_per_byte = 8 // sample_size
+    codes = np.empty((len(packed), samples_per_byte), dtype=np.uint8)
+    for k in range(samples_per_byte):
+        np.right_shift(packed, 8 - (k + 1) * sample_size, out=codes[:, k])
+    codes &= (1 << sample_size) - 1
+    # Sign extension of the two's complement codes
+    codes = codes.reshape(-1)[:n_values].view(np.int8)
+    codes[codes >= 1 << (sample_size - 1)] -= 1 << sample_size
+    return codes
+
+class RdefWriter:
+    """RDEF output: one open, large-buffered file per channel, each record written in one go.
+
+    The header of each record is packed with RDEF_HEADER into a reusable buffer. Records larger
+    than the buffer bypass it: header and payload go to the file in a single vectored write."""
+
+    def __init__(self, buffer_size=4 * 1024 * 1024):
+        self.buffer_size = buffer_size
+        self.files = {}
+        self._header = bytearray(RDEF_HEADER.size)
+
+    def open(self, channel, filename):
+        """Create (or truncate) the RDEF file of a channel."""
+        self.files[channel] = open(filename, "wb", buffering=self.buffer_size)
+
+    def _write(self, out_f, *parts):
+        parts = [memoryview(part).cast('B') for part in parts]
+        if hasattr(os, 'writev') and sum(len(part) for part in parts) >= self.buffer_size:
+            out_f.flush()
+            written = os.writev(out_f.fileno(), parts)  # large payloads: no copy through the buffer
+            # Finish a short write with plain writes of what is left
+            for part in parts:
+                skip = min(written, len(part))
+                written -= skip
+                if skip < len(part):
+                    out_f.write(part[skip:])
+        else:
+            for part in parts:
+                out_f.write(part)
+
+    def write_record(self, channel, frame, year_beg, doy_beg, sod_beg, total_samples_perchann, carrier_frequency, channel_frequency_offset, interleaved_data, sample_size=16, validity_flag=0):
+        """Write the header of a new record and its first (or only) interleaved samples."""
+        RDEF_HEADER.pack_into(self._header, 0, *rdef_header_fields(year_beg, doy_beg, sod_beg, total_samples_perchann, carrier_frequency, channel_frequency_offset, sample_size, validity_flag))
+        self._write(self.files[channel], self._header, interleaved_data)
+
+    def write(self, channel, interleaved_data):
+        """Write more interleaved samples of the current record."""
+        self._write(self.files[channel], interleaved_data)
+
+    def flush(self):
+        """Push the buffered records of all the channels to their files."""
+        for out_f in self.files.values():
+            out_f.flush()
+
+    def close(self):
+        for out_f in self.files.values():
+            out_f.close()
+        self.files = {}
+
+class RdefReader:
+    """Records of an RDEF file, from a memory map of the file.
+
+    The records are found by walking the RECORD_LENGTH of their headers, in a single pass over the
+    headers only. headers -> structured array (RDEF_HEADER_DTYPE) of all of them; iq(k) -> the
+    interleaved I/Q codes of record k, a view of the file for 8- and 16-bit samples; iterating gives
+    (header, complex64 samples) record by record."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.mmap = np.memmap(filename, dtype=np.uint8, mode='r') if os.path.getsize(filename) else np.zeros(0, dtype=np.uint8)
+        offsets = []
+        position = 0
+        while position + RDEF_HEADER.size <= len(self.mmap):
+            label, record_length = struct.unpack_from('<4sI', self.mmap, position)
+            if label != b'RDEF' or record_length < RDEF_HEADER.size:
+                print('*** NO RDEF RECORD AT BYTE {} OF {}, IGNORING THE REST OF THE FILE'.format(position, filename))
+                break
+            if position + record_length > len(self.mmap):
+                print('*** TRUNCATED RDEF RECORD AT BYTE {} OF {}, IGNORED'.format(position, filename))
+                break
+            offsets.append(position)
+            position += record_length
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.headers = self.mmap[self.offsets[:, None] + np.arange(RDEF_HEADER.size)].view(RDEF_HEADER_DTYPE)[:, 0]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def payload(self, k):
+        """Packed samples of record k, a uint8 view of the file."""
+        start = int(self.offsets[k]) + RDEF_HEADER.size
+        return self.mmap[start:int(self.offsets[k]) + int(self.headers['RECORD_LENGTH'][k])]
+
+    def iq(self, k):
+        """Interleaved I/Q codes of record k (see unpack_data)."""
+        header = self.headers[k]
+        return unpack_data(self.payload(k), int(header['SAMPLE_SIZE']), 2 * int(header['SAMPLE_RATE']))
+
+    def samples(self, k, out=None):
+        """Complex samples of record k, at the mid-rise levels (code + 0.5) of quantize_data."""
+        iq_pairs = self.iq(k)
+        out = np.empty(len(iq_pairs) // 2, dtype=np.complex64) if out is None else out[:len(iq_pairs) // 2]
+        np.add(iq_pairs, np.float32(0.5), out=out.view(np.float32))
+        return out
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self.headers[k], self.samples(k)
@@ -43,6 +43,10 @@ mkdir -p "${AUX_DIR}"
 
 # Iterate over each file in the provided directory
 for FILE in "${FILE_PATH}"/*; do
+    # Skip index caches written by vdif2rdef.py next to the VDIF files
+    if [[ "${FILE}" == *.vdifidx ]]; then
+        continue
+    fi
     # Only process if it's a regular file (skip directories)
     if [ -f "$FILE" ]; then
         # Extract the filename without extension to use as sidefile base name
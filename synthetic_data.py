@@ -0,0 +1,150 @@
+#!/bin/python3
+
+import numpy as np
+import argparse
+import struct
+import sys
+from rdef_utilities import *
+
+def synth_quantize(x, bit_sample):
+    # VDIF codes (offset binary, see vdif_decode_lut) of Gaussian samples of unit sigma: 2-bit thresholds at 0 and +-1 sigma
+    codes = np.floor(x * 2.0 ** (bit_sample - 2) + 2 ** (bit_sample - 1))
+    return np.clip(codes, 0, 2 ** bit_sample - 1).astype(np.uint8)
+
+def synth_pack(codes, bit_sample):
+    # Bytes of a flat array of codes, first sample in the least significant bits
+    if bit_sample == 8:
+        return codes
+    samples_per_byte = 8 // bit_sample
+    codes = codes.reshape(-1, samples_per_byte)
+    packed = codes[:, 0].copy()
+    for k in range(1, samples_per_byte):
+        packed |= codes[:, k] << (k * bit_sample)
+    return packed
+
+def synth_signal(rng, n_samples, n_values, sample_rate, first_sample, tones=(), complex_data=False):
+    # (n_samples, n_values) unit Gaussian noise plus tones (frequency Hz, amplitude, phase rad) in every value column
+    x = rng.standard_normal((n_samples, n_values), dtype=np.float32)
+    if tones:
+        n = np.arange(first_sample, first_sample + n_samples, dtype=np.float64)
+        for frequency, amplitude, phase in tones:
+            arg = 2 * np.pi * frequency * n / sample_rate + phase
+            if complex_data:  # I and Q of each channel are consecutive values
+                x[:, 0::2] += (amplitude * np.cos(arg)).astype(np.float32)[:, None]
+                x[:, 1::2] += (amplitude * np.sin(arg)).astype(np.float32)[:, None]
+            else:
+                x += (amplitude * np.cos(arg)).astype(np.float32)[:, None]
+    return x
+
+def synth_vdif_file(filename, seconds=2, nchann=8, bit_sample=2, frames_per_sec=20, payload_bytes=8000, threads=1,
+                    legacy=False, complex_data=False, start_second=1000, reference_epoch=40, station='Wa',
+                    tones=(), drop=0.0, invalid=0.0, lead_frames=0, seed=0):
+    """Write a deterministic synthetic VDIF file and return a description of it.
+
+    Gaussian noise (plus tones, (frequency Hz, amplitude in sigma, phase rad)) quantized to bit_sample bits,
+    nchann channels in each of threads threads, frames_per_sec time steps a second. The file starts with
+    lead_frames frames of the second before start_second; drop and invalid are the fractions of frames left
+    out and flagged invalid. 32-byte headers, or 16-byte legacy ones."""
+    if bit_sample not in (1, 2, 4, 8):
+        print('*** SYNTHETIC VDIF IMPOSSIBLE, WRONG BITS PER SAMPLE: ', bit_sample)
+        sys.exit()
+    rng = np.random.default_rng(seed)
+    header_size = 16 if legacy else 32
+    frame_len = header_size + payload_bytes
+    if frame_len % 8:
+        print('*** SYNTHETIC VDIF IMPOSSIBLE, FRAME LENGTH NOT A MULTIPLE OF 8 BYTES: ', frame_len)
+        sys.exit()
+    n_values = nchann * (2 if complex_data else 1)
+    samples_per_frame = payload_bytes * 8 // bit_sample // n_values
+    sample_rate = samples_per_frame * frames_per_sec
+    word2 = frame_len // 8 | int(np.log2(nchann)) << 24
+    n_frames = n_dropped = n_invalid = 0
+
+    with open(filename, 'wb') as f:
+        for second in range(-1 if lead_frames else 0, seconds):
+            first_step = frames_per_sec - lead_frames if second < 0 else 0
+            n_steps = frames_per_sec - first_step
+            # Codes of all the threads of this second: (steps, threads, data field bytes)
+            x = synth_signal(rng, n_steps * samples_per_frame, n_values * threads, sample_rate,
+                             (second * frames_per_sec + first_step) * samples_per_frame, tones, complex_data)
+            x = x.reshape(n_steps, samples_per_frame, threads, n_values).transpose(0, 2, 1, 3)
+            payloads = synth_pack(synth_quantize(x, bit_sample).reshape(-1), bit_sample).reshape(n_steps, threads, payload_bytes)
+            for step in range(n_steps):
+                for thread in range(threads):
+                    if drop and rng.random() < drop:
+                        n_dropped += 1
+                        continue
+                    flagged = bool(invalid) and rng.random() < invalid
+                    n_invalid += flagged
+                    word0 = (start_second + second) | int(legacy) << 30 | int(flagged) << 31
+                    word1 = (first_step + step) | reference_epoch << 24
+                    word3 = ord(station[0]) | ord(station[1]) << 8 | thread << 16 | (bit_sample - 1) << 26 | int(complex_data) << 31
+                    f.write(struct.pack('<4I', word0, word1, word2, word3))
+                    if not legacy:
+                        f.write(bytes(16))
+                    f.write(payloads[step, thread].tobytes())
+                    n_frames += 1
+
+    return {'filename': filename, 'seconds': seconds, 'nchann': nchann, 'threads': threads, 'bit_sample': bit_sample,
+            'complex_data': complex_data, 'legacy': legacy, 'frame_len': frame_len, 'frames_per_sec': frames_per_sec * threads,
+            'sample_rate': sample_rate, 'frames': n_frames, 'dropped': n_dropped, 'invalid': n_invalid}
+
+def synth_aux_file(filename, n_channels, carrier_frequency=8000e6, channel_spacing=1e6, dor_tones_offset=(0.0, -5e6, 5e6, 0.0)):
+    """Write a sidefile, as sidefile_creator.sh does, for a synthetic VDIF file of n_channels channels."""
+    frequencies = ','.join(f'{carrier_frequency + k * channel_spacing:.2f}' for k in range(n_channels))
+    offsets = ','.join(f'{offset:.2f}' for offset in dor_tones_offset)
+    with open(filename, 'w') as f:
+        f.write(f"SPACECRAFT_ID         = 'SYNT'\n"
+                f"EGRS_ID               = 'S0000'\n"
+                f"RECORDING_NUMBER      = '001'\n"
+                f"TRANSMITTER_TYPE      = 'S'\n"
+                f"STATION_ID            = 'Wa'\n"
+                f"RECEIVER_N            = '00'\n"
+                f"PRD_NAME              = 'SYNTn001tSsWar00'\n"
+                f"NUMBER_CHANNELS       = {n_channels}\n"
+                f"CHANNELS_FREQUENCY    = [ {frequencies} ]\n"
+                f"VLBI_FREQUENCY_OFFSET = 1000000.00\n"
+                f"CARRIER_FREQUENCY     = {carrier_frequency:.2f}\n"
+                f"DOR_TONES_OFFSET      = [ {offsets} ]\n")
+
+def synth_rdef_file(filename, seconds=2, sample_rate=80000, sample_size=16, tones=(), start_sod=0, seed=0):
+    """Write a deterministic synthetic RDEF file: complex Gaussian noise (plus tones) requantized as vdif2rdef does."""
+    rng = np.random.default_rng(seed)
+    writer = RdefWriter()
+    writer.open(0, filename)
+    for second in range(seconds):
+        x = synth_signal(rng, sample_rate, 2, sample_rate, second * sample_rate, tones, complex_data=True)
+        transformed_data = (x / 3).view(np.complex64)[:, 0]  # about the scale of the analytic signal of 2-bit samples
+        packed_data = quantize_data(transformed_data, sample_size, 2)
+        writer.write_record(0, None, 2000, 1, start_sod + second, sample_rate, 8000e6, 0.0, packed_data, sample_size)
+    writer.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write deterministic synthetic VDIF (and sidefile) or RDEF files.')
+    parser.add_argument('kind', choices=('vdif', 'rdef'), help='Kind of file to write.')
+    parser.add_argument('filename', help='Name of the file to write (the VDIF sidefile gets .aux appended).')
+    parser.add_argument('-seconds', type=int, default=2, help='Whole seconds of data.')
+    parser.add_argument('-nchann', type=int, default=8, help='VDIF channels of each thread.')
+    parser.add_argument('-bits', type=int, default=2, help='Bits of each VDIF sample, or of each RDEF I and Q sample.')
+    parser.add_argument('-fps', type=int, default=20, help='VDIF frames per second of each thread.')
+    parser.add_argument('-payload', type=int, default=8000, help='Bytes of the data field of each VDIF frame.')
+    parser.add_argument('-threads', type=int, default=1, help='VDIF threads.')
+    parser.add_argument('-legacy', action='store_true', help='16-byte legacy VDIF headers.')
+    parser.add_argument('-complex', action='store_true', help='Complex VDIF samples.')
+    parser.add_argument('-drop', type=float, default=0.0, help='Fraction of VDIF frames left out.')
+    parser.add_argument('-invalid', type=float, default=0.0, help='Fraction of VDIF frames flagged invalid.')
+    parser.add_argument('-lead-frames', type=int, default=3, help='VDIF frames of the partial second before the first whole one.')
+    parser.add_argument('-tone', type=float, nargs=3, action='append', default=[], metavar=('FREQUENCY', 'AMPLITUDE', 'PHASE'),
+                        help='Tone to add (Hz, sigma, rad); may be repeated.')
+    parser.add_argument('-sample_rate', type=int, default=80000, help='RDEF samples per second.')
+    parser.add_argument('-seed', type=int, default=0, help='Seed of the random generator.')
+    args = parser.parse_args()
+
+    if args.kind == 'vdif':
+        info = synth_vdif_file(args.filename, args.seconds, args.nchann, args.bits, args.fps, args.payload, args.threads,
+                               args.legacy, args.complex, tones=args.tone, drop=args.drop, invalid=args.invalid,
+                               lead_frames=args.lead_frames, seed=args.seed)
+        synth_aux_file(args.filename + '.aux', args.nchann * args.threads)
+        print(info)
+    else:
+        synth_rdef_file(args.filename, args.seconds, args.sample_rate, args.bits, args.tone, seed=args.seed)
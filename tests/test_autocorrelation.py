@@ -0,0 +1,37 @@
+import os
+import sys
+
+import numpy as np
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from auto_correlation_rdef import AutocorrelationAccumulator
+from rdef_utilities import RdefReader
+from synthetic_data import synth_rdef_file
+
+def test_autocorrelation_carries_segments_across_records(tmp_path):
+    filename = str(tmp_path / 'synthetic.prd')
+    synth_rdef_file(filename, seconds=3, sample_rate=10000, tones=((1234.0, 0.5, 0.3),))
+    records = [samples.copy() for header, samples in RdefReader(filename)]
+    fft_size = 768  # not a divisor of the record length: segments straddle the records
+
+    # Reference: all the samples at once, cut into whole segments
+    samples = np.concatenate(records)
+    n_segments = len(samples) // fft_size
+    spectra = np.fft.fft(samples[:n_segments * fft_size].reshape(n_segments, fft_size).astype(np.complex128), axis=1)
+    spectra[:, 0] = 0
+    expected = np.fft.ifft((np.abs(spectra) ** 2).mean(axis=0)).real
+    expected /= expected[0]
+
+    # Record by record, and in uneven pieces smaller than a segment, with small FFT batches
+    by_record = AutocorrelationAccumulator(fft_size, workers=1, batch_segments=4)
+    for record in records:
+        by_record.update(record)
+    by_piece = AutocorrelationAccumulator(fft_size, workers=1)
+    cuts = np.cumsum(np.random.default_rng(0).integers(1, fft_size, len(samples) // 100))
+    for piece in np.split(samples, cuts[cuts < len(samples)]):
+        by_piece.update(piece)
+    for accumulator in (by_record, by_piece):
+        assert accumulator.n_segments == n_segments
+        np.testing.assert_allclose(accumulator.autocorrelation(), expected, atol=1e-5)
@@ -0,0 +1,48 @@
+import json
+import os
+import subprocess
+import sys
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from synthetic_data import synth_aux_file, synth_vdif_file
+
+def batch(tmp_path, *options):
+    # Output of the batch command line on tmp_path/data, writing to tmp_path/out
+    result = subprocess.run([sys.executable, os.path.join(REPO, 'vdif2rdef.py'), 'batch', str(tmp_path / 'data'),
+                             '-outdir', str(tmp_path / 'out'), '-jobs', '1', '-maxseconds', '1', '-nocache', *options],
+                            check=True, capture_output=True, text=True)
+    return result.stdout
+
+def test_batch_resumes_from_the_manifest(tmp_path):
+    (tmp_path / 'data' / 'aux_files').mkdir(parents=True)
+    names = ('a.vdif', 'b.vdif', 'c.vdif')
+    for k, name in enumerate(names):
+        # Other start seconds, so that the RDEF files of the files have other names
+        synth_vdif_file(tmp_path / 'data' / name, seconds=2, nchann=4, start_second=1000 * (k + 1), seed=k)
+        synth_aux_file(tmp_path / 'data' / 'aux_files' / f'{name}.aux', 4)
+    manifest_path = tmp_path / 'out' / 'vdif2rdef_manifest.json'
+    assert 'Files to process: 3' in batch(tmp_path)
+    manifest = json.loads(manifest_path.read_text())
+    assert sorted(manifest['jobs']) == list(names)
+    assert all(job['status'] == 'done' and len(job['outputs']) == 4 for job in manifest['jobs'].values())
+    outputs = {name: manifest['jobs'][name]['outputs'] for name in names}
+    mtimes = {path: os.stat(path).st_mtime_ns for path in outputs['a.vdif']}
+
+    # Interrupted run: b was still being converted, an output of c has been removed since
+    manifest['jobs']['b.vdif'] = {'status': 'pending'}
+    manifest_path.write_text(json.dumps(manifest))
+    for path in outputs['b.vdif'][1:]:
+        os.remove(path)
+    os.remove(outputs['c.vdif'][0])
+    stdout = batch(tmp_path)
+    assert 'Files to process: 2' in stdout and stdout.count('Skipping') == 1
+    assert f'Skipping {tmp_path / "data" / "a.vdif"}' in stdout
+    manifest = json.loads(manifest_path.read_text())
+    assert {name: job['outputs'] for name, job in manifest['jobs'].items()} == outputs
+    assert all(os.path.exists(path) for paths in outputs.values() for path in paths)
+    assert {path: os.stat(path).st_mtime_ns for path in outputs['a.vdif']} == mtimes
+
+    # Other options: a new batch of all the files
+    assert 'Files to process: 3' in batch(tmp_path, '-rdef-bits', '8')
@@ -0,0 +1,80 @@
+import os
+import struct
+import subprocess
+import sys
+
+import numpy as np
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from rdef_utilities import RdefReader
+from synthetic_data import synth_aux_file, synth_vdif_file
+
+def write_vdif(filename, seconds=3, nchann=4, frames_per_sec=20, payload_bytes=8000, seed=0):
+    # 2-bit real samples of random codes behind 32-byte headers, one thread
+    rng = np.random.default_rng(seed)
+    word2 = (32 + payload_bytes) // 8 | int(np.log2(nchann)) << 24
+    word3 = ord('W') | ord('a') << 8 | 1 << 26
+    with open(filename, 'wb') as f:
+        for second in range(seconds):
+            for frame in range(frames_per_sec):
+                f.write(struct.pack('<4I', 1000 + second, frame | 40 << 24, word2, word3) + bytes(16))
+                f.write(rng.integers(0, 256, payload_bytes, dtype=np.uint8).tobytes())
+
+def write_aux(filename, nchann):
+    frequencies = ','.join(f'{8000e6 + k * 1e6:.2f}' for k in range(nchann))
+    with open(filename, 'w') as f:
+        f.write(f"PRD_NAME              = 'Testn001tSsWar00'\n"
+                f"NUMBER_CHANNELS       = {nchann}\n"
+                f"CHANNELS_FREQUENCY    = [ {frequencies} ]\n"
+                f"CARRIER_FREQUENCY     = 8000000000.00\n")
+
+def convert(tmp_path, name, *options, vdif='test.vdif', auxfile='test.aux', n_channels=4):
+    # {RDEF file name: bytes} of a conversion of a test file with the given options
+    outdir = tmp_path / name
+    outdir.mkdir()
+    channels = [str(k + 1) for k in range(n_channels)]
+    subprocess.run([sys.executable, os.path.join(REPO, 'vdif2rdef.py'), str(tmp_path / vdif),
+                    '-auxfile', str(tmp_path / auxfile), '-maxseconds', '3', '-channels', *channels, '-nocache', *options],
+                   cwd=outdir, check=True, capture_output=True)
+    return {path.name: path.read_bytes() for path in outdir.glob('*.prd')}
+
+def test_max_memory_matches_serial(tmp_path):
+    write_vdif(tmp_path / 'test.vdif')
+    write_aux(tmp_path / 'test.aux', 4)
+    serial = convert(tmp_path, 'serial')
+    assert len(serial) == 4 and all(len(data) > 0 for data in serial.values())
+    for rdef_bits in ('16', '4'):
+        assert convert(tmp_path, f'streaming_{rdef_bits}', '-max-memory', '0.5', '-rdef-bits', rdef_bits) == \
+            convert(tmp_path, f'serial_{rdef_bits}', '-rdef-bits', rdef_bits)
+
+def test_modes_match_serial(tmp_path):
+    # Two threads, missing frames and a partial second before the first whole one
+    synth_vdif_file(tmp_path / 'synthetic.vdif', seconds=4, nchann=4, threads=2, drop=0.05, lead_frames=3, seed=1)
+    synth_aux_file(tmp_path / 'synthetic.aux', 8)
+    files = {'vdif': 'synthetic.vdif', 'auxfile': 'synthetic.aux', 'n_channels': 8}
+    serial = convert(tmp_path, 'serial', **files)
+    assert len(serial) == 8 and all(len(data) > 0 for data in serial.values())
+    assert convert(tmp_path, 'workers', '-workers', '2', **files) == serial
+    assert convert(tmp_path, 'max_memory', '-max-memory', '0.5', **files) == serial
+    cache = str(tmp_path / 'cache')
+    assert convert(tmp_path, 'cache_store', '-sample-cache', cache, **files) == serial
+    assert os.listdir(cache)
+    assert convert(tmp_path, 'cache_load', '-sample-cache', cache, **files) == serial
+
+def test_utc_window(tmp_path):
+    # Seconds 1000 to 1005 of 2020/001, after a partial second
+    synth_vdif_file(tmp_path / 'synthetic.vdif', seconds=6, nchann=4, lead_frames=3, start_second=1000, reference_epoch=40)
+    synth_aux_file(tmp_path / 'synthetic.aux', 4)
+    files = {'vdif': 'synthetic.vdif', 'auxfile': 'synthetic.aux'}
+    # Rounded out to whole seconds: 1001 to 1003, as skipping one second
+    window = convert(tmp_path, 'window', '-start', '2020/001/1001.5', '-stop', '2020/001/1003.2', **files)
+    assert window == convert(tmp_path, 'skip', '-skip', '1', **files)
+    assert convert(tmp_path, 'iso', '-start', '2020-01-01T00:16:41', '-stop', '2020-01-01T00:16:44', **files) == window
+    records = RdefReader(str(tmp_path / 'window' / sorted(window)[0])).headers
+    assert records['TIMETAG_SECOND_OF_DAY'].tolist() == [1001, 1002, 1003]
+    # A window starting before the file starts with its first whole second, one after it has no data
+    before = convert(tmp_path, 'before', '-start', '2020/001/0', '-stop', '2020/001/1002', **files)
+    assert RdefReader(str(tmp_path / 'before' / sorted(before)[0])).headers['TIMETAG_SECOND_OF_DAY'].tolist() == [1000, 1001]
+    assert convert(tmp_path, 'after', '-start', '2020/001/2000', **files) == {}
@@ -0,0 +1,37 @@
+import os
+import sys
+
+import numpy as np
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from synthetic_data import synth_vdif_file
+from vdif_utilities import VdifIndex, vdif_index_cache_path
+
+def test_index_cache_reused_until_the_file_changes(tmp_path):
+    filename = str(tmp_path / 'synthetic.vdif')
+    synth_vdif_file(filename, seconds=3, lead_frames=3)
+    index = VdifIndex(filename, cache=True)
+    first_second, frames_in_sec, headers = index.first_second, index.frames_in_sec(), index.headers
+    index.save_cache()
+    assert os.path.exists(vdif_index_cache_path(filename))
+
+    # Same size and mtime: reused
+    reused = VdifIndex(filename, cache=True)
+    assert reused.load_cache()
+    assert (reused.first_second, reused.frames_in_sec()) == (first_second, frames_in_sec) == (3, 20)
+    np.testing.assert_array_equal(reused.headers, headers)
+
+    # Other size: rebuilt from the new headers
+    synth_vdif_file(filename, seconds=2, lead_frames=5)
+    rebuilt = VdifIndex(filename, cache=True)
+    assert not rebuilt.load_cache()
+    assert rebuilt.first_second == 5 and len(rebuilt.headers) == 45
+    rebuilt.save_cache()
+    assert VdifIndex(filename, cache=True).load_cache()
+
+    # Same size, other mtime: rebuilt
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert not VdifIndex(filename, cache=True).load_cache()
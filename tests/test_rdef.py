@@ -0,0 +1,38 @@
+import os
+import sys
+
+import numpy as np
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from rdef_utilities import RDEF_HEADER, RDEF_SAMPLE_SIZES, RdefReader, RdefWriter, quantize_data, rdef_record_bytes
+
+def test_rdef_reader_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    sample_rate = 1000
+    for sample_size in RDEF_SAMPLE_SIZES:
+        filename = str(tmp_path / f'{sample_size}bit.prd')
+        # Interleaved I/Q codes over the whole range of the sample size, written at their mid-rise levels
+        codes = rng.integers(-2 ** (sample_size - 1), 2 ** (sample_size - 1), (3, 2 * sample_rate))
+        writer = RdefWriter()
+        writer.open(0, filename)
+        for k in range(3):
+            transformed_data = ((codes[k] + 0.5) / 2.0 ** (sample_size - 3)).astype(np.float32).view(np.complex64)
+            writer.write_record(0, None, 2020, 1, 1000 + k, sample_rate, 8000e6, 1e6, quantize_data(transformed_data, sample_size, 2), sample_size, k % 2)
+        writer.close()
+        # The start of a record cut short at the end of the file is ignored
+        with open(filename, 'rb') as f:
+            partial = f.read(RDEF_HEADER.size + 10)
+        with open(filename, 'ab') as f:
+            f.write(partial)
+
+        reader = RdefReader(filename)
+        assert len(reader) == 3
+        assert reader.headers['TIMETAG_SECOND_OF_DAY'].tolist() == [1000, 1001, 1002]
+        assert reader.headers['VALIDITY_FLAG'].tolist() == [0, 1, 0]
+        assert (reader.headers['SAMPLE_SIZE'] == sample_size).all() and (reader.headers['SAMPLE_RATE'] == sample_rate).all()
+        assert (reader.headers['RECORD_LENGTH'] == RDEF_HEADER.size + rdef_record_bytes(sample_rate, sample_size)).all()
+        for k, (header, samples) in enumerate(reader):
+            np.testing.assert_array_equal(reader.iq(k), codes[k])
+            np.testing.assert_array_equal(samples.view(np.float32), codes[k] + 0.5)
@@ -0,0 +1,43 @@
+import math
+import os
+import sys
+
+import numpy as np
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from dor_tones import dor_tone_plan, extract_tones
+from synthetic_data import synth_aux_file, synth_vdif_file
+from vdif2rdef import load_aux_file
+from vdif_utilities import VdifReader
+
+def test_tone_phase_and_amplitude_of_an_injected_tone(tmp_path):
+    frequency, amplitude, phase = 5000.0, 1.0, 0.7
+    auxfile = str(tmp_path / 'synthetic.aux')
+    # Tone 5 kHz above the first channel: out of the band of the others
+    synth_aux_file(auxfile, 4, dor_tones_offset=(frequency,))
+    aux = load_aux_file(auxfile)
+    for complex_data in (False, True):
+        filename = str(tmp_path / f'synthetic_{complex_data}.vdif')
+        info = synth_vdif_file(filename, seconds=2, nchann=4, bit_sample=8, complex_data=complex_data,
+                               tones=((frequency, amplitude, phase),))
+        sample_rate = info['sample_rate']
+        plan = dor_tone_plan(aux, range(4), sample_rate, complex_data)
+        assert list(plan) == [0] and plan[0].tolist() == [frequency]
+
+        reader = VdifReader(filename)
+        outname = str(tmp_path / f'tones_{complex_data}')
+        names = extract_tones(reader.seconds(channels=[0]), reader.FRAME_HEADER, aux, plan, sample_rate, 0.5, {0: outname})
+        assert names == [f'{outname}_tones.txt']
+        lines = np.loadtxt(names[0], ndmin=2)
+        # 2 seconds of 0.5 s integrations, from the start of the first second, none with missing frames
+        assert len(lines) == 4
+        np.testing.assert_allclose(lines[:, 0] - lines[0, 0], [0, 0.5, 1, 1.5])
+        assert (lines[:, 1] == aux['CHANNELS_FREQUENCY'][0] + frequency).all()
+        assert (lines[:, 4] == 0).all()
+        # 8-bit codes are 128 decoded levels a sigma, clipped at 2 sigma: the tone keeps the fraction of the
+        # samples not clipped; the noise averages down to about 2 %
+        gain = 128 * math.erf(2 / math.sqrt(2 * (1 + amplitude ** 2 / 2)))
+        np.testing.assert_allclose(lines[:, 2], gain * amplitude, rtol=0.06)
+        np.testing.assert_allclose(lines[:, 3], phase, atol=0.08)
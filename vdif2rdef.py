@@ -1,30 +1,528 @@
 #!/bin/python3
 
 import numpy as np
-import struct
 import argparse
-from time import time
-from scipy.signal import hilbert, welch
+import json
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import scipy.fft as sp_fft
+from scipy.signal import get_window
 from vdif_utilities import *
+from rdef_utilities import *
+from vdif_live import *
+from dor_tones import *
+from metrics import METRICS, add_metrics_arguments, metrics_config, run_profiler
 
-def process_chunk(data_chunk):
-    """Apply Hilbert transform to the data chunk."""
-    return hilbert(data_chunk)
+_ANALYTIC_RESPONSE = {}
 
-def calculate_psd(transformed_data, fs, nperseg=1024):
-    """Calculate the Power Spectral Density (PSD) using the Welch method."""
-    freqs, psd = welch(transformed_data, fs=fs, nperseg=nperseg, return_onesided=False)
-    return psd
+def analytic_filter_response(nfft, ntaps):
+    """Spectrum, on nfft points, of an ntaps Kaiser-windowed FIR filter turning a real signal into its analytic signal."""
+    if (nfft, ntaps) not in _ANALYTIC_RESPONSE:
+        delay = ntaps // 2
+        m = np.arange(-delay, delay + 1)
+        taps = np.zeros(ntaps, dtype=np.complex128)
+        taps[delay] = 1.0
+        odd = m % 2 == 1
+        taps[odd] = 2j / (np.pi * m[odd])  # ideal Hilbert transformer, on the imaginary part
+        taps.imag *= np.kaiser(ntaps, 8.0)
+        _ANALYTIC_RESPONSE[nfft, ntaps] = sp_fft.fft(taps, nfft).astype(np.complex64)
+    return _ANALYTIC_RESPONSE[nfft, ntaps]
 
-def extract_samples(f, frames_in_sec, skip):
+class AnalyticSignal:
+    """Streaming analytic signal of one channel, by overlap-save FFT filtering.
+
+    Output sample n depends only on input samples n - ntaps // 2 to n + ntaps // 2 (zero before the
+    first and after the last sample), and the overlap-save blocks always start at multiples of step
+    from the first sample. The output is therefore the same whatever the sizes of the pieces pushed:
+    there are no seams at block or second boundaries, and any range of it can be recomputed alone."""
+
+    def __init__(self, nfft=2**16, ntaps=1023, workers=-1, batch_blocks=16):
+        self.nfft = nfft
+        self.ntaps = ntaps
+        self.delay = ntaps // 2
+        self.step = nfft - (ntaps - 1)  # output samples per block
+        self.workers = workers
+        self.batch_blocks = batch_blocks
+        self.response = analytic_filter_response(nfft, ntaps)
+        # Input not yet consumed by a block, starting with the zeros before the first sample
+        self._pending = np.zeros(self.delay, dtype=np.float32)
+        self._pushed = 0
+        self._emitted = 0
+
+    def blocks(self, inputs, n_blocks, out=None):
+        """Analytic signal of n_blocks overlap-save blocks of inputs, which must start at a block boundary."""
+        out = np.empty(n_blocks * self.step, dtype=np.complex64) if out is None else out[:n_blocks * self.step]
+        if n_blocks == 0:
+            return out
+        windows = np.lib.stride_tricks.sliding_window_view(inputs, self.nfft)[::self.step]
+        for first in range(0, n_blocks, self.batch_blocks):
+            last = min(first + self.batch_blocks, n_blocks)
+            spectrum = sp_fft.fft(windows[first:last], axis=1, workers=self.workers)
+            spectrum *= self.response
+            filtered = sp_fft.ifft(spectrum, axis=1, overwrite_x=True, workers=self.workers)
+            out[first * self.step:last * self.step] = filtered[:, self.ntaps - 1:].reshape(-1)
+        return out
+
+    def _consume(self, inputs, n_blocks, out):
+        transformed_data = self.blocks(inputs, n_blocks, out)
+        self._pending = inputs[n_blocks * self.step:].copy()
+        self._emitted += len(transformed_data)
+        return transformed_data
+
+    def push(self, channel_sample, out=None):
+        """Feed the next samples, return the analytic signal of the samples whose output is complete.
+
+        out, if given, needs room for len(channel_sample) + step samples."""
+        if np.iscomplexobj(channel_sample):  # complex VDIF samples are already analytic
+            transformed_data = np.asarray(channel_sample, dtype=np.complex64)
+            return transformed_data if transformed_data.flags.writeable else transformed_data.copy()
+        inputs = np.concatenate((self._pending, np.asarray(channel_sample, dtype=np.float32)))
+        self._pushed += len(channel_sample)
+        n_blocks = max(len(inputs) - (self.ntaps - 1), 0) // self.step
+        return self._consume(inputs, n_blocks, out)
+
+    def flush(self, out=None):
+        """Return the analytic signal of the samples still pending, as if zeros followed them."""
+        remaining = self._pushed - self._emitted
+        n_blocks = -(-remaining // self.step)
+        inputs = np.zeros(n_blocks * self.step + self.ntaps - 1, dtype=np.float32)
+        inputs[:len(self._pending)] = self._pending
+        return self._consume(inputs, n_blocks, out)[:remaining]
+
+class WelchAccumulator:
+    """Running two-sided Welch PSD of the analytic signal of one channel.
+
+    Hann-windowed segments of nperseg samples with 50% overlap, mean removed and density scaling,
+    as scipy.signal.welch. Segments start at multiples of nperseg // 2 from the first sample, and
+    each one is added to the running sum as soon as its samples have all been seen."""
+
+    def __init__(self, fs, nperseg=1024, batch_segments=4096, workers=-1):
+        self.fs = fs
+        self.nperseg = nperseg
+        self.hop = nperseg // 2
+        self.batch_segments = batch_segments
+        self.workers = workers
+        self.window = get_window('hann', nperseg).astype(np.float32)
+        self.psd_sum = np.zeros(nperseg)
+        self.n_segments = 0
+        self._tail = np.empty(0, dtype=np.complex64)
+
+    def segments_sum(self, transformed_data, n_segments):
+        """Sum of the periodograms of the first n_segments segments of transformed_data."""
+        psd_sum = np.zeros(self.nperseg)
+        if n_segments == 0:
+            return psd_sum
+        segments = np.lib.stride_tricks.sliding_window_view(transformed_data, self.nperseg)[::self.hop]
+        for first in range(0, n_segments, self.batch_segments):
+            batch = segments[first:min(first + self.batch_segments, n_segments)]
+            batch = (batch - batch.mean(axis=1, keepdims=True)) * self.window
+            psd_sum += (np.abs(sp_fft.fft(batch, axis=1, workers=self.workers)) ** 2).sum(axis=0)
+        return psd_sum
+
+    def update(self, transformed_data):
+        """Add the segments completed by the next samples of the analytic signal."""
+        data = np.concatenate((self._tail, transformed_data))
+        n_segments = max((len(data) - self.nperseg) // self.hop + 1, 0)
+        self.add(self.segments_sum(data, n_segments), n_segments)
+        self._tail = data[n_segments * self.hop:]
+
+    def add(self, psd_sum, n_segments):
+        """Add periodograms summed elsewhere, e.g. by a worker process."""
+        self.psd_sum += psd_sum
+        self.n_segments += n_segments
+
+    def spectrum(self):
+        """Frequencies (Hz, ascending) and averaged power spectral density."""
+        freqs = sp_fft.fftshift(sp_fft.fftfreq(self.nperseg, d=1 / self.fs))
+        psd = self.psd_sum / (max(self.n_segments, 1) * self.fs * (self.window.astype(np.float64) ** 2).sum())
+        return freqs, sp_fft.fftshift(psd)
+
+def save_psd_to_file(accumulator, outname_prd):
+    """Save the averaged PSD of one channel next to its RDEF file."""
+    output_filename = f"{outname_prd}_psd.txt"
+    print(f"Saving PSD ({accumulator.n_segments} segments) to {output_filename} ...")
+    freqs, psd = accumulator.spectrum()
+    with open(output_filename, "w") as f:
+        for freq, power in zip(freqs, psd):
+            f.write(f"{freq} {power}\n")
+
+def split_records(i, emitted, n_samples, packed_data, total_samples_perchann, sample_size=16):
+    """Split n_samples packed samples of channel i, starting at sample emitted of its stream, at the one-second RDEF records."""
+    position = 0
+    while position < n_samples:
+        relative_sec, first_sample = divmod(emitted + position, total_samples_perchann)
+        n_record = min(total_samples_perchann - first_sample, n_samples - position)
+        first_byte = position * 2 * sample_size // 8
+        yield relative_sec, i, first_sample, packed_data[first_byte:first_byte + rdef_record_bytes(n_record, sample_size)]
+        position += n_record
+
+def streaming_block_frames(FRAME_HEADER, frames_in_sec, n_channels, max_memory, n_buffers=1):
+    """Frames per block of the streaming mode (of all the threads), so that its buffers fit in max_memory bytes.
+
+    n_buffers -> input buffers of a block of frames (those of the read-ahead)."""
+    samples_per_frame = vdif_frame_samples_perchann(FRAME_HEADER)
+    n_threads = len(vdif_frame_threads(FRAME_HEADER))
+    # Per sample of each channel: decoded sample, float32 filter input, complex64 analytic signal, packed I/Q pair
+    bytes_per_sample = n_channels * (2 + 4 + 8 + 4) + n_buffers * n_threads * FRAME_HEADER['data_frame_len_bytes'] / samples_per_frame
+    block_frames = max(int(max_memory / bytes_per_sample) // samples_per_frame, 1) * n_threads
+    return min(block_frames, frames_in_sec)
+
+def read_channels_samples(f, FRAME_HEADER, FRAME_MAP, channels, first_sample, n_samples, total_samples, counts=None):
+    """Samples [first_sample, first_sample + n_samples) of channels of the time steps of FRAME_MAP, zero outside [0, total_samples), as {channel: samples}.
+
+    The frames are read and decoded once for all the channels.
+    counts -> optional dict to which the bytes read, frames and samples decoded are added (METRICS counter names)."""
+    samples_per_frame = vdif_frame_samples_perchann(FRAME_HEADER)
+    start = max(first_sample, 0)
+    stop = min(first_sample + n_samples, total_samples)
+    sample_dtype = np.complex64 if FRAME_HEADER['data_type'] else np.float32
+    channels_sample = {i: np.zeros(n_samples, dtype=sample_dtype) for i in channels}
+    if start < stop:
+        first_step, stop_step = start // samples_per_frame, -(-stop // samples_per_frame)
+        decoded = vdif_read_steps(f, FRAME_HEADER, FRAME_MAP, first_step, stop_step, channels)
+        if counts is not None:
+            for name, value in (('bytes_read', vdif_range_bytes(FRAME_MAP, FRAME_HEADER, first_step, stop_step)),
+                                ('frames', int((vdif_map_rows(FRAME_MAP, first_step, stop_step) >= 0).sum())),
+                                ('samples_decoded', (stop_step - first_step) * samples_per_frame * len(channels))):
+                counts[name] = counts.get(name, 0) + value
+        skip = start - first_step * samples_per_frame
+        for i in channels:
+            channels_sample[i][start - first_sample:stop - first_sample] = decoded[i][skip:skip + stop - start]
+    return channels_sample
+
+def convert_second(filename, FRAME_HEADER, FRAME_MAP, total_samples_perchann, maxseconds, relative_sec, channels, nperseg=None, rdef_bits=16):
+    """Worker: return one second of channels as {channel: packed RDEF samples}, as the serial stream computes them, and {counter: value} of the data read.
+
+    The frames around the second are read and decoded once for all the channels.
+    FRAME_MAP -> the time steps around this second (vdif_frame_map_slice). With nperseg, also return
+    {channel: (sum, number)} of the Welch periodograms of the segments starting in this second."""
+    first_sample = relative_sec * total_samples_perchann
+    total_samples = maxseconds * total_samples_perchann
+    stream = AnalyticSignal(workers=1)
+    first_block = first_sample // stream.step
+    # Only the overlap-save blocks covering this second (and the PSD segments starting in it),
+    # with their overlap into the neighbouring seconds
+    last_sample = first_sample + total_samples_perchann + (nperseg or 0)
+    n_blocks = -(-last_sample // stream.step) - first_block
+    counts = {}
+    with open(filename, "rb") as f:
+        if FRAME_HEADER['data_type']:
+            n_blocks = 0
+            inputs = read_channels_samples(f, FRAME_HEADER, FRAME_MAP, channels, first_block * stream.step, last_sample - first_block * stream.step, total_samples, counts)
+        else:
+            inputs = read_channels_samples(f, FRAME_HEADER, FRAME_MAP, channels, first_block * stream.step - stream.delay,
+                                           n_blocks * stream.step + stream.ntaps - 1, total_samples, counts)
+    skip = first_sample - first_block * stream.step
+    if nperseg is not None:
+        psd = WelchAccumulator(total_samples_perchann, nperseg, workers=1)
+        first_segment = -(-first_sample // psd.hop) * psd.hop
+        end_segment = min(first_sample + total_samples_perchann, total_samples - nperseg + 1)
+        n_segments = max(-(-(end_segment - first_segment) // psd.hop), 0)
+        start = first_segment - first_block * stream.step
+    channels_packed, channels_psd = {}, {}
+    for i in channels:
+        transformed_data = inputs.pop(i) if FRAME_HEADER['data_type'] else stream.blocks(inputs.pop(i), n_blocks)
+        if nperseg is not None:
+            channels_psd[i] = psd.segments_sum(transformed_data[start:], n_segments), n_segments
+        channels_packed[i] = quantize_data(transformed_data[skip:skip + total_samples_perchann], rdef_bits, FRAME_HEADER['bit_sample'])
+    if nperseg is None:
+        return channels_packed, counts
+    return channels_packed, counts, channels_psd
+
+def serial_converted_seconds(f, FRAME_HEADER, mapper, channels_to_extract, total_samples_perchann, psd=None, readahead=2, rdef_bits=16, sample_cache=None, fft_workers=-1, tones=None):
+    """Yield (relative second, channel, first sample, packed samples) reading the file one second at a time.
+
+    mapper -> VdifFrameMapper of the seconds to convert, missing frames decoded as zeros.
+    psd -> optional {channel: WelchAccumulator} fed with the analytic signal.
+    readahead -> buffers filled one second ahead by a background reader (0 to read in this thread).
+    sample_cache -> optional VdifSampleCache of decoded seconds; the file is not read if it holds them all.
+    fft_workers -> threads of the scipy.fft transforms (-1 for all the CPUs).
+    tones -> optional ToneWriter fed with the decoded samples of each second."""
+    steps_in_sec = mapper.steps_in_sec
+    n_seconds = mapper.n_seconds
+    frame_len = FRAME_HEADER['data_frame_len_bytes']
+    file_key = sample_cache.file_key(f.name) if sample_cache is not None else None
+    prefetcher = None
+
+    def second_block(relative_sec):
+        # (file offset, bytes, rows) of the frames of a second, mapped as the file is read
+        FRAME_MAP = mapper.second(relative_sec)
+        steps = (relative_sec * steps_in_sec, (relative_sec + 1) * steps_in_sec)
+        return int(FRAME_MAP['starts'][0]) * frame_len, vdif_range_bytes(FRAME_MAP, FRAME_HEADER, *steps), vdif_map_rows(FRAME_MAP, *steps)
+
+    def read_second(relative_sec):
+        # Frames and rows of a second read in this thread (also when found in the cache but deleted from it since)
+        offset, n_bytes, rows = second_block(relative_sec)
+        f.seek(offset)
+        return f.read(n_bytes), rows
+
+    def cached_seconds():
+        for k in range(n_seconds):
+            mapper.second(k)  # validity of the second, from its headers only
+            yield None, None
+
+    if sample_cache is not None and all(sample_cache.has(file_key, FRAME_HEADER['seconds_from_epoch'] + k, channels_to_extract) for k in range(n_seconds)):
+        seconds_rows = cached_seconds()
+    elif readahead > 0:
+        frames_in_sec = steps_in_sec * len(vdif_frame_threads(FRAME_HEADER))
+        seconds_rows = prefetcher = VdifPrefetcher(f, (second_block(k) for k in range(n_seconds)), readahead, frames_in_sec * frame_len)
+    else:
+        seconds_rows = (read_second(k) for k in range(n_seconds))
+    channels_samples = decoded_seconds(seconds_rows, FRAME_HEADER, channels_to_extract, sample_cache, file_key, read_second)
+    records = RecordStream(FRAME_HEADER, channels_to_extract, total_samples_perchann, psd, rdef_bits, fft_workers, tones, mapper.valid)
+    try:
+        yield from converted_samples(channels_samples, records)
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()  # also when the conversion stops early
+
+def decoded_seconds(seconds, FRAME_HEADER, channels_to_extract, sample_cache=None, file_key=None, read_second=None):
+    """Yield the decoded samples (as vdif_decode_mapped) of consecutive seconds given as (frames, rows).
+
+    With a sample_cache, the seconds it holds for file_key are read from it instead (their frames
+    may then be None), and the others are added to it. read_second(relative second) -> (frames, rows)
+    of a second whose frames are None but which is no longer in the cache (another run evicted it)."""
+    n_channels = vdif_total_channels(FRAME_HEADER)
+    for relative_sec, (buffer, rows) in enumerate(seconds):
+        second = FRAME_HEADER['seconds_from_epoch'] + relative_sec
+        cached = sample_cache.load(file_key, second, channels_to_extract) if sample_cache is not None else None
+        if cached is not None:
+            METRICS.count('seconds_from_cache')
+            yield [cached.get(i) for i in range(n_channels)]
+            continue
+        if buffer is None:
+            buffer, rows = read_second(relative_sec)
+        with METRICS.timer('decode'):
+            channels_sample = vdif_decode_mapped(buffer, rows, FRAME_HEADER, channels_to_extract)
+        METRICS.count('bytes_read', memoryview(buffer).nbytes)
+        METRICS.count('frames', int((rows >= 0).sum()))
+        METRICS.count('samples_decoded', len(rows) * vdif_frame_samples_perchann(FRAME_HEADER) * len(channels_to_extract))
+        METRICS.count('seconds')
+        if sample_cache is not None:
+            sample_cache.store(file_key, second, channels_sample, channels_to_extract)
+        yield channels_sample
+
+class RecordStream:
+    """Analytic signal, PSD, tones and packed RDEF records of the channels of a conversion, fed with decoded samples in time order.
+
+    Every mode (serial, streaming, live) goes through push() and flush(), so that they all compute
+    the records the same way. With block_samples, the analytic signal and packed samples of each
+    push go into buffers reused from one push to the next: its records must be written first.
+
+    psd -> optional {channel: WelchAccumulator}; tones -> optional ToneWriter, with valid[relative second]
+    the validity of each thread of a second (as VdifFrameMapper.valid)."""
+
+    def __init__(self, FRAME_HEADER, channels_to_extract, total_samples_perchann, psd=None, rdef_bits=16, fft_workers=-1,
+                 tones=None, valid=None, block_samples=None):
+        self.FRAME_HEADER = FRAME_HEADER
+        self.channels_to_extract = channels_to_extract
+        self.total_samples_perchann = total_samples_perchann
+        self.psd = psd
+        self.rdef_bits = rdef_bits
+        self.tones = tones
+        self.valid = valid
+        self.streams = {i: AnalyticSignal(workers=fft_workers) for i in channels_to_extract}
+        self.emitted = dict.fromkeys(channels_to_extract, 0)
+        self._transformed = self._packed = None
+        if block_samples is not None:
+            stream = self.streams[channels_to_extract[0]]
+            max_output = block_samples + stream.step + stream.ntaps
+            self._transformed = np.empty(max_output, dtype=np.complex64)
+            self._packed = np.empty(rdef_record_bytes(max_output, rdef_bits), dtype=np.uint8)
+
+    def push(self, channels_sample, relative_sec, first_sample=0, n_samples=None):
+        """Yield (relative second, channel, first sample, packed samples) of the records completed by the next samples.
+
+        channels_sample -> decoded samples (as vdif_decode_mapped) from sample first_sample of a second,
+        of which only the first n_samples are used if given."""
+        if self.tones is not None:
+            with METRICS.timer('tones'):
+                for i in self.tones.plan:
+                    self.tones.add_samples(i, self.FRAME_HEADER['seconds_from_epoch'] + relative_sec, self.valid[relative_sec],
+                                           channels_sample[i][:n_samples], first_sample)
+        for i in self.channels_to_extract:
+            with METRICS.timer('analytic_signal'):
+                transformed_data = self.streams[i].push(channels_sample[i][:n_samples], out=self._transformed)
+            yield from self._records(i, transformed_data)
+
+    def flush(self):
+        """Yield the last records of each channel, whose filter output needed the zeros after the end."""
+        for i in self.channels_to_extract:
+            with METRICS.timer('analytic_signal'):
+                transformed_data = self.streams[i].flush(out=self._transformed)
+            yield from self._records(i, transformed_data)
+
+    def _records(self, i, transformed_data):
+        if self.psd:
+            with METRICS.timer('psd'):
+                self.psd[i].update(transformed_data)
+        n_samples = len(transformed_data)
+        with METRICS.timer('quantize'):
+            packed_data = quantize_data(transformed_data, self.rdef_bits, self.FRAME_HEADER['bit_sample'], out=self._packed)
+        METRICS.count('samples_converted', n_samples)
+        yield from split_records(i, self.emitted[i], n_samples, packed_data, self.total_samples_perchann, self.rdef_bits)
+        self.emitted[i] += n_samples
+
+def converted_samples(channels_samples, records):
+    """Yield (relative second, channel, first sample, packed samples) from the decoded samples of consecutive seconds, through a RecordStream."""
+    for relative_sec, channels_sample in enumerate(channels_samples):
+        yield from records.push(channels_sample, relative_sec)
+    yield from records.flush()
+
+def streaming_converted_seconds(f, FRAME_HEADER, mapper, channels_to_extract, max_memory, psd=None, readahead=2, rdef_bits=16, fft_workers=-1, tones=None):
+    """Yield (relative second, channel, first sample, packed samples) block by block within max_memory bytes.
+
+    All the blocks are decoded, transformed and quantized into the same buffers: each block must be
+    written before the generator is resumed. With readahead > 0, that many block buffers are
+    filled by a background reader; they count in max_memory. The blocks are planned as they are
+    read. tones -> optional ToneWriter fed with the decoded blocks."""
+    samples_per_frame = vdif_frame_samples_perchann(FRAME_HEADER)
+    n_threads = len(vdif_frame_threads(FRAME_HEADER))
+    steps_in_sec = mapper.steps_in_sec
+    maxseconds = mapper.n_seconds
+    total_samples_perchann = steps_in_sec * samples_per_frame
+    frame_len = FRAME_HEADER['data_frame_len_bytes']
+    block_frames = streaming_block_frames(FRAME_HEADER, steps_in_sec * n_threads, len(channels_to_extract), max_memory, max(readahead, 1))
+    block_steps = block_frames // n_threads
+    block_samples = block_steps * samples_per_frame
+    print(f'Streaming blocks of {block_frames} frames ({block_samples} samples per channel)')
+
+    records = RecordStream(FRAME_HEADER, channels_to_extract, total_samples_perchann, psd, rdef_bits, fft_workers, tones, mapper.valid, block_samples)
+
+    def blocks():
+        # (file offset, bytes, (relative second, steps, rows)) of each block, generated (and its second mapped) as the reader advances
+        for relative_sec in range(maxseconds):
+            FRAME_MAP = mapper.second(relative_sec)
+            second_step = relative_sec * steps_in_sec
+            for first_step in range(second_step, second_step + steps_in_sec, block_steps):
+                steps = (first_step, min(first_step + block_steps, second_step + steps_in_sec))
+                yield (int(FRAME_MAP['starts'][first_step - second_step]) * frame_len, vdif_range_bytes(FRAME_MAP, FRAME_HEADER, *steps),
+                       (relative_sec, steps, vdif_map_rows(FRAME_MAP, *steps)))
+
+    prefetcher = None
+    if readahead > 0:
+        blocks_read = prefetcher = VdifPrefetcher(f, blocks(), readahead, block_frames * frame_len)
+    else:
+        raw = bytearray(block_frames * frame_len)
+
+        def read_block(offset, n_bytes, tag):
+            nonlocal raw
+            if len(raw) < n_bytes:
+                raw = bytearray(n_bytes)  # frames out of place
+            f.seek(offset)
+            return memoryview(raw)[:f.readinto(memoryview(raw)[:n_bytes])], tag
+
+        blocks_read = (read_block(*block) for block in blocks())
+
+    sample_dtype = np.complex64 if FRAME_HEADER['data_type'] else vdif_sample_dtype(FRAME_HEADER['bit_sample'])
+    decoded = [None] * vdif_total_channels(FRAME_HEADER)
+    for i in channels_to_extract:
+        decoded[i] = np.empty(block_samples, dtype=sample_dtype)
+
+    try:
+        for block, (relative_sec, steps, rows) in blocks_read:
+            if steps[0] == relative_sec * steps_in_sec:
+                METRICS.count('seconds')
+            n_samples = (steps[1] - steps[0]) * samples_per_frame
+            with METRICS.timer('decode'):
+                vdif_decode_mapped(block, rows, FRAME_HEADER, channels_to_extract, out=decoded)
+            METRICS.count('bytes_read', memoryview(block).nbytes)
+            METRICS.count('frames', int((rows >= 0).sum()))
+            METRICS.count('samples_decoded', n_samples * len(channels_to_extract))
+            yield from records.push(decoded, relative_sec, (steps[0] - relative_sec * steps_in_sec) * samples_per_frame, n_samples)
+        yield from records.flush()
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()  # also when the conversion stops early
+
+def parallel_converted_seconds(filename, FRAME_HEADER, mapper, channels_to_extract, workers, psd=None, rdef_bits=16):
+    """Yield (relative second, channel, first sample, packed samples) in file order, computed by a pool of worker processes.
+
+    mapper -> VdifFrameMapper of the seconds to convert, mapped as they are handed out."""
+    samples_per_frame = vdif_frame_samples_perchann(FRAME_HEADER)
+    steps_in_sec = mapper.steps_in_sec
+    maxseconds = mapper.n_seconds
+    total_samples_perchann = steps_in_sec * samples_per_frame
+    nperseg = next(iter(psd.values())).nperseg if psd else None
+    # Time steps each worker may read around its second: filter blocks, filter delay and PSD segments
+    stream = AnalyticSignal(workers=1)
+    margin_steps = -(-(stream.step + stream.ntaps + (nperseg or 0)) // samples_per_frame) + 1
+    margin_seconds = -(-margin_steps // steps_in_sec)
+    mapper.n_cached = max(mapper.n_cached, 2 * margin_seconds + 2)
+    pending = deque()
+
+    def results(relative_sec, future):
+        METRICS.gauge('pending_seconds', len(pending) + 1)
+        with METRICS.timer('wait_workers'):
+            future_result = future.result()
+        channels_packed, counts = future_result[:2]
+        # What the worker read and decoded, as the serial mode counts it
+        for name, value in counts.items():
+            METRICS.count(name, value)
+        METRICS.count('samples_converted', total_samples_perchann * len(channels_to_extract))
+        METRICS.count('seconds')
+        if psd:
+            for i, (psd_sum, n_segments) in future_result[2].items():
+                psd[i].add(psd_sum, n_segments)
+        for i in channels_to_extract:
+            yield relative_sec, i, 0, channels_packed[i]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for relative_sec in range(maxseconds):
+            # Each worker reads its own byte range of the file, from the maps of the seconds around its own
+            around = mapper.seconds(max(relative_sec - margin_seconds, 0), min(relative_sec + margin_seconds + 1, maxseconds))
+            second_map = vdif_frame_map_slice(around, relative_sec * steps_in_sec - margin_steps, (relative_sec + 1) * steps_in_sec + margin_steps)
+            future = executor.submit(convert_second, filename, FRAME_HEADER, second_map, total_samples_perchann, maxseconds, relative_sec, list(channels_to_extract), nperseg, rdef_bits)
+            pending.append((relative_sec, future))
+            # Bound the seconds waiting to be written, yielding them in submission order
+            if len(pending) >= 2 * workers:
+                yield from results(*pending.popleft())
+        while pending:
+            yield from results(*pending.popleft())
+
+def extract_samples(f, frames_in_sec, skip, index=None):
     """Extract the sample information including timetag and frame structure."""
-    vdif_integ_sec_align(f)
-    vdif_skip_seconds(f, skip)
+    vdif_integ_sec_align(f, index)
+    vdif_seek_seconds(f, frames_in_sec, skip, index)
     year_beg, doy_beg, sod_beg, hh_beg, mm_beg, ss_beg, FRAME = vdif_info_timetag_extractor(f, frames_in_sec)
+    if index is not None:
+        FRAME['HEADER']['threads'] = index.threads
     return year_beg, doy_beg, sod_beg, hh_beg, mm_beg, ss_beg, FRAME
 
-def calculate_total_seconds(f, frame, frames_in_sec):
+def time_window(f, frames_in_sec, start=None, stop=None, index=None):
+    """Seconds to skip and to convert (None without stop) for the UTC window [start, stop), rounded out to whole seconds.
+
+    Returns None if the file holds no data in the window."""
+    vdif_integ_sec_align(f, index)
+    position = f.tell()
+    FRAME_HEADER = vdif_frame_reader(f)['HEADER']
+    f.seek(position)
+    first_second = FRAME_HEADER['seconds_from_epoch']
+    last_second = int(index.last_header()['seconds_from_epoch']) if index is not None else None
+    epoch = FRAME_HEADER['reference_epoch']
+    start_second = first_second if start is None else int(np.floor(vdif_epoch_seconds(epoch, *vdif_parse_utc(start))))
+    stop_second = None if stop is None else int(np.ceil(vdif_epoch_seconds(epoch, *vdif_parse_utc(stop))))
+    if (last_second is not None and start_second > last_second) or (stop_second is not None and stop_second <= max(start_second, first_second)):
+        return None
+    skip = max(start_second - first_second, 0)
+    maxseconds = None if stop_second is None else stop_second - first_second - skip
+    print(f'UTC window: skipping {skip} seconds' + ('' if maxseconds is None else f', converting {maxseconds} seconds'))
+    return skip, maxseconds
+
+def calculate_total_seconds(f, frame, frames_in_sec, index=None):
     """Calculate total seconds available in the VDIF file."""
+    if index is not None:
+        # Timetag of the last frame, so that missing frames do not shorten the count
+        first = f.tell() // index.data_frame_len_bytes
+        if first >= index.n_frames:
+            return 0
+        last = index.last_header()
+        total_integer_seconds = int(last['seconds_from_epoch']) - frame['HEADER']['seconds_from_epoch']
+        if last['data_frame_n'] == frames_in_sec // len(vdif_frame_threads(frame['HEADER'])) - 1:
+            total_integer_seconds += 1  # last second is complete
+        return max(total_integer_seconds, 0)
     file_begin = f.tell()
     f.seek(0, 2)
     file_end = f.tell()
@@ -33,165 +531,363 @@ def calculate_total_seconds(f, frame, frames_in_sec):
     total_integer_seconds = int((total_size // frame['HEADER']['data_frame_len_bytes']) // frames_in_sec)
     return total_integer_seconds
 
-def write_rdef_header(out_f, frame, year_beg, doy_beg, sod_beg, channel, total_samples_perchann, carrier_frequency, channel_frequency_offset):
-    """Write the RDEF header to the output file."""
-    RECORD_LABEL = 'RDEF'
-    RECORD_VERSION_ID = 0
-    STATION_ID = 'Wa'.encode()
-    SPACECRAFT_ID = 0
-    SAMPLE_SIZE = 16  # 16 bits per sample for complex numbers (2 * 8 bits)
-    SAMPLE_RATE = int(total_samples_perchann)
-    VALIDITY_FLAG = 0
-    AGENCY_FLAG = 0
-    RF_TO_IF_DOWNCONV = 0.0
-    IF_TO_CHANNEL_DOWNCONV = float(carrier_frequency)  # Use single carrier frequency here
-    TIMETAG_PICOSECOND = 0.0
-    CHANN_ACCUM_PHASE = 0.0
-    CHANN_PHASE_C0 = 0.0
-    CHANN_PHASE_C1 = float(channel_frequency_offset)
-    CHANN_PHASE_C2 = 0.0
-    CHANN_PHASE_C3 = 0.0
-    END_LABEL = -99999
-
-    RECORD_LENGTH = int(176 + (total_samples_perchann * 4) / 8)  # 4 bits per sample (2 bits real + 2 bits imaginary)
-
-    # Writing header information
-    out_f.write(RECORD_LABEL.encode())
-    out_f.write(struct.pack('<I', RECORD_LENGTH))
-    out_f.write(struct.pack('<H', RECORD_VERSION_ID))
-    out_f.write(STATION_ID.ljust(2, b'\x00'))
-    out_f.write(struct.pack('<H', SPACECRAFT_ID))
-    out_f.write(struct.pack('<H', SAMPLE_SIZE))
-    out_f.write(struct.pack('<I', SAMPLE_RATE))
-    out_f.write(struct.pack('<H', VALIDITY_FLAG))
-    out_f.write(struct.pack('<H', AGENCY_FLAG))
-    out_f.write(struct.pack('<d', RF_TO_IF_DOWNCONV))
-    out_f.write(struct.pack('<d', IF_TO_CHANNEL_DOWNCONV))
-    out_f.write(struct.pack('<H', year_beg))
-    out_f.write(struct.pack('<H', doy_beg))
-    out_f.write(struct.pack('<I', int(sod_beg)))
-    out_f.write(struct.pack('<d', TIMETAG_PICOSECOND))
-    out_f.write(struct.pack('<d', CHANN_ACCUM_PHASE))
-    out_f.write(struct.pack('<d', CHANN_PHASE_C0))
-    out_f.write(struct.pack('<d', CHANN_PHASE_C1))
-    out_f.write(struct.pack('<d', CHANN_PHASE_C2))
-    out_f.write(struct.pack('<d', CHANN_PHASE_C3))
-    out_f.write(struct.pack('<d', 0) * 5)
-    out_f.write(struct.pack('<I', 0) * 9)
-    out_f.write(struct.pack('<i', END_LABEL))  # Write END_LABEL here
-
-def write_interleaved_data(out_f, transformed_data):
-    """Convert complex data to interleaved format and write it to the file."""
-    real_part = (transformed_data.real * 32767).astype(np.int16)
-    imag_part = (transformed_data.imag * 32767).astype(np.int16)
-    interleaved_data = np.empty((len(real_part) + len(imag_part)), dtype=np.int16)
-    interleaved_data[0::2] = real_part
-    interleaved_data[1::2] = imag_part
-    out_f.write(interleaved_data.tobytes())
+def write_records(writer, converted, FRAME_HEADER, frames_in_sec, valid, total_samples_perchann, aux, rdef_bits=16, flush=False):
+    """Write RDEF header and packed data for each channel, in time order.
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument('filenames', nargs='+', help='Name of the file(s) to be processed.')
-    parser.add_argument('-auxfile', type=str, help='Name of the auxiliary side file.')
-    parser.add_argument('-skip', type=int, help='Seconds to skip from the beginning of the file.')
-    parser.add_argument('-maxseconds', type=int, help='Max number of seconds to decode.')
-    parser.add_argument('-channels', nargs='+', type=int, help='Channels to extract (first channel is "1").')
+    Each record has the timetag of its own second, and is flagged invalid if valid[second, thread]
+    is False (frames of that second were missing). With flush, the files are flushed as each
+    second begins, so that the records of the previous second can be read."""
+    current_sec = 0
+    for relative_sec, i, first_sample, packed_data in converted:
+        if flush and relative_sec != current_sec:
+            writer.flush()
+            current_sec = relative_sec
+        METRICS.count('bytes_written', memoryview(packed_data).nbytes)
+        if first_sample == 0:
+            METRICS.count('records')
+            METRICS.count('bytes_written', RDEF_HEADER.size)
+            year_sec, doy_sec, sod_sec = vdif_second_timetag(FRAME_HEADER, FRAME_HEADER['seconds_from_epoch'] + relative_sec, frames_in_sec)[:3]
+            validity_flag = 0 if valid[relative_sec][i // FRAME_HEADER['nchann']] else 1
+            with METRICS.timer('write'):
+                writer.write_record(i, {'HEADER': FRAME_HEADER}, year_sec, doy_sec, sod_sec, total_samples_perchann, aux['CARRIER_FREQUENCY'], aux['CHANNEL_FREQUENCY_OFFSET'][i], packed_data, rdef_bits, validity_flag)
+        else:
+            with METRICS.timer('write'):
+                writer.write(i, packed_data)
 
-    args = parser.parse_args()
+def open_rdef_outputs(FRAME_HEADER, aux, channels, total_samples_perchann, outdir, timetag, source, psd=False, rdef_bits=16, fft_workers=-1):
+    """Check the side file and RDEF sample size against the VDIF data, and create the RDEF files of the channels to convert.
 
-    filenames = args.filenames
-    auxfile = args.auxfile
-    skip = args.skip if args.skip is not None else 0
-    maxseconds = args.maxseconds if args.maxseconds is not None else 1
-    channels = args.channels
+    timetag -> year, day of year, hour, minute and second of the first second, for the file names.
+    source -> the VDIF data, for the messages. Returns the channels to extract, {channel: RDEF file name},
+    the RdefWriter of the files and {channel: WelchAccumulator} of the PSD (None without psd)."""
+    # Check if auxfile has consistent number of channels with respect to vdif data (of all its threads)
+    n_threads = len(vdif_frame_threads(FRAME_HEADER))
+    print(f'Number of channels in {source}: {vdif_total_channels(FRAME_HEADER)} ({n_threads} threads)')
+    if vdif_total_channels(FRAME_HEADER) != aux['NUMBER_CHANNELS']:
+        print(f'*** Error: Number of channels in auxiliary file does not match {source}.')
+        sys.exit()
+    if rdef_bits == 2 and total_samples_perchann % 2:
+        print(f'*** Error: 2-bit RDEF records need an even number of samples per second, not {total_samples_perchann}.')
+        sys.exit()
 
-    print()
-    print('--- vdif2rdef ---')
-    print('Files to process:', filenames)
+    # Channels to extract
+    channels_to_extract = range(vdif_total_channels(FRAME_HEADER)) if channels is None else [(int(k) - 1) for k in channels]
 
-    # Load auxiliary file
+    # Create binary file for each channel, kept open until the end of the data
+    outnames = {i: os.path.join(outdir, rdef_output_name(aux, i, *timetag)) for i in channels_to_extract}
+    writer = RdefWriter()
+    print(f'Creating {len(outnames)} RDEF files in {outdir} ...')
+    for i in channels_to_extract:
+        writer.open(i, outnames[i])
+    accumulators = {i: WelchAccumulator(total_samples_perchann, workers=fft_workers) for i in channels_to_extract} if psd else None
+    return channels_to_extract, outnames, writer, accumulators
+
+def convert_live(source, aux, maxseconds=None, channels=None, outdir='.', psd=False, rdef_bits=16, latency=1, idle_timeout=30.0, max_gap=10):
+    """Convert a live VDIF source, a growing file or udp://host:port, second by second as its frames arrive.
+
+    Records are written with at most latency seconds (plus the filter delay) of delay. Stops after
+    maxseconds seconds, or once no data has come for idle_timeout seconds. After more than max_gap
+    seconds without frames, new RDEF files are started at the second the source resumed with, rather
+    than writing the gap as zeros. Returns the names of the files written."""
+    if source.startswith('udp://'):
+        host, port = source[len('udp://'):].rsplit(':', 1)
+        frame_batches = receive_udp_frames(host, int(port), idle_timeout=idle_timeout)
+    else:
+        frame_batches = follow_file_frames(source, idle_timeout=idle_timeout)
+    stream = VdifLiveStream(frame_batches, latency, max_gap=max_gap)
+    total_samples_perchann = stream.steps_in_sec * vdif_frame_samples_perchann(stream.FRAME_HEADER)
+    live_seconds = iter(stream)
+    following = next(live_seconds, None)  # (seconds_from_epoch, frames, rows) of the next second
+    n_converted = 0
+    names = []
+
+    while following is not None:
+        # One set of RDEF files per run of consecutive seconds
+        first_second = following[0]
+        FRAME_HEADER = dict(stream.FRAME_HEADER, seconds_from_epoch=first_second, data_frame_n=0)
+        year_beg, doy_beg, sod_beg, hh_beg, mm_beg, ss_beg = vdif_second_timetag(FRAME_HEADER, first_second, stream.frames_in_sec)
+        channels_to_extract, outnames, writer, accumulators = open_rdef_outputs(
+            FRAME_HEADER, aux, channels, total_samples_perchann, outdir, (year_beg, doy_beg, hh_beg, mm_beg, ss_beg), f'VDIF stream {source}', psd, rdef_bits)
+
+        # Seconds in order, a second with missing frames being flagged as soon as it is handed out
+        valid = []
+        def seconds():
+            nonlocal following, n_converted
+            while following is not None and following[0] == first_second + len(valid):
+                second, frames, rows = following
+                valid.append((rows >= 0).all(axis=0))
+                n_converted += 1
+                yield frames, rows
+                # Only then the next second, the assembler reusing the frames of this one
+                following = next(live_seconds, None) if maxseconds is None or n_converted < maxseconds else None
+
+        channels_samples = decoded_seconds(seconds(), FRAME_HEADER, channels_to_extract)
+        records = RecordStream(FRAME_HEADER, channels_to_extract, total_samples_perchann, accumulators, rdef_bits)
+        converted = converted_samples(channels_samples, records)
+        write_records(writer, converted, FRAME_HEADER, stream.frames_in_sec, valid, total_samples_perchann, aux, rdef_bits, flush=True)
+        writer.close()
+        if psd:
+            for i in channels_to_extract:
+                save_psd_to_file(accumulators[i], outnames[i])
+        names += outnames.values()
+    return names
+
+def load_aux_file(auxfile):
+    """Settings of an auxiliary side file, as a dict of its variables."""
+    aux = {}
     with open(auxfile, 'r') as aux_f:
-        lines = aux_f.readlines()
-        exec('\n'.join(lines))  # This will execute the code in the auxiliary file
+        exec(aux_f.read(), {}, aux)  # The side file is a list of Python assignments
 
     # Ensure CARRIER_FREQUENCY is a float and CHANNELS_FREQUENCY is a list
-    if not isinstance(CARRIER_FREQUENCY, (int, float)) or not isinstance(CHANNELS_FREQUENCY, list):
-        print("Error: CARRIER_FREQUENCY should be a float and CHANNELS_FREQUENCY should be a list.")
-        exit(1)
+    if not isinstance(aux.get('CARRIER_FREQUENCY'), (int, float)) or not isinstance(aux.get('CHANNELS_FREQUENCY'), list):
+        print(f'*** Error: CARRIER_FREQUENCY should be a float and CHANNELS_FREQUENCY should be a list in {auxfile}.')
+        sys.exit(1)
 
     # Define CHANNEL_FREQUENCY_OFFSET if not already defined
-    if 'CHANNEL_FREQUENCY_OFFSET' not in globals():
-        CHANNEL_FREQUENCY_OFFSET = [0.0] * NUMBER_CHANNELS
+    aux.setdefault('CHANNEL_FREQUENCY_OFFSET', [0.0] * aux['NUMBER_CHANNELS'])
+    return aux
 
-    # Channels to extract
-    channels_to_extract = range(FRAME['HEADER']['nchann']) if channels is None else [(int(k) - 1) for k in channels]
+def rdef_output_name(aux, channel, year_beg, doy_beg, hh_beg, mm_beg, ss_beg):
+    """Name of the RDEF file of a channel (first channel is 0)."""
+    return '{}{:02}-{:02}{:03}{:02}{:02}{:02}.prd'.format(
+        aux['PRD_NAME'][:16], channel + 1, int(str(year_beg)[-2:]), doy_beg, hh_beg, mm_beg, ss_beg)
 
-    for filename in filenames:
-        with open(filename, "rb") as f:
-            # Extract sample rate
-            frames_in_sec = vdif_samplerate_extractor(f)
+def convert_file(filename, aux, skip=0, maxseconds=1, channels=None, outdir='.', nocache=False, workers=1,
+                 max_memory=None, psd=False, readahead=2, rdef_bits=16, start=None, stop=None, tones=None,
+                 sample_cache=None, sample_cache_size=10000, fft_workers=-1):
+    """Convert one VDIF file to one RDEF file per channel in outdir, and return the names of the files written.
 
-            # Extract timetag and header info
-            year_beg, doy_beg, sod_beg, hh_beg, mm_beg, ss_beg, FRAME = extract_samples(f, frames_in_sec, skip)
+    start, stop -> UTC window to convert (see vdif_parse_utc), replacing skip and maxseconds.
+    tones -> integration time (s) of the DOR tone phases and amplitudes to extract (see ToneWriter), None for none.
+    sample_cache -> directory of a VdifSampleCache of decoded seconds, limited to sample_cache_size MB (serial mode only).
+    fft_workers -> threads of the FFTs of the serial and streaming conversions (-1 for all the CPUs)."""
+    with open(filename, "rb") as f:
+        # Frame index from the headers of the memory-mapped file
+        index = VdifIndex(filename, cache=not nocache)
 
-            # Create empty binary file for each channel
-            for i in channels_to_extract:
-                outname_prd = '{}{:02}-{:02}{:03}{:02}{:02}{:02}.prd'.format(
-                    PRD_NAME[:16], i + 1, int(str(year_beg)[-2:]), doy_beg, hh_beg, mm_beg, ss_beg)
-                print(f'Creating {outname_prd} ...')
-                with open(outname_prd, "wb") as outfile:
-                    pass  # Create empty file
-
-            # Total seconds in file (after manually skipped seconds)
-            total_integer_seconds = calculate_total_seconds(f, FRAME, frames_in_sec)
-            print(f'Total seconds in file (after skipping): {total_integer_seconds}')
-            maxseconds = min(maxseconds, total_integer_seconds)
-
-            # Check if auxfile has consistent number of channels with respect to vdif file
-            print(f'Number of channels in VDIF file: {FRAME["HEADER"]["nchann"]}')
-            if FRAME['HEADER']['nchann'] != NUMBER_CHANNELS:
-                print(f'*** Error: Number of channels in auxiliary file {auxfile} does not match VDIF file.')
-                exit()
-
-            # Read data and extract samples
-            for relative_sec in range(maxseconds):
-                print(f'Reading second {relative_sec} of data...')
-                mytime = time()
-                FRAME_SEC = vdif_second_reader(f, frames_in_sec)
-                channels_sample = FRAME_SEC['DATA']
-                print(f'{time() - mytime} seconds to read one second of data.')
-
-                # Apply Hilbert transform and Welch method to each channel
-                for i in channels_to_extract:
-                    print(f'Processing channel {i + 1} ...')
-                    chunk_size = 1000000  # Adjust chunk size as needed
-                    num_chunks = len(channels_sample[i]) // chunk_size
-                    transformed_data = np.empty(len(channels_sample[i]), dtype=np.complex64)
-
-                    for j in range(num_chunks):
-                        start = j * chunk_size
-                        end = start + chunk_size
-                        transformed_data[start:end] = process_chunk(channels_sample[i][start:end])
-
-                    # Handle any remaining data
-                    start = num_chunks * chunk_size
-                    if start < len(channels_sample[i]):
-                        transformed_data[start:] = process_chunk(channels_sample[i][start:])
-
-                    # Calculate Power Spectral Density (PSD) for the channel
-                    print(f'Calculating PSD for channel {i + 1} ...')
-                    psd = calculate_psd(transformed_data, fs=frames_in_sec)
-                    # You might save or further process the PSD as needed.
-
-                    channels_sample[i] = transformed_data
-
-                # Write RDEF header and interleaved data for each channel
-                for i in channels_to_extract:
-                    outname_prd = '{}{:02}-{:02}{:03}{:02}{:02}{:02}.prd'.format(
-                        PRD_NAME[:16], i + 1, int(str(year_beg)[-2:]), doy_beg, hh_beg, mm_beg, ss_beg)
-                    with open(outname_prd, "ab") as out_f:
-                        print(f'Writing second {relative_sec} of channel {i + 1} to {outname_prd} ...')
-                        total_samples_perchann = len(channels_sample[i])
-                        write_rdef_header(out_f, FRAME, year_beg, doy_beg, sod_beg, i + 1, total_samples_perchann, CARRIER_FREQUENCY, CHANNEL_FREQUENCY_OFFSET[i])
-                        write_interleaved_data(out_f, channels_sample[i])
+        # Extract sample rate
+        frames_in_sec = vdif_samplerate_extractor(f, index)
+
+        # Seconds of the UTC window, found by bisecting the frame headers
+        if start is not None or stop is not None:
+            window = time_window(f, frames_in_sec, start, stop, index)
+            if window is None:
+                print(f'No data of {filename} in the UTC window.')
+                return []
+            skip, window_seconds = window
+            maxseconds = maxseconds if window_seconds is None else window_seconds
+
+        # Extract timetag and header info
+        year_beg, doy_beg, sod_beg, hh_beg, mm_beg, ss_beg, FRAME = extract_samples(f, frames_in_sec, skip, index)
+
+        # Total seconds in file (after manually skipped seconds)
+        total_integer_seconds = calculate_total_seconds(f, FRAME, frames_in_sec, index)
+        print(f'Total seconds in file (after skipping): {total_integer_seconds}')
+        index.save_cache()
+        maxseconds = min(maxseconds, total_integer_seconds)
+
+        # Frames of the seconds to convert, from a validation of their headers second by second as they are read
+        mapper = VdifFrameMapper(index, f.tell() // index.data_frame_len_bytes, frames_in_sec, maxseconds)
+        total_samples_perchann = mapper.steps_in_sec * vdif_frame_samples_perchann(FRAME['HEADER'])
+        channels_to_extract, outnames, writer, accumulators = open_rdef_outputs(
+            FRAME['HEADER'], aux, channels, total_samples_perchann, outdir, (year_beg, doy_beg, hh_beg, mm_beg, ss_beg), f'VDIF file {filename}', psd, rdef_bits, fft_workers)
+
+        # DOR tones of the same seconds, mixed down from the decoded samples of the channels holding them
+        tone_writer = None
+        if tones is not None:
+            plan = dor_tone_plan(aux, channels_to_extract, total_samples_perchann, FRAME['HEADER']['data_type'])
+            if plan:
+                tone_writer = ToneWriter(FRAME['HEADER'], aux, plan, total_samples_perchann, tones, outnames)
+            else:
+                print(f'No DOR tone in the band of the channels of {filename}.')
+
+        # Read data and extract samples, in this process or spread over a pool of workers
+        cache = VdifSampleCache(sample_cache, sample_cache_size * 1e6) if sample_cache is not None else None
+        if cache is not None and (workers > 1 or max_memory is not None):
+            print('The sample cache is only used when converting one whole second at a time (without -workers and -max-memory).')
+        if workers > 1:
+            converted = parallel_converted_seconds(filename, FRAME['HEADER'], mapper, channels_to_extract, workers, accumulators, rdef_bits)
+        elif max_memory is not None:
+            converted = streaming_converted_seconds(f, FRAME['HEADER'], mapper, channels_to_extract, max_memory * 1e6, accumulators, readahead, rdef_bits, fft_workers, tone_writer)
+        else:
+            converted = serial_converted_seconds(f, FRAME['HEADER'], mapper, channels_to_extract, total_samples_perchann, accumulators, readahead, rdef_bits, cache, fft_workers, tone_writer)
+
+        write_records(writer, converted, FRAME['HEADER'], frames_in_sec, mapper.valid, total_samples_perchann, aux, rdef_bits)
+        writer.close()
+        mapper.report()
+
+        if tone_writer is not None:
+            # The samples decoded by the workers stay in their processes: the tones are mixed from a decoding of their own
+            if workers > 1:
+                for seconds_from_epoch, valid, channels_sample in VdifReader(filename).seconds(skip, maxseconds, list(plan)):
+                    tone_writer.add_second(seconds_from_epoch, valid, channels_sample)
+            tone_writer.close()
+
+    # Averaged PSD of each channel over all the converted seconds
+    if psd:
+        for i in channels_to_extract:
+            save_psd_to_file(accumulators[i], outnames[i])
+    return list(outnames.values())
+
+# Files of a VDIF directory written by vdif2rdef itself: index caches, RDEF, PSD and tone outputs, manifest, metrics
+BATCH_SKIPPED_SUFFIXES = ('.vdifidx', '.prd', '_psd.txt', '_tones.txt', '.json', '.jsonl', '.tmp')
+
+def batch_files(directory):
+    """VDIF files of a directory, with their auxiliary side files in its aux_files/ subdirectory.
+
+    Only the files with a side file are VDIF files to convert."""
+    files = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        auxfile = os.path.join(directory, 'aux_files', name + '.aux')
+        if name.startswith('.') or name.endswith(BATCH_SKIPPED_SUFFIXES) or not os.path.isfile(path) or not os.path.isfile(auxfile):
+            continue
+        files.append((path, auxfile))
+    return files
+
+def load_manifest(manifest_path, options):
+    """Jobs of a previous batch run with the same options, or an empty manifest."""
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as manifest_f:
+            manifest = json.load(manifest_f)
+        if manifest.get('options') == options:
+            return manifest
+        print(f'Options differ from those of {manifest_path}, starting a new batch.')
+    return {'options': options, 'jobs': {}}
+
+def save_manifest(manifest_path, manifest):
+    """Write the manifest atomically, so that an interrupted batch always leaves a readable one."""
+    with open(manifest_path + '.tmp', 'w') as manifest_f:
+        json.dump(manifest, manifest_f, indent=1)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def batch_convert_file(filename, auxfile, options, fft_workers=-1, metrics=None):
+    """Worker: convert one file of a batch, reporting errors instead of exiting.
+
+    fft_workers -> threads of the FFTs of this job, so that the jobs together use each CPU once.
+    metrics -> metrics_config of the METRICS lines of the conversion, labelled with the file name."""
+    if metrics is not None:
+        METRICS.configure(label=filename, **metrics)
+    try:
+        return convert_file(filename, load_aux_file(auxfile), fft_workers=fft_workers, **options), None
+    except (Exception, SystemExit) as error:
+        return None, f'{type(error).__name__}: {error}'
+    finally:
+        METRICS.summary()
+        METRICS.close()
+
+def batch_convert(directory, options, jobs=1, outdir=None, restart=False, metrics=None):
+    """Convert all the VDIF files of a directory with a pool of jobs processes, resuming from its manifest."""
+    outdir = directory if outdir is None else outdir
+    os.makedirs(outdir, exist_ok=True)
+    options = dict(options, outdir=outdir)
+    manifest_path = os.path.join(outdir, 'vdif2rdef_manifest.json')
+    manifest = {'options': options, 'jobs': {}} if restart else load_manifest(manifest_path, options)
+
+    pending = []
+    for filename, auxfile in batch_files(directory):
+        job = manifest['jobs'].get(os.path.basename(filename), {})
+        if job.get('status') == 'done' and all(os.path.exists(name) for name in job['outputs']):
+            print(f'Skipping {filename}, already converted.')
+            continue
+        manifest['jobs'][os.path.basename(filename)] = {'status': 'pending'}
+        pending.append((filename, auxfile))
+    save_manifest(manifest_path, manifest)
+    print(f'Files to process: {len(pending)}')
+
+    # At most jobs files in flight, the manifest updated as each one completes
+    fft_workers = max((os.cpu_count() or 1) // jobs, 1)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(batch_convert_file, filename, auxfile, options, fft_workers, metrics): filename for filename, auxfile in pending}
+        for future in as_completed(futures):
+            filename = futures[future]
+            outputs, error = future.result()
+            if error is None:
+                manifest['jobs'][os.path.basename(filename)] = {'status': 'done', 'outputs': outputs}
+                print(f'... done for {filename}.')
+            else:
+                manifest['jobs'][os.path.basename(filename)] = {'status': 'failed', 'error': error}
+                print(f'*** Error converting {filename}: {error}')
+            save_manifest(manifest_path, manifest)
+
+    failed = [name for name, job in manifest['jobs'].items() if job['status'] != 'done']
+    if failed:
+        print(f'*** Files not converted: {failed}')
+    return not failed
+
+def add_conversion_arguments(parser):
+    """Options shared by the single file and batch command lines."""
+    parser.add_argument('-skip', type=int, default=0, help='Seconds to skip from the beginning of the file.')
+    parser.add_argument('-maxseconds', type=int, help='Max number of seconds to decode (default: 1, in live mode until the data stops).')
+    parser.add_argument('-channels', nargs='+', type=int, help='Channels to extract (first channel is "1").')
+    parser.add_argument('-nocache', action='store_true', help='Do not read or write the .vdifidx index cache.')
+    parser.add_argument('-workers', type=int, default=1, help='Worker processes converting seconds and channels in parallel.')
+    parser.add_argument('-max-memory', type=float, help='Stream each second in blocks fitting this memory budget (MB, read-ahead buffers included).')
+    parser.add_argument('-psd', action='store_true', help='Write the averaged power spectral density of each channel.')
+    parser.add_argument('-readahead', type=int, default=2, help='Input buffers filled ahead by a background reader (0: read in the main thread).')
+    parser.add_argument('-rdef-bits', type=int, default=16, choices=RDEF_SAMPLE_SIZES, help='Bits of each I and Q sample in the RDEF records.')
+    parser.add_argument('-start', type=str, help='UTC start of the data to convert, YYYY/DOY/SOD or YYYY-MM-DDTHH:MM:SS (replaces -skip).')
+    parser.add_argument('-stop', type=str, help='UTC end of the data to convert, YYYY/DOY/SOD or YYYY-MM-DDTHH:MM:SS (replaces -maxseconds).')
+    parser.add_argument('-sample-cache', type=str, help='Directory of a cache of decoded samples, reused by later runs on the same files.')
+    parser.add_argument('-sample-cache-size', type=float, default=10000, help='Size limit of the sample cache (MB), least recently used seconds deleted first.')
+    parser.add_argument('-tones', type=float, nargs='?', const=0.1, help='Also write the phase and amplitude of the DOR tones, integrated over this time (s, default 0.1).')
+
+def conversion_options(args):
+    """Keyword arguments of convert_file from the parsed command line."""
+    return {'skip': args.skip, 'maxseconds': 1 if args.maxseconds is None else args.maxseconds, 'channels': args.channels, 'nocache': args.nocache,
+            'workers': args.workers, 'max_memory': args.max_memory, 'psd': args.psd, 'readahead': args.readahead,
+            'rdef_bits': args.rdef_bits, 'start': args.start, 'stop': args.stop, 'tones': args.tones,
+            'sample_cache': args.sample_cache, 'sample_cache_size': args.sample_cache_size}
+
+if __name__ == "__main__":
+    print()
+    print('--- vdif2rdef ---')
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        parser = argparse.ArgumentParser(prog='vdif2rdef.py batch')
+        parser.add_argument('directory', help='Directory of the VDIF files, with their side files in aux_files/.')
+        parser.add_argument('-jobs', type=int, default=os.cpu_count(), help='Files converted at the same time.')
+        parser.add_argument('-outdir', type=str, help='Directory of the RDEF files and manifest (default: the VDIF directory).')
+        parser.add_argument('-restart', action='store_true', help='Convert all the files again, ignoring the manifest.')
+        add_conversion_arguments(parser)
+        add_metrics_arguments(parser)
+        args = parser.parse_args(sys.argv[2:])
+
+        if not os.path.isdir(args.directory):
+            print(f'*** Error: Directory {args.directory} does not exist.')
+            sys.exit(1)
+        with run_profiler(args.profile, args.profile_out):
+            completed = batch_convert(args.directory, conversion_options(args), args.jobs, args.outdir, args.restart,
+                                      metrics_config(args.metrics, args.metrics_interval))
+        print('Processing completed.' if completed else 'Processing completed with errors.')
+        sys.exit(0 if completed else 1)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filenames', nargs='+', help='Name of the file(s) to be processed (with -live, a growing file or udp://host:port).')
+    parser.add_argument('-auxfile', type=str, help='Name of the auxiliary side file.')
+    parser.add_argument('-live', action='store_true', help='Convert a file still being written, or a UDP stream, second by second.')
+    parser.add_argument('-latency', type=int, default=1, help='Live mode: seconds to wait for late frames before writing a second.')
+    parser.add_argument('-idle-timeout', type=float, default=30.0, help='Live mode: stop after this many seconds without data.')
+    parser.add_argument('-max-gap', type=int, default=10, help='Live mode: longest gap without frames (s) written as zeros; new RDEF files are started after a longer one.')
+    add_conversion_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    print('Files to process:', args.filenames)
+
+    # Load auxiliary file
+    aux = load_aux_file(args.auxfile)
+
+    if args.metrics is not None:
+        METRICS.configure(args.metrics, args.metrics_interval, 'vdif2rdef')
+    with run_profiler(args.profile, args.profile_out):
+        for filename in args.filenames:
+            if args.live:
+                convert_live(filename, aux, args.maxseconds, args.channels, psd=args.psd, rdef_bits=args.rdef_bits,
+                             latency=args.latency, idle_timeout=args.idle_timeout, max_gap=args.max_gap)
+            else:
+                convert_file(filename, aux, **conversion_options(args))
+            METRICS.count('files')
+    METRICS.summary()
+    METRICS.close()
     print('Processing completed.')
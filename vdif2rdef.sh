@@ -21,6 +21,12 @@ MAX_SECONDS=1
 # Default:          CHANNELS_TO_EXTRACT='1 2 3 4 5 6 7 8'
 CHANNELS_TO_EXTRACT='1 2 3 4 5 6 7 8'
 
+# JOBS
+# Number of VDIF files converted at the same time.
+# Allowed values:   integer
+# Default:          JOBS=$(nproc)
+JOBS=$(nproc)
+
 # TRANSLATOR_PATH
 # Path containing the python script
 # Allowed values:   "%path%"
@@ -44,31 +50,9 @@ if [ ! -d "${FILE_PATH}" ]; then
     exit 1
 fi
 
-# Enable nullglob option to handle empty directories gracefully
-shopt -s nullglob
-
-# Change to the specified directory
-cd "${FILE_PATH}" || exit 1
-
-# Update FILE_PATH to remove any leading or trailing spaces or slashes
-FILE_PATH=${PWD}
-
-# Set AUX_DIR with location of aux files
-AUX_DIR="${FILE_PATH}/aux_files/"
-
-# Iterate over each file in the directory
-for FILE in "${FILE_PATH}"/*; do
-    if [ -f "${FILE}" ]; then
-        # Extract the filename without extension to use as auxiliary file base name
-        BASENAME=$(basename "${FILE}")
-        AUX_FILE="${AUX_DIR}/${BASENAME}.aux"
-
-        # Execute the translation script with the specified parameters
-        echo "Running ${TRANSLATOR_PATH}/vdif2rdef.py ${FILE} -auxfile ${AUX_FILE} -skip ${SKIP_SECONDS} -maxseconds ${MAX_SECONDS} -channels ${CHANNELS_TO_EXTRACT} || exit 1"
-        ${TRANSLATOR_PATH}/vdif2rdef.py "${FILE}" -auxfile "${AUX_FILE}" -skip "${SKIP_SECONDS}" -maxseconds "${MAX_SECONDS}" -channels ${CHANNELS_TO_EXTRACT} || exit 1
-
-        echo "... done for ${FILE}."
-    fi
-done
+# Convert all the files of the directory in one Python process, with their side files in aux_files/.
+# The batch keeps a manifest in the directory: running the script again resumes an interrupted batch.
+echo "Running ${TRANSLATOR_PATH}/vdif2rdef.py batch ${FILE_PATH} -jobs ${JOBS} -skip ${SKIP_SECONDS} -maxseconds ${MAX_SECONDS} -channels ${CHANNELS_TO_EXTRACT}"
+${TRANSLATOR_PATH}/vdif2rdef.py batch "${FILE_PATH}" -jobs "${JOBS}" -skip "${SKIP_SECONDS}" -maxseconds "${MAX_SECONDS}" -channels ${CHANNELS_TO_EXTRACT} || exit 1
 
 echo "End of script."
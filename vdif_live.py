@@ -0,0 +1,284 @@
+#!/bin/python3
+
+import argparse
+import numpy as np
+import os
+import select
+import socket
+import struct
+import sys
+from time import sleep, time
+from vdif_utilities import *
+
+def vdif_frame_words(frames):
+    # Header words 0 to 3 of each frame of a uint8 array (frames, frame length)
+    return np.ascontiguousarray(frames[:, :16]).view('<u4')
+
+def follow_file_frames(filename, frame_len=None, batch_frames=256, poll_interval=0.2, idle_timeout=30.0):
+    """Yield uint8 arrays (frames, frame length) of the whole frames written to a VDIF file that is still growing.
+
+    Stops once the file has not grown for idle_timeout seconds. Each array is a view of a reused buffer,
+    valid until the next one is requested."""
+    with open(filename, 'rb') as f:
+        if frame_len is None:
+            # Frame length from the first header, once it is on disk
+            idle_since = time()
+            while os.fstat(f.fileno()).st_size < 16:
+                if time() - idle_since > idle_timeout:
+                    return
+                sleep(poll_interval)
+            frame_len = ibits(struct.unpack('<4I', f.read(16))[2], 0, 24) * 8
+            f.seek(0)
+        buffer = bytearray(batch_frames * frame_len)
+        view = memoryview(buffer)
+        filled = 0
+        idle_since = time()
+        while True:
+            n_bytes = f.readinto(view[filled:])
+            filled += n_bytes or 0
+            n_frames = filled // frame_len
+            if n_frames:
+                idle_since = time()
+                yield np.frombuffer(buffer, dtype=np.uint8, count=n_frames * frame_len).reshape(n_frames, frame_len)
+                # Keep the partial frame at the end for the next read
+                remainder = filled - n_frames * frame_len
+                view[:remainder] = view[n_frames * frame_len:filled]
+                filled = remainder
+            elif time() - idle_since > idle_timeout:
+                return
+            else:
+                sleep(poll_interval)
+
+def receive_udp_frames(host, port, batch=64, payload_offset=0, idle_timeout=30.0, rcvbuf=64 * 1024 * 1024):
+    """Yield uint8 arrays (frames, frame length) of VDIF frames received as UDP datagrams, one frame per datagram.
+
+    payload_offset -> bytes before the VDIF frame in each datagram (e.g. a packet sequence number).
+    Datagrams are read into a preallocated (batch, datagram) array: after waiting for the first one,
+    recv_into of as many as are queued, up to batch. Python has no recvmmsg, this is the closest
+    batching the socket module offers. Stops after idle_timeout seconds without datagrams.
+    Each array is a view of the reused buffer, valid until the next one is requested."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.bind((host, port))
+    sock.setblocking(False)
+    try:
+        # Datagram length from the header of the first frame
+        first = bytearray(65536)
+        if not select.select([sock], [], [], idle_timeout)[0]:
+            return
+        n_bytes = sock.recv_into(first)
+        frame_len = ibits(struct.unpack_from('<4I', first, payload_offset)[2], 0, 24) * 8
+        datagram_len = payload_offset + frame_len
+        datagrams = np.zeros((batch, datagram_len), dtype=np.uint8)
+        rows = [memoryview(row) for row in datagrams]
+        if n_bytes == datagram_len:
+            datagrams[0] = np.frombuffer(first, dtype=np.uint8, count=datagram_len)
+            yield datagrams[:1, payload_offset:]
+        sizes = np.zeros(batch, dtype=np.int64)
+        while True:
+            if not select.select([sock], [], [], idle_timeout)[0]:
+                return
+            n = 0
+            while n < batch:
+                try:
+                    sizes[n] = sock.recv_into(rows[n], datagram_len)
+                except (BlockingIOError, InterruptedError):
+                    break
+                n += 1
+            # Datagrams of another length are not VDIF frames of this stream
+            good = sizes[:n] == datagram_len
+            yield datagrams[:n][good, payload_offset:] if not good.all() else datagrams[:n, payload_offset:]
+    finally:
+        sock.close()
+
+class VdifSecondAssembler:
+    """Place live VDIF frames on the (time step, thread) slot of their second, and hand out whole seconds in order.
+
+    A second is handed out as soon as all its frames are in, or once a frame timed latency seconds
+    after its end has arrived: its missing frames are left out, and frames arriving for it later are
+    dropped. About latency + 2 seconds are buffered, the buffers being reused.
+
+    Frames more than one second ahead of the newest one are only taken once confirm_frames of them
+    have come for the same second (the source resumed after a gap): until then they are ignored, so
+    that a single frame with a corrupted time does not hand out the seconds before it unfinished.
+    Up to max_gap seconds without any frame are handed out as missing; a longer gap is skipped, the
+    next second handed out being the one the source resumed with."""
+
+    def __init__(self, frame_len, steps_in_sec, threads, first_second, latency=1, confirm_frames=8, max_gap=10):
+        self.frame_len = frame_len
+        self.steps_in_sec = steps_in_sec
+        self.threads = list(threads)
+        self.latency = latency
+        self.confirm_frames = confirm_frames
+        self.max_gap = max_gap
+        self.next_second = first_second  # seconds_from_epoch of the next second to hand out
+        self.newest = first_second - 1
+        self.newest_time = float(self.newest)  # time of the newest frame, in seconds_from_epoch
+        self.late = 0
+        self.invalid = 0
+        self.ignored = 0
+        self._open = {}  # seconds_from_epoch -> (frames, present)
+        self._free = []
+        self._ahead = {}  # seconds_from_epoch -> frames ignored so far, for the seconds not yet confirmed
+
+    def _second(self, second):
+        if second not in self._open:
+            n_slots = self.steps_in_sec * len(self.threads)
+            frames = self._free.pop() if self._free else np.empty((n_slots, self.frame_len), dtype=np.uint8)
+            self._open[second] = (frames, np.zeros(n_slots, dtype=bool))
+        return self._open[second]
+
+    def add(self, frames):
+        """Copy a batch of frames (uint8 array (frames, frame length)) into their seconds."""
+        if len(frames) == 0:
+            return
+        words = vdif_frame_words(frames)
+        seconds = (words[:, 0] & 0x3fffffff).astype(np.int64)
+        invalid = (words[:, 0] >> 31).astype(bool)
+        data_frame_n = (words[:, 1] & 0xffffff).astype(np.int64)
+        thread_ids = (words[:, 3] >> 16) & 0x3ff
+        thread = np.minimum(np.searchsorted(self.threads, thread_ids), len(self.threads) - 1)
+        usable = ~invalid & (np.asarray(self.threads)[thread] == thread_ids) & (data_frame_n < self.steps_in_sec)
+        self.invalid += int(invalid.sum())
+        late = usable & (seconds < self.next_second)
+        self.late += int(late.sum())
+        usable &= ~late
+        slot = data_frame_n * len(self.threads) + thread
+        for second in np.unique(seconds[usable]):
+            in_second = usable & (seconds == second)
+            second = int(second)
+            # A jump ahead is only followed once enough frames confirm it
+            if second > max(self.newest, self.next_second) + 1:
+                n_frames = self._ahead.get(second, 0) + int(in_second.sum())
+                if n_frames < self.confirm_frames:
+                    self.ignored += int(in_second.sum())
+                    self._ahead[second] = n_frames
+                    continue
+            second_frames, present = self._second(second)
+            second_frames[slot[in_second]] = frames[in_second]
+            present[slot[in_second]] = True
+            self.newest = max(self.newest, second)
+            self.newest_time = max(self.newest_time, second + data_frame_n[in_second].max() / self.steps_in_sec)
+        # Counts of the seconds caught up with, or of too many stray ones
+        if len(self._ahead) > 64:
+            self._ahead.clear()
+        for second in [second for second in self._ahead if second <= self.newest + 1]:
+            del self._ahead[second]
+
+    def ready(self, flush=False):
+        """Yield (seconds_from_epoch, frames, rows) for each second that can be handed out, in order.
+
+        rows -> (time steps, threads) row in frames of each frame, -1 for the missing ones. frames is
+        reused once the next second is requested. With flush, hand out all the buffered seconds.
+        After a gap longer than max_gap, seconds_from_epoch jumps to the second after the gap."""
+        while self.next_second <= self.newest:
+            second = self.next_second
+            frames, present = self._open.get(second, (None, None))
+            complete = present is not None and present.all()
+            if not (complete or flush or self.newest_time >= second + 1 + self.latency):
+                return
+            if frames is None:
+                resume = min((open_second for open_second in self._open if open_second > second), default=self.newest)
+                if resume - second > self.max_gap:
+                    print(f'Live stream: no frame for {resume - second} seconds from second {second}, resuming at second {resume}')
+                    self.next_second = resume
+                    continue
+                # No frame at all in this second: all its samples are zero
+                frames, present = self._second(second)
+            rows = np.where(present, np.arange(len(present)), -1).reshape(self.steps_in_sec, len(self.threads))
+            yield second, frames, rows
+            del self._open[second]
+            self._free.append(frames)
+            self.next_second += 1
+
+class VdifLiveStream:
+    """Whole seconds of a live VDIF source (growing file or UDP frames), in order, with bounded latency.
+
+    The frame format, frames per second and threads are learnt from the first full second received,
+    so creating the stream waits for about two seconds of data. The stream starts with the first
+    second received if its frame 0 came, else with the next one. confirm_frames, max_gap -> see VdifSecondAssembler."""
+
+    def __init__(self, frame_batches, latency=1, confirm_frames=8, max_gap=10):
+        self.frame_batches = iter(frame_batches)
+        self.latency = latency
+        warmup = []
+        first = None
+        for frames in self.frame_batches:
+            if len(frames) == 0:
+                continue
+            warmup.append(frames.copy())
+            seconds = vdif_frame_words(frames)[:, 0] & 0x3fffffff
+            first = int(vdif_frame_words(warmup[0])[0, 0] & 0x3fffffff) if first is None else first
+            if seconds.max() >= first + 2:
+                break
+        else:
+            print('*** LIVE STREAM ENDED BEFORE ONE FULL SECOND WAS RECEIVED')
+            sys.exit()
+
+        # Rate and threads from the frames of the first full second
+        frames = np.concatenate(warmup)
+        words = vdif_frame_words(frames)
+        seconds = words[:, 0] & 0x3fffffff
+        in_second = np.flatnonzero(seconds == first + 1)
+        self.first_second = first if ((seconds == first) & (words[:, 1] & 0xffffff == 0)).any() else first + 1
+        self.steps_in_sec = int((words[in_second, 1] & 0xffffff).max()) + 1
+        self.threads = [int(thread) for thread in np.unique((words[in_second, 3] >> 16) & 0x3ff)]
+        self.FRAME_HEADER = dict(vdif_parse_header(frames[in_second[0]])._asdict(), threads=self.threads)
+        self.frames_in_sec = self.steps_in_sec * len(self.threads)
+        print(f'Live stream: {self.frames_in_sec} frames per second, threads {self.threads}, starting at second {self.first_second}')
+
+        self.assembler = VdifSecondAssembler(frames.shape[1], self.steps_in_sec, self.threads, self.first_second, latency, confirm_frames, max_gap)
+        self.assembler.add(frames[seconds >= self.first_second])
+
+    def __iter__(self):
+        """Yield (seconds_from_epoch, frames, rows) for each second, as vdif_decode_mapped takes them."""
+        yield from self.assembler.ready()
+        for frames in self.frame_batches:
+            METRICS.count('frames_received', len(frames))
+            self.assembler.add(frames)
+            METRICS.gauge('live_open_seconds', len(self.assembler._open))
+            yield from self.assembler.ready()
+        yield from self.assembler.ready(flush=True)
+        assembler = self.assembler
+        print(f'Live stream ended: {assembler.late} late, {assembler.invalid} invalid and {assembler.ignored} ignored frames')
+
+def replay_udp(filename, host, port, rate=1.0, drop=0.0, reorder=0, payload_offset=0, seed=0):
+    """Send the frames of a VDIF file as UDP datagrams at rate times real time, for testing the live mode.
+
+    drop -> fraction of frames not sent; reorder -> frames shuffled within windows of that many frames."""
+    index = VdifIndex(filename)
+    frames_in_sec = index.frames_in_sec()
+    frames = index.mmap[:index.n_frames * index.data_frame_len_bytes].reshape(index.n_frames, index.data_frame_len_bytes)
+    rng = np.random.default_rng(seed)
+    order = np.arange(index.n_frames)
+    if reorder > 1:
+        windows = order[:len(order) // reorder * reorder].reshape(-1, reorder)
+        order[:windows.size] = rng.permuted(windows, axis=1).reshape(-1)
+    if drop > 0:
+        order = order[rng.random(len(order)) >= drop]
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    prefix = bytes(payload_offset)
+    chunk = max(frames_in_sec // 100, 1)  # frames sent between two pacing checks
+    print(f'Replaying {len(order)} frames of {filename} to {host}:{port} at {frames_in_sec * rate:.0f} frames/s')
+    start = time()
+    for k in range(0, len(order), chunk):
+        for frame in order[k:k + chunk]:
+            sock.sendto(prefix + frames[frame].tobytes() if payload_offset else frames[frame], (host, port))
+        delay = start + (k + chunk) / (frames_in_sec * rate) - time()
+        if delay > 0:
+            sleep(delay)
+    sock.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay a VDIF file as a UDP stream of frames, to test the live mode of vdif2rdef.py.')
+    parser.add_argument('filename', help='VDIF file to send.')
+    parser.add_argument('destination', help='host:port to send the frames to.')
+    parser.add_argument('-rate', type=float, default=1.0, help='Speed, in multiples of real time.')
+    parser.add_argument('-drop', type=float, default=0.0, help='Fraction of frames not sent.')
+    parser.add_argument('-reorder', type=int, default=0, help='Shuffle frames within windows of this many frames.')
+    parser.add_argument('-payload-offset', type=int, default=0, help='Bytes of zeros sent before each frame.')
+    args = parser.parse_args()
+
+    host, port = args.destination.rsplit(':', 1)
+    replay_udp(args.filename, host, int(port), args.rate, args.drop, args.reorder, args.payload_offset)
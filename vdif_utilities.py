@@ -1,8 +1,15 @@
 #!/bin/python3
 
+import collections
+import datetime
+import hashlib
 import numpy as np
+import os
+import queue
 import struct
 import sys
+import threading
+from metrics import METRICS
 
 def ibits(value, position, length):
     return (value >> position) & ~(-1 << length)
@@ -23,12 +30,141 @@ def clear_bit(value, bit):
 def get_bit(value, bit):
     return (value & (1 << bit)) != 0
 
-def vdif_frame_reader(file, skip_data=True):
-    # Read HEADER
-    word0 = struct.unpack('<I', file.read(4))[0]
-    word1 = struct.unpack('<I', file.read(4))[0]
-    word2 = struct.unpack('<I', file.read(4))[0]
-    word3 = struct.unpack('<I', file.read(4))[0]
+_DECODE_LUT = {}
+
+def vdif_sample_dtype(bit_sample):
+    # Decoded levels are odd integers in [-(2**bit_sample - 1), 2**bit_sample - 1]
+    return np.int8 if bit_sample <= 4 else np.int16
+
+def vdif_decode_lut(bit_sample):
+    # 256-entry table: byte value -> the 8 // bit_sample samples it holds, least significant bits first
+    if bit_sample not in (1, 2, 4, 8):
+        print('*** DECODING IMPOSSIBLE, WRONG BITS PER SAMPLE: ', bit_sample)
+        sys.exit()
+    if bit_sample not in _DECODE_LUT:
+        samples_per_byte = 8 // bit_sample
+        codes = np.arange(256)[:, None] >> (np.arange(samples_per_byte) * bit_sample)
+        codes &= (1 << bit_sample) - 1
+        # Offset binary, as the 2-bit sign/magnitude coding: -3 -1 1 3 -> signmagn 00 01 10 11
+        lut = 2 * codes - ((1 << bit_sample) - 1)
+        _DECODE_LUT[bit_sample] = lut.astype(vdif_sample_dtype(bit_sample))
+    return _DECODE_LUT[bit_sample]
+
+def vdif_decode_component(payload, bit_sample, values_per_step, component, out):
+    # Decode straight into out the samples of one component (channel, or I/Q of a channel) of each time step
+    lut = vdif_decode_lut(bit_sample)
+    if values_per_step * bit_sample >= 8:
+        # Whole bytes per time step: the component lives in one fixed byte of each step
+        step_bytes = values_per_step * bit_sample // 8
+        position = component * bit_sample
+        codes = payload[:, position // 8::step_bytes]
+        table = lut[:, (position % 8) // bit_sample]
+    else:
+        # Several time steps per byte: the component takes every values_per_step-th sample of each byte
+        codes = payload
+        table = lut[:, component::values_per_step]
+    np.take(table.astype(out.dtype, copy=False), codes, axis=0, out=out.reshape(codes.shape + table.shape[1:]))
+    return out
+
+def vdif_decode_samples(payload, bit_sample, nchann, data_type=False, channels=None, out=None):
+    # payload -> uint8 array (frames, data field bytes) with the data fields of one or more frames
+    # out -> optional list of reusable per-channel arrays to decode the requested channels into
+    payload = np.asarray(payload, dtype=np.uint8).reshape(-1, np.shape(payload)[-1])
+    if channels is None and out is None:
+        samples = vdif_decode_lut(bit_sample)[payload].reshape(-1)
+        if not data_type:
+            return [samples[i::nchann] for i in range(nchann)]  # one element every nchann elements
+        channels = range(nchann)
+
+    # Only the bit fields of the requested channels, into one preallocated array per channel
+    if channels is None:
+        channels = range(nchann)
+    values_per_step = nchann * (2 if data_type else 1)  # complex: I and Q of each channel are consecutive samples
+    samples_perchann = payload.size * 8 // bit_sample // values_per_step
+    channels_sample = [None] * nchann
+    for i in channels:
+        if out is not None:
+            channels_sample[i] = out[i][:samples_perchann]
+        elif data_type:
+            channels_sample[i] = np.empty(samples_perchann, dtype=np.complex64)
+        else:
+            channels_sample[i] = np.empty(samples_perchann, dtype=vdif_sample_dtype(bit_sample))
+        if data_type:
+            vdif_decode_component(payload, bit_sample, values_per_step, 2 * i, channels_sample[i].real)
+            vdif_decode_component(payload, bit_sample, values_per_step, 2 * i + 1, channels_sample[i].imag)
+        else:
+            vdif_decode_component(payload, bit_sample, values_per_step, i, channels_sample[i])
+    return channels_sample
+
+def vdif_thread_payloads(frames, threads, header_size_bytes, wanted=None):
+    # frames -> uint8 array (frames, frame length) of consecutive frames, the threads taking turns
+    # threads -> thread IDs of the file, in channel order; wanted -> positions in threads to return (all if None)
+    # Data fields of the frames of each thread in data_frame_n order, None for the threads not wanted
+    wanted = range(len(threads)) if wanted is None else wanted
+    if len(threads) == 1:
+        return [frames[:, header_size_bytes:] if 0 in wanted else None]
+    words = np.ascontiguousarray(frames[:, :16]).view('<u4')
+    thread_ids = (words[:, 3] >> 16) & 0x3ff
+    payloads = [None] * len(threads)
+    n_threads = len(threads)
+    turn = thread_ids[:n_threads]
+    if (len(frames) % n_threads == 0 and sorted(turn.tolist()) == sorted(threads)
+            and (thread_ids.reshape(-1, n_threads) == turn).all()):
+        # Threads always in the same order: one zero-copy strided view per thread
+        for k in wanted:
+            payloads[k] = frames[int(np.flatnonzero(turn == threads[k])[0])::n_threads, header_size_bytes:]
+        return payloads
+    # Irregular order: gather the frames of each thread, sorted by frame number
+    seconds = words[:, 0] & 0x3fffffff
+    data_frame_n = words[:, 1] & 0xffffff
+    for k in wanted:
+        rows = np.flatnonzero(thread_ids == threads[k])
+        rows = rows[np.lexsort((data_frame_n[rows], seconds[rows]))]
+        payloads[k] = frames[rows, header_size_bytes:]
+    return payloads
+
+def vdif_frame_threads(FRAME_HEADER):
+    # Thread IDs of the file, in channel order: a single-thread file if the index did not list them
+    return FRAME_HEADER.get('threads', [FRAME_HEADER['threadID']])
+
+def vdif_total_channels(FRAME_HEADER):
+    # Channels over all the threads: channel c of the k-th thread is channel k * nchann + c
+    return FRAME_HEADER['nchann'] * len(vdif_frame_threads(FRAME_HEADER))
+
+def vdif_decode_frames(frames, FRAME_HEADER, channels=None, out=None):
+    # frames -> uint8 array (frames, frame length) of consecutive frames, all the threads taking turns
+    # channels, out -> as vdif_decode_samples, numbered over all the threads (see vdif_total_channels)
+    nchann = FRAME_HEADER['nchann']
+    threads = vdif_frame_threads(FRAME_HEADER)
+    channels = range(nchann * len(threads)) if channels is None and len(threads) > 1 else channels
+    wanted = None if channels is None else sorted({i // nchann for i in channels})
+    payloads = vdif_thread_payloads(frames, threads, FRAME_HEADER['header_size_bytes'], wanted)
+    channels_sample = []
+    for k, payload in enumerate(payloads):
+        if payload is None:
+            channels_sample += [None] * nchann
+            continue
+        first = k * nchann
+        thread_channels = None if channels is None else [i - first for i in channels if first <= i < first + nchann]
+        thread_out = None if out is None else out[first:first + nchann]
+        channels_sample += vdif_decode_samples(payload, FRAME_HEADER['bit_sample'], nchann,
+                                               FRAME_HEADER['data_type'], thread_channels, thread_out)
+    return channels_sample
+
+def vdif_frame_samples_perchann(FRAME_HEADER):
+    # Samples of each channel in the data field of one frame
+    data_field_bits = (FRAME_HEADER['data_frame_len_bytes'] - FRAME_HEADER['header_size_bytes']) * 8
+    values_per_step = FRAME_HEADER['nchann'] * (2 if FRAME_HEADER['data_type'] else 1)
+    return data_field_bits // FRAME_HEADER['bit_sample'] // values_per_step
+
+# Fields of a frame header, in the order of FRAME_HEADER
+VdifHeader = collections.namedtuple('VdifHeader', ['legacy_mode', 'invalid_data', 'seconds_from_epoch', 'data_frame_n',
+                                                   'reference_epoch', 'data_frame_len_bytes', 'nchann', 'vdif_version',
+                                                   'stationID', 'threadID', 'bit_sample', 'data_type', 'header_size_bytes'])
+
+def vdif_parse_header(buffer, offset=0):
+    # VdifHeader of the frame at offset of buffer (bytes, memoryview or uint8 array); FRAME_HEADER is its _asdict()
+    word0, word1, word2, word3 = struct.unpack_from('<4I', buffer, offset)
 
     # WORD0
     legacy_mode = get_bit(word0, 30)  # Bool
@@ -50,61 +186,29 @@ def vdif_frame_reader(file, skip_data=True):
     bit_sample_min1 = ibits(word3, 26, 5)
     data_type = get_bit(word3, 31)  # 0 real, 1 complex
 
-    header_size_bytes = 16
-    if not legacy_mode:
-        word4 = struct.unpack('<I', file.read(4))[0]
-        word5 = struct.unpack('<I', file.read(4))[0]
-        word6 = struct.unpack('<I', file.read(4))[0]
-        word7 = struct.unpack('<I', file.read(4))[0]
-        header_size_bytes = 32
+    # Words 4 to 7 (extended user data) are not used
+    header_size_bytes = 16 if legacy_mode else 32
 
-    data_frame_len_bytes = data_frame_len_8bytes * 8
-    nchann = 2 ** log2nchann
-    bit_sample = bit_sample_min1 + 1
+    return VdifHeader(legacy_mode, invalid_data, seconds_from_epoch, data_frame_n, reference_epoch,
+                      data_frame_len_8bytes * 8, 2 ** log2nchann, vdif_version, stationID, threadID,
+                      bit_sample_min1 + 1, data_type, header_size_bytes)
+
+def vdif_frame_reader(file, skip_data=True):
+    # Read HEADER
+    header = vdif_parse_header(file.read(16))
+    if not header.legacy_mode:
+        file.seek(16, 1)
 
     # DATA EXTRACTION
-    n32bitwords = (data_frame_len_bytes - header_size_bytes) // 4  # each read word is 4 bytes
-    total_samples_bits = (data_frame_len_bytes - header_size_bytes) * 8
-    total_samples_perchann = total_samples_bits // bit_sample  # 4000 samples with 2bit/sample, 8chann, 8000bytes data frame
+    data_field_bytes = header.data_frame_len_bytes - header.header_size_bytes
+    channels_sample = [None] * header.nchann
+    if skip_data:
+        file.seek(data_field_bytes, 1)
+    else:
+        payload = np.frombuffer(file.read(data_field_bytes), dtype=np.uint8)
+        channels_sample = vdif_decode_samples(payload, header.bit_sample, header.nchann, header.data_type)
 
-    # bit_sample= 2 [bit/sample] specific:
-    samples_per_32bitword = 32 // bit_sample  # 16 samples of 2bit in a word
-
-    channels_sample = [None] * nchann
-    samples = [None] * total_samples_perchann * nchann
-    index = 0
-
-    for counter in range(n32bitwords):  # Main cycle on all the sample data field
-        iword32 = struct.unpack('<I', file.read(4))[0]
-        if not skip_data:
-            for jj in range(samples_per_32bitword):  # 0-15
-                i_magn = ibits(iword32, jj * bit_sample, bit_sample - 1)
-                i_sign = ibits(iword32, ((jj + 1) * bit_sample) - 1, 1)  # magn (bit0) sign(bit1) | magn(bit2) sign ... we encounter firstly the magn bit
-                if bit_sample != 2:
-                    print('*** DECODING IMPOSSIBLE, WRONG SAMPLING RATE: ', bit_sample)
-                    sys.exit()
-                if i_sign == 1:  # !coding: -3 -1 1 3 -> signmagn 00 01 10 11
-                    samples[index] = i_magn * 2 + 1
-                else:
-                    samples[index] = i_magn * 2 - 3
-                index += 1
-            # Extract
-            for i in range(nchann):
-                channels_sample[i] = samples[i::nchann]  # one element every nchann elements
-
-    FRAME_HEADER = {'legacy_mode': legacy_mode,
-                    'invalid_data': invalid_data,
-                    'seconds_from_epoch': seconds_from_epoch,
-                    'data_frame_n': data_frame_n,
-                    'reference_epoch': reference_epoch,
-                    'data_frame_len_bytes': data_frame_len_bytes,
-                    'nchann': nchann,
-                    'vdif_version': vdif_version,
-                    'stationID': stationID,
-                    'threadID': threadID,
-                    'bit_sample': bit_sample,
-                    'data_type': data_type,
-                    'header_size_bytes': header_size_bytes}
+    FRAME_HEADER = header._asdict()
 
     FRAME_DATA = channels_sample
 
@@ -112,53 +216,230 @@ def vdif_frame_reader(file, skip_data=True):
              "DATA": FRAME_DATA}
     return FRAME
 
-def vdif_integ_sec_align(file):
+VDIF_INDEX_DTYPE = np.dtype([('seconds_from_epoch', np.uint32),
+                             ('data_frame_n', np.uint32),
+                             ('threadID', np.uint16),
+                             ('invalid_data', np.bool_),
+                             ('offset', np.int64)])
+
+def vdif_index_cache_path(filename):
+    # .vdifidx sidecar, in the aux_files/ directory made by sidefile_creator.sh if there is one
+    directory, basename = os.path.split(os.path.abspath(filename))
+    aux_dir = os.path.join(directory, 'aux_files')
+    if os.path.isdir(aux_dir):
+        directory = aux_dir
+    return os.path.join(directory, basename + '.vdifidx')
+
+class VdifIndex:
+    """Frame index of a VDIF file, decoded from the frame headers of a memory map."""
+
+    def __init__(self, filename, cache=False):
+        self.filename = filename
+        self.mmap = np.memmap(filename, dtype=np.uint8, mode='r')
+        word0, word1, word2, word3 = (int(word) for word in self.mmap[:16].view('<u4'))
+        self.legacy_mode = get_bit(word0, 30)
+        self.header_size_bytes = 16 if self.legacy_mode else 32
+        self.data_frame_len_bytes = ibits(word2, 0, 24) * 8
+        self.n_frames = len(self.mmap) // self.data_frame_len_bytes
+        self._headers = None
+        self._first_second = None
+        self._frames_in_sec = None
+        self._last_header = None
+        self._threads = None
+        self._cache_stale = False
+        self.cache_path = vdif_index_cache_path(filename) if cache else None
+        if cache:
+            self.load_cache()
+
+    def _file_key(self):
+        stat = os.stat(self.filename)
+        return stat.st_size, stat.st_mtime_ns
+
+    def load_cache(self):
+        """Reuse the sidecar index if it was written for the current size and mtime of the file."""
+        try:
+            with np.load(self.cache_path) as cache:
+                if tuple(int(k) for k in cache['file_key']) != self._file_key():
+                    print('Index cache {} is stale, rebuilding it'.format(self.cache_path))
+                    return False
+                if cache['first_second'] >= 0:
+                    self._first_second = int(cache['first_second'])
+                if cache['frames_in_sec'] >= 0:
+                    self._frames_in_sec = int(cache['frames_in_sec'])
+                if len(cache['last_header']):
+                    self._last_header = cache['last_header'][0]
+                if cache['has_headers']:
+                    self._headers = cache['headers']
+                if 'threads' in cache.files and len(cache['threads']):
+                    self._threads = [int(thread) for thread in cache['threads']]
+        except (OSError, KeyError, ValueError):
+            return False
+        print('Index cache loaded from {}'.format(self.cache_path))
+        return True
+
+    def save_cache(self):
+        """Write what has been learned about the file to the sidecar index, if anything is new."""
+        if self.cache_path is None or not self._cache_stale:
+            return
+        no_headers = np.empty(0, dtype=VDIF_INDEX_DTYPE)
+        cache_tmp = self.cache_path + '.tmp'
+        try:
+            with open(cache_tmp, 'wb') as cache:
+                np.savez(cache,
+                         file_key=np.array(self._file_key(), dtype=np.int64),
+                         first_second=-1 if self._first_second is None else self._first_second,
+                         frames_in_sec=-1 if self._frames_in_sec is None else self._frames_in_sec,
+                         last_header=no_headers if self._last_header is None else np.array([self._last_header]),
+                         has_headers=self._headers is not None,
+                         threads=np.array(self._threads if self._threads is not None else [], dtype=np.int64),
+                         headers=no_headers if self._headers is None else self._headers)
+            os.replace(cache_tmp, self.cache_path)
+        except OSError as e:
+            print('*** Could not write index cache {}: {}'.format(self.cache_path, e))
+            return
+        self._cache_stale = False
+
+    def decode_headers(self, start=0, stop=None):
+        """Decode the headers of frames [start, stop), striding through the file one frame length at a time."""
+        stop = self.n_frames if stop is None else min(stop, self.n_frames)
+        start = min(start, stop)
+        words = np.ndarray((stop - start, 4), dtype='<u4', buffer=self.mmap,
+                           offset=start * self.data_frame_len_bytes, strides=(self.data_frame_len_bytes, 4))
+        headers = np.empty(stop - start, dtype=VDIF_INDEX_DTYPE)
+        headers['seconds_from_epoch'] = words[:, 0] & 0x3fffffff
+        headers['invalid_data'] = words[:, 0] >> 31
+        headers['data_frame_n'] = words[:, 1] & 0xffffff
+        headers['threadID'] = (words[:, 3] >> 16) & 0x3ff
+        headers['offset'] = np.arange(start, stop, dtype=np.int64) * self.data_frame_len_bytes
+        return headers
+
+    @property
+    def headers(self):
+        """Headers of all the frames in the file."""
+        if self._headers is None:
+            self._headers = self.decode_headers()
+            self._cache_stale = True
+        return self._headers
+
+    def headers_window(self, start, stop):
+        """Headers of frames [start, stop), from the full index if it is loaded."""
+        if self._headers is not None:
+            return self._headers[start:stop]
+        return self.decode_headers(start, stop)
+
+    @property
+    def threads(self):
+        """Thread IDs of the file, sorted, from the headers of its first frames."""
+        if self._threads is None:
+            headers = self._headers if self._headers is not None else self.decode_headers(0, 4096)
+            self._threads = [int(thread) for thread in np.unique(headers['threadID'])]
+            self._cache_stale = True
+        return self._threads
+
+    @property
+    def first_second(self):
+        """Frame number of the first frame with data_frame_n == 0."""
+        if self._first_second is None:
+            starts = self.second_starts(0)
+            if len(starts) == 0:
+                print('*** NO INTEGER SECOND FOUND IN FILE: ', self.filename)
+                sys.exit()
+            self._first_second = int(starts[0])
+            self._cache_stale = True
+        return self._first_second
+
+    def last_header(self):
+        """Header of the last complete frame in the file."""
+        if self._last_header is None:
+            self._last_header = self.decode_headers(self.n_frames - 1)[0]
+            self._cache_stale = True
+        return self._last_header
+
+    @staticmethod
+    def _second_start_mask(headers, previous):
+        # Frames with data_frame_n == 0 that follow a frame of an earlier second: in multi-thread files,
+        # the first frame of the run of frames (one per thread) starting the second
+        # previous -> header of the frame before headers[0], None at the start of the file
+        data_frame_n = headers['data_frame_n']
+        seconds = headers['seconds_from_epoch']
+        mask = data_frame_n == 0
+        mask[1:] &= (data_frame_n[:-1] != 0) | (seconds[:-1] != seconds[1:])
+        if len(headers) and previous is not None:
+            mask[0] &= previous['data_frame_n'] != 0 or previous['seconds_from_epoch'] != seconds[0]
+        return mask
+
+    def second_starts(self, frame=0, count=1):
+        """Frame numbers of the first count frames starting an integer second, at or after frame."""
+        if self._headers is not None:
+            previous = self._headers[frame - 1] if frame > 0 else None
+            return frame + np.flatnonzero(self._second_start_mask(self._headers[frame:], previous))[:count]
+        # Without the full index, decode growing windows of headers until enough seconds are found
+        starts = []
+        window = 4096
+        previous = self.decode_headers(frame - 1, frame)[0] if frame > 0 else None
+        while sum(len(s) for s in starts) < count and frame < self.n_frames:
+            headers = self.decode_headers(frame, frame + window)
+            starts.append(frame + np.flatnonzero(self._second_start_mask(headers, previous)))
+            previous = headers[-1]
+            frame += window
+            window *= 2
+        return np.concatenate(starts or [np.empty(0, dtype=np.int64)])[:count]
+
+    def frame_key(self, frame):
+        """(seconds_from_epoch, data_frame_n) of a frame: the same for the frames of all the threads at one time step."""
+        header = self.decode_headers(frame, frame + 1)[0]
+        return int(header['seconds_from_epoch']), int(header['data_frame_n'])
+
+    def search(self, key, low=0, high=None):
+        """First frame in [low, high) whose frame_key is not before key, bisecting single headers (high if none)."""
+        high = self.n_frames if high is None else high
+        while low < high:
+            middle = (low + high) // 2
+            if self.frame_key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def frames_in_sec(self, frame=0):
+        """Frames per second of all the threads, from the frame numbers of the (up to two) integer seconds at or after frame.
+
+        Counted from the highest data_frame_n rather than the distance between two seconds, so that
+        missing or repeated frames do not change it."""
+        at_first_second = frame <= self.first_second
+        if at_first_second and self._frames_in_sec is not None:
+            return self._frames_in_sec
+        starts = self.second_starts(max(frame, self.first_second), 3)
+        if len(starts) < 2:
+            print('*** SAMPLE RATE EXTRACTION IMPOSSIBLE, LESS THAN ONE INTEGER SECOND IN FILE: ', self.filename)
+            sys.exit()
+        headers = self.decode_headers(int(starts[0]), int(starts[-1]))
+        frames_in_sec = (int(headers['data_frame_n'].max()) + 1) * len(self.threads)
+        if at_first_second:
+            self._frames_in_sec = frames_in_sec
+            self._cache_stale = True
+        return frames_in_sec
+
+def vdif_integ_sec_align(file, index=None):
     # file -> in main, "with open() as file:"
-    frames_read = 0
-    while True:
-        offset_position = file.tell()
-        # READ HEADER AND DATA FIELDS
-        word0 = struct.unpack('<I', file.read(4))[0]
-        word1 = struct.unpack('<I', file.read(4))[0]
-        word2 = struct.unpack('<I', file.read(4))[0]
-        word3 = struct.unpack('<I', file.read(4))[0]
-
-        legacy_mode = get_bit(word0, 30)  # Bool
-        data_frame_n = ibits(word1, 0, 24)  # int
-        data_frame_len_8bytes = ibits(word2, 0, 24)  # int
-
-        header_size_bytes = 16
-        if not legacy_mode:
-            word4 = struct.unpack('<I', file.read(4))[0]
-            word5 = struct.unpack('<I', file.read(4))[0]
-            word6 = struct.unpack('<I', file.read(4))[0]
-            word7 = struct.unpack('<I', file.read(4))[0]
-            header_size_bytes = 32
-
-        data_frame_len_bytes = data_frame_len_8bytes * 8
-        n32bitwords = (data_frame_len_bytes - header_size_bytes) // 4  # each read word is 4 bytes
-
-        for i in range(n32bitwords):
-            temp = struct.unpack('<I', file.read(4))[0]
-
-        frames_read += 1
-
-        if data_frame_n == 0:
-            file.seek(offset_position)
-            frames_read -= 1
-            return frames_read
-
-def vdif_samplerate_extractor(file):
-    file_position = file.tell()
+    if index is None:
+        index = VdifIndex(file.name)
+    frame = file.tell() // index.data_frame_len_bytes
+    starts = [index.first_second] if frame <= index.first_second else index.second_starts(frame)
+    if len(starts) == 0:
+        print('*** NO INTEGER SECOND FOUND AFTER FRAME: ', frame)
+        sys.exit()
+    file.seek(int(starts[0]) * index.data_frame_len_bytes)
+    frames_read = int(starts[0]) - frame
+    return frames_read
+
+def vdif_samplerate_extractor(file, index=None):
+    if index is None:
+        index = VdifIndex(file.name)
 
     print('Sample rate extraction:')
-    vdif_integ_sec_align(file)
-    vdif_frame_reader(file)
-    frames_in_sec = vdif_integ_sec_align(file)
-    frames_in_sec += 1
+    frames_in_sec = index.frames_in_sec(file.tell() // index.data_frame_len_bytes)
     print('Computed frames per second: ', frames_in_sec)
-
-    file.seek(file_position)
     return frames_in_sec
 
 def vdif_timedecode(FRAME, frames_in_sec):
@@ -195,6 +476,28 @@ def vdif_timedecode(FRAME, frames_in_sec):
     ss = int(np.rint(diff2))
     return year, doy, sod, hh, mm, ss
 
+def vdif_second_timetag(FRAME_HEADER, seconds_from_epoch, frames_in_sec):
+    # year, doy, sod, hh, mm, ss of the start of an integer second of the same reference epoch
+    FRAME = {'HEADER': dict(FRAME_HEADER, seconds_from_epoch=seconds_from_epoch, data_frame_n=0)}
+    return vdif_timedecode(FRAME, frames_in_sec)
+
+def vdif_epoch_seconds(reference_epoch, year, doy, sod):
+    # Seconds from the start of a reference epoch (half years since 2000) of a UTC year, day of year and second of day
+    epoch_start = datetime.datetime(2000 + reference_epoch // 2, 1 + 6 * (reference_epoch % 2), 1)
+    return (datetime.datetime(year, 1, 1) - epoch_start).total_seconds() + (doy - 1) * 86400 + sod
+
+def vdif_parse_utc(text):
+    # 'YYYY/DOY/SOD' (fractional SOD allowed) or ISO 8601 'YYYY-MM-DDTHH:MM:SS[.ffffff]' -> year, doy, sod
+    try:
+        if '/' in text:
+            year, doy, sod = text.split('/')
+            return int(year), int(doy), float(sod)
+        t = datetime.datetime.fromisoformat(text.rstrip('Z'))
+        return t.year, t.timetuple().tm_yday, t.hour * 3600 + t.minute * 60 + t.second + t.microsecond * 1e-6
+    except ValueError:
+        print('*** WRONG UTC TIME, EXPECTED YYYY/DOY/SOD OR YYYY-MM-DDTHH:MM:SS: ', text)
+        sys.exit()
+
 def vdif_info_timetag_extractor(file, frames_in_sec):
     print('Timetag extraction:')
     file_position = file.tell()
@@ -204,91 +507,519 @@ def vdif_info_timetag_extractor(file, frames_in_sec):
     print('{:04} {:03} {}'.format(year, doy, sod), '{:02}:{:02}:{:02}'.format(hh, mm, ss))
     return year, doy, sod, hh, mm, ss, FRAME
 
-def vdif_skip_seconds(file, skip):
-    for i in range(skip):
-        FRAME = vdif_frame_reader(file)
-        vdif_integ_sec_align(file)
-        print('Skipped second {}'.format(i + 1))
+def vdif_seek_seconds(file, frames_in_sec, skip, index=None):
+    # file -> positioned on the first frame of an integer second
+    if skip <= 0:
+        return
+    if index is None:
+        index = VdifIndex(file.name)
+    frame = file.tell() // index.data_frame_len_bytes
+    current = index.decode_headers(frame, frame + 1)[0]
+    target_key = (int(current['seconds_from_epoch']) + skip, 0)  # frame 0 of the target second
 
-def vdif_second_reader(file, frames_in_sec):
-    # file -> in main, "with open() as file:"
+    # Frames have a fixed size: without missing or repeated frames the target is skip * frames_in_sec ahead
+    target = frame + skip * frames_in_sec
+    if target >= index.n_frames or index.frame_key(target) != target_key or index.frame_key(target - 1) >= target_key:
+        # Local search: bisect the headers for the first frame at or after the target second
+        target = index.search(target_key, frame)
+        if target >= index.n_frames:
+            print('*** SEEK IMPOSSIBLE, LESS THAN {} SECONDS AFTER FRAME: '.format(skip), frame)
+            sys.exit()
+        print('Frames missing before second {}, found it by header search'.format(skip))
+    file.seek(target * index.data_frame_len_bytes)
+    print('Skipped {} seconds'.format(skip))
 
-    for k in range(frames_in_sec):
-        if k == 0:
-            # HEADER
-            word0 = struct.unpack('<I', file.read(4))[0]
-            word1 = struct.unpack('<I', file.read(4))[0]
-            word2 = struct.unpack('<I', file.read(4))[0]
-            word3 = struct.unpack('<I', file.read(4))[0]
-
-            legacy_mode = get_bit(word0, 30)  # Bool
-            invalid_data = get_bit(word0, 31)  # Bool
-            seconds_from_epoch = ibits(word0, 0, 30)  # int
-            data_frame_n = ibits(word1, 0, 24)  # int
-            reference_epoch = ibits(word1, 24, 6)  # int
-            data_frame_len_8bytes = ibits(word2, 0, 24)  # int
-            log2nchann = ibits(word2, 24, 5)  # int
-            vdif_version = ibits(word2, 29, 3)  # int
-            stationID = chr(ibits(word3, 0, 8)) + chr(ibits(word3, 8, 16))  # string
-            threadID = ibits(word3, 16, 10)
-            bit_sample_min1 = ibits(word3, 26, 5)
-            data_type = get_bit(word3, 31)  # 0 real, 1 complex
-            header_size_bytes = 16
-            if not legacy_mode:
-                word4 = struct.unpack('<I', file.read(4))[0]
-                word5 = struct.unpack('<I', file.read(4))[0]
-                word6 = struct.unpack('<I', file.read(4))[0]
-                word7 = struct.unpack('<I', file.read(4))[0]
-                header_size_bytes = 32
-
-            data_frame_len_bytes = data_frame_len_8bytes * 8
-            nchann = 2 ** log2nchann
-            bit_sample = bit_sample_min1 + 1
-
-            FRAME_HEADER = {'legacy_mode': legacy_mode,
-                            'invalid_data': invalid_data,
-                            'seconds_from_epoch': seconds_from_epoch,
-                            'data_frame_n': data_frame_n,
-                            'reference_epoch': reference_epoch,
-                            'data_frame_len_bytes': data_frame_len_bytes,
-                            'nchann': nchann,
-                            'vdif_version': vdif_version,
-                            'stationID': stationID,
-                            'threadID': threadID,
-                            'bit_sample': bit_sample,
-                            'data_type': data_type,
-                            'header_size_bytes': header_size_bytes}
-
-            n32bitwords = (FRAME_HEADER['data_frame_len_bytes'] - FRAME_HEADER['header_size_bytes']) // 4  # each read word is 4 bytes
-
-            total_samples_bits = (FRAME_HEADER['data_frame_len_bytes'] - FRAME_HEADER['header_size_bytes']) * 8
-            total_samples = total_samples_bits // FRAME_HEADER['bit_sample']
-            total_samples_perchann = total_samples // nchann  # 4000 samples with 2bit in a word, 8chann, 8000bytes data frame
-
-            samples_per_32bitword = 32 // FRAME_HEADER['bit_sample']  # 16 samples of 2bit in a word
-
-            index = 0  # counter for all the samples and channels in one second of data
-            channels_sample = [None] * nchann
-            samples = [None] * total_samples * frames_in_sec  # all samples of all channels for one second of data
+class VdifFrameMapper:
+    """Frame maps of consecutive integer seconds, each validated from the headers around that second only.
 
-        else:
-            # Skip header
-            offset_position = file.tell()
-            file.seek(offset_position + FRAME_HEADER['header_size_bytes'])
-
-        # Read data
-        for counter in range(n32bitwords):  # Main cycle on all the sample data field
-            iword32 = struct.unpack('<I', file.read(4))[0]
-            for jj in range(samples_per_32bitword):  # 0-15
-                if get_bit(iword32, (jj * 2) + 1):  # !coding: -3 -1 1 3 -> signmagn 00 01 10 11
-                    samples[index] = get_bit(iword32, jj * 2) * 2 + 1
+    second(k) -> FRAME_MAP of second k (as vdif_frame_map, time steps counted from first_frame). Maps are
+    built as they are asked for, in order as the file is read, and only the last few are kept: memory
+    does not grow with the number of seconds, but for valid, (seconds, threads) True if no frame is
+    missing in that second of that thread, filled in as the seconds are mapped. report() prints the
+    header validation of the seconds mapped so far."""
+
+    def __init__(self, index, first_frame, frames_in_sec, n_seconds, n_cached=4):
+        # first_frame -> the first frame of an integer second
+        self.index = index
+        self.threads = index.threads
+        self.steps_in_sec = frames_in_sec // len(self.threads)
+        self.frames_in_sec = frames_in_sec
+        self.n_seconds = n_seconds
+        self.first_frame = first_frame
+        self.first_second = index.frame_key(first_frame)[0] if first_frame < index.n_frames else 0
+        self.valid = np.zeros((n_seconds, len(self.threads)), dtype=bool)
+        self.n_cached = n_cached
+        self._maps = collections.OrderedDict()
+        self._start = (0, first_frame)  # (second, frame) of the last second start found
+        # Validation report of the seconds mapped in order
+        self._mapped = 0
+        self._counts = dict.fromkeys(('missing', 'invalid', 'repeated', 'out_of_place', 'jumps'), 0)
+        self._gaps = [[] for thread in self.threads]
+        self._n_gaps = [0] * len(self.threads)
+        self._open_gaps = [None] * len(self.threads)
+        self._jumps = []
+
+    def _second_start(self, k):
+        # First frame at or after integer second k: frames_in_sec after the last one found if no frame is missing
+        # or repeated in between, else found by bisecting the headers
+        known_k, known = self._start
+        if k == known_k:
+            return known
+        index = self.index
+        key = (self.first_second + k, 0)
+        frame = known + (k - known_k) * self.frames_in_sec
+        if k < known_k or frame >= index.n_frames or index.frame_key(frame) != key or index.frame_key(frame - 1) >= key:
+            frame = index.search(key, known if k > known_k else self.first_frame)
+        self._start = (k, frame)
+        return frame
+
+    def second(self, k):
+        """FRAME_MAP of second k, from the headers from its start to the next one (and a few frames around, for frames out of order)."""
+        if k in self._maps:
+            self._maps.move_to_end(k)
+            return self._maps[k]
+        index = self.index
+        threads = self.threads
+        n_threads = len(threads)
+        steps_in_sec = self.steps_in_sec
+        start, stop = self._second_start(k), self._second_start(k + 1)
+        first_frame = max(start - 16 * n_threads, self.first_frame)
+        last_frame = min(stop + 16 * n_threads, index.n_frames)
+        headers = index.headers_window(first_frame, last_frame)
+        frame_numbers = first_frame + np.arange(len(headers), dtype=np.int64)
+
+        # Time step (in this second) and thread of every frame
+        seconds = headers['seconds_from_epoch'].astype(np.int64)
+        data_frame_n = headers['data_frame_n'].astype(np.int64)
+        step = (seconds - (self.first_second + k)) * steps_in_sec + data_frame_n
+        thread = np.minimum(np.searchsorted(threads, headers['threadID']), n_threads - 1)
+        known_thread = np.asarray(threads)[thread] == headers['threadID']
+        in_range = (step >= 0) & (step < steps_in_sec) & (data_frame_n < steps_in_sec) & known_thread
+        invalid = in_range & headers['invalid_data'].astype(bool)
+        usable = in_range & ~invalid
+
+        # First frame of each slot wins, the others are duplicates
+        slots, first, counts = np.unique(step[usable] * n_threads + thread[usable], return_index=True, return_counts=True)
+        frames = np.full(steps_in_sec * n_threads, -1, dtype=np.int64)
+        frames[slots] = frame_numbers[usable][first]
+        frames = frames.reshape(steps_in_sec, n_threads)
+
+        # File range of each time step: from its first frame up to the first frame of any later step
+        after = np.flatnonzero(step >= steps_in_sec)
+        end = int(frame_numbers[after[0]]) if len(after) else last_frame
+        step_first = np.where(frames >= 0, frames, end).min(axis=1)
+        starts = np.minimum.accumulate(np.append(step_first, end)[::-1])[::-1]
+
+        missing = frames < 0
+        if k < self.n_seconds:
+            self.valid[k] = ~missing.any(axis=0)
+        if k == self._mapped and k < self.n_seconds:
+            # Frames of this second only: from its start to the next one
+            own = (frame_numbers >= start) & (frame_numbers < stop)
+            own_seconds = seconds[own.argmax():own.argmax() + own.sum() + 1] if own.any() else seconds[:0]
+            jumps = np.flatnonzero((np.diff(own_seconds) < 0) | (np.diff(own_seconds) > 1))
+            self._counts['missing'] += int(missing.sum())
+            self._counts['invalid'] += int(invalid.sum())
+            self._counts['repeated'] += int(counts.sum()) - len(slots)
+            self._counts['out_of_place'] += int((own & ~in_range & (seconds == self.first_second + k)).sum())
+            self._counts['jumps'] += len(jumps)
+            for jump in jumps[:5 - len(self._jumps)]:
+                self._jumps.append((own_seconds[jump], own_seconds[jump + 1], start + jump))
+            self._add_gaps(k, missing)
+            self._mapped += 1
+
+        FRAME_MAP = {'frames': frames,
+                     'starts': starts,
+                     'first_step': k * steps_in_sec,
+                     'steps_in_sec': steps_in_sec}
+        self._maps[k] = FRAME_MAP
+        if len(self._maps) > self.n_cached:
+            self._maps.popitem(last=False)
+        return FRAME_MAP
+
+    def seconds(self, first, stop):
+        """FRAME_MAP of seconds [first, stop), joined (see vdif_frame_map_join)."""
+        return vdif_frame_map_join([self.second(k) for k in range(first, stop)])
+
+    def _add_gaps(self, k, missing):
+        # Runs of missing frames of each thread, continued from the previous second
+        steps_in_sec = self.steps_in_sec
+        for t in range(len(self.threads)):
+            open_start, self._open_gaps[t] = self._open_gaps[t], None
+            if open_start is not None and not missing[0, t]:
+                self._add_gap(t, open_start, k * steps_in_sec)
+                open_start = None
+            edges = np.diff(np.concatenate(([0], missing[:, t].astype(np.int8), [0])))
+            for gap_start, gap_end in zip(k * steps_in_sec + np.flatnonzero(edges == 1), k * steps_in_sec + np.flatnonzero(edges == -1)):
+                if gap_start == k * steps_in_sec and open_start is not None:
+                    gap_start = open_start
+                if gap_end == (k + 1) * steps_in_sec:
+                    self._open_gaps[t] = gap_start
                 else:
-                    samples[index] = get_bit(iword32, jj * 2) * 2 - 3
-                index += 1
-    # Extract
-    for i in range(nchann):
-        channels_sample[i] = samples[i::nchann]  # one element every nchann elements
+                    self._add_gap(t, gap_start, gap_end)
+
+    def _add_gap(self, t, gap_start, gap_end):
+        self._n_gaps[t] += 1
+        if len(self._gaps[t]) < 5:
+            self._gaps[t].append((gap_start, gap_end))
+
+    def report(self):
+        """Print the header validation of the seconds mapped in order so far."""
+        steps_in_sec = self.steps_in_sec
+        counts = self._counts
+        print('Header validation: {} frames missing or invalid ({} invalid), {} repeated, {} out of place, {} time jumps'.format(
+            counts['missing'], counts['invalid'], counts['repeated'], counts['out_of_place'], counts['jumps']))
+        for t, thread in enumerate(self.threads):
+            gaps = list(self._gaps[t])
+            n_gaps = self._n_gaps[t]
+            if self._open_gaps[t] is not None:
+                n_gaps += 1
+                if len(gaps) < 5:
+                    gaps.append((self._open_gaps[t], self._mapped * steps_in_sec))
+            for gap_start, gap_end in gaps:
+                print('  thread {}: {} frames missing from second {} frame {}'.format(
+                    thread, gap_end - gap_start, gap_start // steps_in_sec, gap_start % steps_in_sec))
+            if n_gaps > 5:
+                print('  thread {}: {} more gaps'.format(thread, n_gaps - 5))
+        for second, next_second, frame in self._jumps:
+            print('  time jump from {} to {} seconds after frame {}'.format(second, next_second, frame))
+
+def vdif_frame_map(index, first_frame, frames_in_sec, n_seconds):
+    # Validate the headers of n_seconds seconds from first_frame (the first frame of an integer second), all at once,
+    # and place each frame on its (time step, thread) slot. Returns FRAME_MAP:
+    #   'frames' -> (time steps, threads) frame number in the file, -1 for missing, invalid or repeated frames
+    #   'starts' -> first frame of the file range holding each time step (and the end of the last one)
+    #   'first_step' -> time step of frames[0], counted from first_frame; 'steps_in_sec' -> time steps per second
+    #   'valid' -> (seconds, threads) True if no frame is missing in that second of that thread
+    # Its size grows with n_seconds: conversions map their seconds one at a time with VdifFrameMapper
+    mapper = VdifFrameMapper(index, first_frame, frames_in_sec, n_seconds)
+    FRAME_MAP = mapper.seconds(0, max(n_seconds, 1))
+    if n_seconds == 0:
+        FRAME_MAP = vdif_frame_map_slice(FRAME_MAP, 0, 0)
+    mapper.report()
+    FRAME_MAP['valid'] = mapper.valid
+    return FRAME_MAP
+
+def vdif_frame_map_join(FRAME_MAPS):
+    # One FRAME_MAP of the time steps of consecutive FRAME_MAPS (of consecutive seconds)
+    starts = np.concatenate([FRAME_MAP['starts'][:-1] for FRAME_MAP in FRAME_MAPS] + [FRAME_MAPS[-1]['starts'][-1:]])
+    return {'frames': np.concatenate([FRAME_MAP['frames'] for FRAME_MAP in FRAME_MAPS]),
+            'starts': np.minimum.accumulate(starts[::-1])[::-1],
+            'first_step': FRAME_MAPS[0]['first_step'],
+            'steps_in_sec': FRAME_MAPS[0]['steps_in_sec']}
+
+def vdif_frame_map_slice(FRAME_MAP, first_step, stop_step):
+    # Time steps [first_step, stop_step) of FRAME_MAP (counted as its 'first_step'), enough to read them
+    a = max(first_step - FRAME_MAP['first_step'], 0)
+    b = min(max(stop_step - FRAME_MAP['first_step'], a), len(FRAME_MAP['frames']))
+    return {'frames': FRAME_MAP['frames'][a:b],
+            'starts': FRAME_MAP['starts'][a:b + 1],
+            'first_step': FRAME_MAP['first_step'] + a,
+            'steps_in_sec': FRAME_MAP['steps_in_sec']}
+
+def vdif_map_rows(FRAME_MAP, first_step, stop_step):
+    # Rows, in the frames read from the file range of time steps [first_step, stop_step), of the frame of each
+    # thread at each step: -1 for the frames missing, or outside that range
+    a, b = first_step - FRAME_MAP['first_step'], stop_step - FRAME_MAP['first_step']
+    rows = FRAME_MAP['frames'][a:b] - FRAME_MAP['starts'][a]
+    rows[(FRAME_MAP['frames'][a:b] < 0) | (rows >= FRAME_MAP['starts'][b] - FRAME_MAP['starts'][a])] = -1
+    return rows
+
+def vdif_range_bytes(FRAME_MAP, FRAME_HEADER, first_step, stop_step):
+    # Bytes of the file range of time steps [first_step, stop_step)
+    a, b = first_step - FRAME_MAP['first_step'], stop_step - FRAME_MAP['first_step']
+    return int(FRAME_MAP['starts'][b] - FRAME_MAP['starts'][a]) * FRAME_HEADER['data_frame_len_bytes']
+
+def vdif_decode_mapped(buffer, rows, FRAME_HEADER, channels=None, out=None):
+    # buffer -> frames read from the file; rows -> (time steps, threads) row of buffer of each frame, -1 if missing
+    # channels, out -> as vdif_decode_frames. The samples of the missing frames are zero
+    frame_len = FRAME_HEADER['data_frame_len_bytes']
+    header_size = FRAME_HEADER['header_size_bytes']
+    nchann = FRAME_HEADER['nchann']
+    n_steps, n_threads = rows.shape
+    samples_per_frame = vdif_frame_samples_perchann(FRAME_HEADER)
+    frames = np.frombuffer(buffer, dtype=np.uint8, count=memoryview(buffer).nbytes // frame_len * frame_len).reshape(-1, frame_len)
+    if len(frames) == 0:
+        frames = np.zeros((1, frame_len), dtype=np.uint8)
+    channels = range(nchann * n_threads) if channels is None else channels
+    channels_sample = [None] * (nchann * n_threads)
+    for k in sorted({i // nchann for i in channels}):
+        thread_rows = rows[:, k]
+        present = thread_rows >= 0
+        stride = int(thread_rows[1] - thread_rows[0]) if n_steps > 1 else 1
+        if present.all() and stride > 0 and (np.diff(thread_rows) == stride).all():
+            payload = frames[thread_rows[0]:thread_rows[-1] + 1:stride, header_size:]  # no copy
+        else:
+            payload = frames[np.where(present, thread_rows, 0), header_size:]
+        first = k * nchann
+        thread_channels = [i - first for i in channels if first <= i < first + nchann]
+        thread_out = None if out is None else out[first:first + nchann]
+        decoded = vdif_decode_samples(payload, FRAME_HEADER['bit_sample'], nchann, FRAME_HEADER['data_type'],
+                                      thread_channels, thread_out)
+        for c in thread_channels:
+            if not present.all():
+                decoded[c].reshape(n_steps, samples_per_frame)[~present] = 0
+            channels_sample[first + c] = decoded[c]
+    return channels_sample
+
+def vdif_read_steps(file, FRAME_HEADER, FRAME_MAP, first_step, stop_step, channels=None):
+    # Read and decode time steps [first_step, stop_step) of FRAME_MAP, with zeros for its missing frames
+    file.seek(int(FRAME_MAP['starts'][first_step - FRAME_MAP['first_step']]) * FRAME_HEADER['data_frame_len_bytes'])
+    buffer = file.read(vdif_range_bytes(FRAME_MAP, FRAME_HEADER, first_step, stop_step))
+    return vdif_decode_mapped(buffer, vdif_map_rows(FRAME_MAP, first_step, stop_step), FRAME_HEADER, channels)
+
+def vdif_second_reader(file, frames_in_sec, channels=None, threads=None):
+    # file -> in main, "with open() as file:"
+    # channels -> channels to decode (first channel is 0), all of them if None
+    # threads -> thread IDs of the file (VdifIndex.threads), the thread of the first frame if None
+    second_position = file.tell()
+    data_frame_len_bytes = ibits(struct.unpack('<4I', file.read(16))[2], 0, 24) * 8
+
+    # Read data: all the frames of the second in one go
+    file.seek(second_position)
+    return vdif_second_decoder(file.read(data_frame_len_bytes * frames_in_sec), frames_in_sec, channels, threads)
+
+def vdif_second_decoder(buffer, frames_in_sec, channels=None, threads=None):
+    # buffer -> bytes or memoryview holding frames_in_sec frames (of all the threads), the first one of an integer second
+
+    # HEADER (first frame of the second)
+    header = vdif_parse_header(buffer)
+    data_frame_len_bytes = header.data_frame_len_bytes
+    FRAME_HEADER = dict(header._asdict(), threads=[header.threadID] if threads is None else list(threads))
+
+    # Data: drop the headers of all the frames and split the threads, without copying the buffer
+    frames = np.frombuffer(buffer, dtype=np.uint8, count=data_frame_len_bytes * frames_in_sec)
+    frames = frames.reshape(frames_in_sec, data_frame_len_bytes)
+    channels_sample = vdif_decode_frames(frames, FRAME_HEADER, channels)
 
     FRAME_SEC = {"HEADER": FRAME_HEADER,
                  "DATA": channels_sample}
     return FRAME_SEC
+
+class VdifPrefetcher:
+    """Read-ahead of blocks of a VDIF file on a background thread.
+
+    Blocks are read with readinto into n_buffers preallocated buffers of buffer_bytes, and handed out
+    as zero-copy memoryviews: a block must no longer be used once the iteration moves on to the next one.
+    close() (or leaving a with block) stops the reader, even if not all the blocks were consumed."""
+
+    def __init__(self, file, blocks, n_buffers=2, buffer_bytes=0):
+        # blocks -> iterable of (file offset, bytes, tag) of the blocks to read, in order; it is
+        # pulled by the reader thread as it advances, and each block is yielded as (data, tag)
+        self.file = file
+        self.blocks = blocks
+        self._free = queue.Queue()
+        self._full = queue.Queue()
+        for k in range(max(n_buffers, 1)):
+            self._free.put(bytearray(buffer_bytes))
+        self._closing = False
+        self._thread = threading.Thread(target=self._read_blocks, daemon=True)
+        self._thread.start()
+
+    def _read_blocks(self):
+        try:
+            position = None
+            for offset, block_size, tag in self.blocks:
+                buffer = self._free.get()
+                if buffer is None or self._closing:
+                    return
+                if len(buffer) < block_size:
+                    # Block larger than planned (frames out of place): this buffer is replaced for good
+                    buffer = bytearray(block_size)
+                if offset != position:
+                    self.file.seek(offset)
+                n_bytes = self.file.readinto(memoryview(buffer)[:block_size])
+                position = offset + n_bytes
+                self._full.put((buffer, n_bytes, tag))
+                if n_bytes < block_size:
+                    break
+        except Exception as e:
+            self._full.put(e)
+        self._full.put(None)
+
+    def __iter__(self):
+        while True:
+            block = self._full.get()
+            if block is None:
+                return
+            if isinstance(block, Exception):
+                raise block
+            buffer, n_bytes, tag = block
+            METRICS.gauge('readahead_blocks', self._full.qsize() + 1)
+            yield memoryview(buffer)[:n_bytes], tag
+            self._free.put(buffer)
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._closing = True
+        self._free.put(None)
+        self._thread.join()
+        self._thread = None
+        # Buffers of the blocks read ahead but never consumed
+        self._free, self._full = queue.Queue(), queue.Queue()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+class VdifReader:
+    """Frames and integer seconds of a VDIF file, as zero-copy views of its memory map.
+
+    Iterating over the reader gives (VdifHeader, payload) for each frame, payload being a uint8 view
+    of the data field. seconds() decodes whole seconds, with zeros for the missing frames. Views
+    stay valid as long as the reader is referenced."""
+
+    def __init__(self, filename, cache=False):
+        self.index = VdifIndex(filename, cache)
+        self.filename = filename
+        self.mmap = self.index.mmap
+        self.data_frame_len_bytes = self.index.data_frame_len_bytes
+        self.header = vdif_parse_header(self.mmap)  # first frame
+        self.FRAME_HEADER = dict(self.header._asdict(), threads=self.index.threads)
+
+    def __len__(self):
+        return self.index.n_frames
+
+    def frame_header(self, frame):
+        """VdifHeader of a frame."""
+        return vdif_parse_header(self.mmap, frame * self.data_frame_len_bytes)
+
+    def frames(self, start=0, stop=None):
+        """uint8 view (frames, frame length) of frames [start, stop)."""
+        stop = len(self) if stop is None else min(stop, len(self))
+        start = min(start, stop)
+        return self.mmap[start * self.data_frame_len_bytes:stop * self.data_frame_len_bytes].reshape(-1, self.data_frame_len_bytes)
+
+    def payloads(self, start=0, stop=None):
+        """uint8 view (frames, data field bytes) of the data fields of frames [start, stop)."""
+        return self.frames(start, stop)[:, self.header.header_size_bytes:]
+
+    def __iter__(self):
+        payloads = self.payloads()
+        for frame in range(len(self)):
+            yield self.frame_header(frame), payloads[frame]
+
+    def decode(self, start=0, stop=None, channels=None):
+        """Samples of frames [start, stop), holding whole time steps of all the threads, as vdif_decode_frames."""
+        return vdif_decode_frames(self.frames(start, stop), self.FRAME_HEADER, channels)
+
+    def seconds(self, skip=0, count=None, channels=None, sample_cache=None):
+        """Yield (seconds_from_epoch, valid, channels_sample) for count integer seconds (all if None) after skip.
+
+        valid -> per thread, False if frames of the second are missing or invalid: their samples are zeros.
+        channels_sample -> as vdif_decode_frames, decoded straight from the memory map, or read from
+        sample_cache (VdifSampleCache) if it holds them (the others are added to it)."""
+        index = self.index
+        frames_in_sec = index.frames_in_sec()
+        steps_in_sec = frames_in_sec // len(index.threads)
+        first_frame = index.first_second
+        first_second = index.frame_key(first_frame)[0] + skip
+        if skip > 0:
+            first_frame = index.search((first_second, 0), first_frame)
+        last = index.last_header()
+        n_seconds = int(last['seconds_from_epoch']) - first_second + int(last['data_frame_n'] == steps_in_sec - 1)
+        n_seconds = max(n_seconds if count is None else min(count, n_seconds), 0)
+        if n_seconds == 0 or first_frame >= len(self):
+            return
+        mapper = VdifFrameMapper(index, first_frame, frames_in_sec, n_seconds)
+        n_channels = vdif_total_channels(self.FRAME_HEADER)
+        channels = range(n_channels) if channels is None else channels
+        file_key = sample_cache.file_key(self.filename) if sample_cache is not None else None
+        for k in range(n_seconds):
+            FRAME_MAP = mapper.second(k)
+            cached = sample_cache.load(file_key, first_second + k, channels) if sample_cache is not None else None
+            if cached is not None:
+                yield first_second + k, mapper.valid[k], [cached.get(i) for i in range(n_channels)]
+                continue
+            first_step, stop_step = k * steps_in_sec, (k + 1) * steps_in_sec
+            frames = self.frames(int(FRAME_MAP['starts'][0]), int(FRAME_MAP['starts'][-1]))
+            rows = vdif_map_rows(FRAME_MAP, first_step, stop_step)
+            channels_sample = vdif_decode_mapped(frames, rows, self.FRAME_HEADER, channels)
+            if sample_cache is not None:
+                sample_cache.store(file_key, first_second + k, channels_sample, channels)
+            yield first_second + k, mapper.valid[k], channels_sample
+        mapper.report()
+
+class VdifSampleCache:
+    """Decoded samples of whole seconds, kept on disk to skip decoding in later runs on the same files.
+
+    One .npy file per VDIF file identity (path, size and modification time), second and channel,
+    read back as a memory map without copying. Beyond max_bytes the least recently used files are
+    deleted, file modification times recording the uses."""
+
+    def __init__(self, directory, max_bytes=10e9):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in self._entries())
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def _entries(self):
+        for file_dir in os.scandir(self.directory):
+            if file_dir.is_dir():
+                yield from (entry for entry in os.scandir(file_dir.path) if entry.name.endswith('.npy'))
+
+    @staticmethod
+    def file_key(filename):
+        # Name of the directory of the samples of a VDIF file: changes if the file is moved or modified
+        stat = os.stat(filename)
+        path_hash = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()[:12]
+        return '{}-{}-{}-{}'.format(os.path.basename(filename), path_hash, stat.st_size, stat.st_mtime_ns)
+
+    def path(self, file_key, second, channel):
+        return os.path.join(self.directory, file_key, '{}_{}.npy'.format(second, channel))
+
+    def has(self, file_key, second, channels):
+        """True if the samples of all the channels of a second are cached."""
+        return all(os.path.exists(self.path(file_key, second, i)) for i in channels)
+
+    def load(self, file_key, second, channels):
+        """{channel: read-only memory map of its samples} of a second, None unless all the channels are cached."""
+        paths = {i: self.path(file_key, second, i) for i in channels}
+        try:
+            samples = {i: np.load(path, mmap_mode='r') for i, path in paths.items()}
+        except (OSError, ValueError):
+            return None
+        for path in paths.values():
+            os.utime(path)
+        return samples
+
+    def store(self, file_key, second, channels_sample, channels):
+        """Keep the decoded samples of the channels of a second (channels_sample as vdif_decode_frames)."""
+        os.makedirs(os.path.join(self.directory, file_key), exist_ok=True)
+        for i in channels:
+            path = self.path(file_key, second, i)
+            try:
+                old_size = os.path.getsize(path)  # a file replaced, e.g. stored by another run meanwhile
+            except OSError:
+                old_size = 0
+            try:
+                with open(path + '.tmp', 'wb') as cache_f:
+                    np.save(cache_f, channels_sample[i])
+                os.replace(path + '.tmp', path)
+            except OSError as e:
+                print('*** Could not write sample cache {}: {}'.format(path, e))
+                return
+            self.size += os.path.getsize(path) - old_size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Delete the least recently used files, down to 90% of max_bytes so that eviction is not needed at every store.
+
+        The size is first taken again from the directory, which other runs may have added to or evicted from."""
+        entries = sorted(((entry.stat().st_mtime_ns, entry.stat().st_size, entry.path) for entry in self._entries()))
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size